@@ -0,0 +1,72 @@
+"""基准测试共用的启动代码：在指定的工作目录中加载插件，并提供只响应管理后台接口的模拟bot"""
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+MANIFEST_NAME = "benchmark.json"
+"""生成器写在工作目录中的数据说明，供测试脚本选择查询条件"""
+
+
+def start(workdir: str, log_level: str = "WARNING"):
+    """切换到工作目录并加载插件，返回未启动的TestClient，需要在with语句中使用"""
+    path = Path(workdir).resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    # 插件的配置文件和默认数据库路径都相对于工作目录
+    os.chdir(path)
+    sys.path.insert(0, str(ROOT))
+
+    import nonebot
+    from nonebot.adapters.onebot.v11 import Adapter
+    from starlette.testclient import TestClient
+
+    nonebot.init(
+        driver="~fastapi", superusers={"1"}, nickname={"bot"}, log_level=log_level
+    )
+    nonebot.get_driver().register_adapter(Adapter)
+    nonebot.load_plugin("nonebot_plugin_learning_chat")
+    return TestClient(nonebot.get_asgi())
+
+
+def connect_bot(groups: Dict[int, List[int]], self_id: str = "10000"):
+    """连接一个模拟的OneBot bot，需要在事件循环中调用"""
+    import nonebot
+    from nonebot.adapters.onebot.v11 import Adapter, Bot
+
+    class StubBot(Bot):
+        """只返回群列表和群成员，其他接口什么都不做"""
+
+        async def call_api(self, api: str, **data):
+            if api == "get_group_list":
+                return [
+                    {"group_id": group_id, "group_name": f"群{group_id}"}
+                    for group_id in groups
+                ]
+            if api == "get_group_member_list":
+                return [
+                    {"user_id": user_id, "nickname": f"群友{user_id}", "card": ""}
+                    for user_id in groups.get(data["group_id"], [])
+                ]
+            return {"message_id": 0}
+
+    adapter = nonebot.get_adapter(Adapter)
+    bot = StubBot(adapter, self_id)
+    adapter.bot_connect(bot)
+    return bot
+
+
+def ljust(text: str, width: int) -> str:
+    """按终端显示宽度左对齐，中文字符占两个宽度"""
+    return text + " " * max(width - len(text.encode("gbk")), 0)
+
+
+def read_manifest() -> dict:
+    with open(MANIFEST_NAME, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest: dict):
+    with open(MANIFEST_NAME, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
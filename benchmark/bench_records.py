@@ -0,0 +1,86 @@
+"""比较模型对象与轻量记录的内存占用和读取耗时
+
+先用generate_db.py生成数据库，再在同一个工作目录中运行：
+
+    python benchmark/bench_records.py bench_data --rows 100000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from typing import Awaitable, Callable, List, Tuple
+
+from _harness import ljust, start
+
+
+async def measure(load: Callable[[], Awaitable[list]]) -> Tuple[int, float, float]:
+    """返回(记录数量, 每条记录占用的字节数, 每条记录的读取耗时微秒)"""
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    rows = await load()
+    elapsed = time.perf_counter() - start_time
+    # 只统计读取完成后仍然存活的内存，即缓存这些记录的实际开销
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = len(rows) or 1
+    return len(rows), size / count, elapsed / count * 1e6
+
+
+async def run(rows: int):
+    from nonebot_plugin_learning_chat.models import ChatAnswer, ChatContext, ChatMessage
+    from nonebot_plugin_learning_chat.records import (
+        load_answers,
+        load_contexts,
+        load_messages,
+    )
+
+    cases: List[Tuple[str, Callable[[], Awaitable[list]], Callable[[], Awaitable[list]]]] = [
+        (
+            "聊天记录",
+            lambda: ChatMessage.all().limit(rows),
+            lambda: load_messages(ChatMessage.all().limit(rows)),
+        ),
+        (
+            "内容",
+            lambda: ChatContext.all().limit(rows),
+            lambda: load_contexts(ChatContext.all().limit(rows)),
+        ),
+        (
+            "回复",
+            lambda: ChatAnswer.all().limit(rows),
+            lambda: load_answers(ChatAnswer.all().limit(rows)),
+        ),
+    ]
+    print(
+        ljust("类型", 10)
+        + "".join(
+            " " * (14 - len(h.encode("gbk"))) + h
+            for h in ("数量", "模型(B/条)", "记录(B/条)", "模型(us/条)", "记录(us/条)")
+        )
+    )
+    for name, load_models, load_records in cases:
+        # 先读取一次，使数据库页面进入缓存，两种方式的比较更公平
+        await load_records()
+        count, model_size, model_time = await measure(load_models)
+        _, record_size, record_time = await measure(load_records)
+        print(
+            ljust(name, 10)
+            + f"{count:>14}{model_size:>14.0f}{record_size:>14.0f}"
+            f"{model_time:>14.2f}{record_time:>14.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较模型对象与轻量记录的内存占用和读取耗时")
+    parser.add_argument("workdir", nargs="?", default="bench_data", help="generate_db.py生成数据的工作目录")
+    parser.add_argument("--rows", type=int, default=100000, help="每种类型读取的数量")
+    args = parser.parse_args()
+
+    client = start(args.workdir)
+    with client:
+        client.portal.call(run, args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""在进程内请求管理后台接口，按接口和查询条件统计延迟分位数
+
+先用generate_db.py生成数据库，再在同一个工作目录中运行：
+
+    python benchmark/bench_web_api.py bench_data --repeat 50 --output result.json
+    python benchmark/bench_web_api.py bench_data --baseline result.json
+
+指定--baseline时，中位数延迟比基线慢超过--tolerance的项目会列出并以非零状态退出，
+可作为分页和搜索优化的回归测试。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from _harness import connect_bot, ljust, read_manifest, start
+
+API = "/learning_chat/api/"
+
+
+class Scenario(NamedTuple):
+    endpoint: str
+    condition: str
+    params: dict
+
+    @property
+    def key(self) -> str:
+        return f"{self.endpoint}|{self.condition}"
+
+
+def build_scenarios(manifest: dict, per_page: int) -> List[Scenario]:
+    hot_group, cold_group = manifest["hot_group"], manifest["cold_group"]
+    common_word, rare_word = manifest["common_word"], manifest["rare_word"]
+    page = {"perPage": per_page}
+
+    def middle_page(total: int) -> int:
+        return max(total // per_page // 2, 1)
+
+    scenarios = [
+        Scenario("get_chat_messages", "默认", page),
+        Scenario("get_chat_messages", "热门群", {**page, "group_id": hot_group}),
+        Scenario("get_chat_messages", "冷门群", {**page, "group_id": cold_group}),
+        Scenario("get_chat_messages", "活跃用户", {**page, "user_id": manifest["hot_user"]}),
+        Scenario("get_chat_messages", "搜索常见词", {**page, "message": common_word}),
+        Scenario("get_chat_messages", "搜索罕见词", {**page, "message": rare_word}),
+        Scenario(
+            "get_chat_messages",
+            "热门群+搜索",
+            {**page, "group_id": hot_group, "message": common_word},
+        ),
+        Scenario("get_chat_messages", "时间升序", {**page, "orderDir": "asc"}),
+        Scenario(
+            "get_chat_messages",
+            "中间页",
+            {**page, "page": middle_page(manifest["messages"])},
+        ),
+        Scenario("get_chat_contexts", "默认", page),
+        Scenario("get_chat_contexts", "按次数", {**page, "orderBy": "count"}),
+        Scenario("get_chat_contexts", "搜索关键词", {**page, "keywords": common_word}),
+        Scenario(
+            "get_chat_contexts",
+            "中间页",
+            {**page, "page": middle_page(manifest["contexts"])},
+        ),
+        Scenario("get_chat_answers", "默认", page),
+        Scenario("get_chat_answers", "按时间", {**page, "orderBy": "time"}),
+        Scenario("get_chat_answers", "搜索关键词", {**page, "keywords": common_word}),
+        Scenario(
+            "get_chat_answers",
+            "中间页",
+            {**page, "page": middle_page(manifest["answers"])},
+        ),
+        Scenario("get_chat_blacklist", "默认", page),
+        Scenario("get_message_partitions", "默认", {}),
+        Scenario("chat_global_config", "默认", {}),
+        Scenario("chat_group_config", "热门群", {"group_id": hot_group}),
+        Scenario("stats", "全部群", {}),
+        Scenario("stats", "热门群", {"group_id": hot_group}),
+        Scenario("stats_chart", "全部群", {}),
+    ]
+    if manifest.get("hot_context"):
+        scenarios.append(
+            Scenario(
+                "get_chat_answers",
+                "热门内容",
+                {**page, "context_id": manifest["hot_context"]},
+            )
+        )
+    return scenarios
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近秩法的分位数"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(math.ceil(q * len(ordered)) - 1, 0))]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(samples, 0.5), 2),
+        "p90": round(percentile(samples, 0.9), 2),
+        "p99": round(percentile(samples, 0.99), 2),
+        "max": round(max(samples), 2),
+        "mean": round(sum(samples) / len(samples), 2),
+    }
+
+
+class Runner:
+    def __init__(self, client, repeat: int, warmup: int):
+        self.client = client
+        self.repeat = repeat
+        self.warmup = warmup
+        self._token: Optional[str] = None
+        self._token_time = 0.0
+
+    @property
+    def token(self) -> str:
+        # 登录凭证30分钟过期，长时间测试时定期重新登录
+        if not self._token or time.monotonic() - self._token_time > 600:
+            from nonebot_plugin_learning_chat.config import config_manager
+
+            response = self.client.post(
+                API + "login",
+                json={
+                    "username": config_manager.config.web_username,
+                    "password": config_manager.config.web_password,
+                },
+            )
+            self._token = response.json()["data"]["token"]
+            self._token_time = time.monotonic()
+        return self._token
+
+    def request(self, scenario: Scenario) -> float:
+        """返回请求耗时，单位为毫秒，请求失败时抛出异常"""
+        headers = {"token": self.token}
+        start_time = time.perf_counter()
+        response = self.client.get(
+            API + scenario.endpoint, params=scenario.params, headers=headers
+        )
+        elapsed = (time.perf_counter() - start_time) * 1000
+        data = response.json()
+        if response.status_code != 200 or (
+            isinstance(data, dict) and data.get("status", 0) != 0
+        ):
+            raise RuntimeError(f"{scenario.key}: {response.status_code} {data}")
+        return elapsed
+
+    def run(self, scenario: Scenario) -> Dict[str, float]:
+        for _ in range(self.warmup):
+            self.request(scenario)
+        return summarize([self.request(scenario) for _ in range(self.repeat)])
+
+
+def print_table(results: Dict[str, Dict[str, float]]):
+    columns = ("p50", "p90", "p99", "max", "mean")
+    print(
+        ljust("接口", 24)
+        + ljust("条件", 14)
+        + "".join(f"{k:>10}" for k in columns)
+        + "  (ms)"
+    )
+    for key, stats in results.items():
+        endpoint, condition = key.split("|", 1)
+        print(
+            ljust(endpoint, 24)
+            + ljust(condition, 14)
+            + "".join(f"{stats[k]:>10.2f}" for k in columns)
+        )
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float
+) -> List[str]:
+    """返回中位数延迟超过基线(1+tolerance)倍的项目，差距不足1ms的忽略"""
+    regressions = []
+    for key, stats in results.items():
+        if (base := baseline.get(key)) is None:
+            continue
+        if stats["p50"] > base["p50"] * (1 + tolerance) and stats["p50"] - base["p50"] >= 1:
+            regressions.append(f"{key}: {base['p50']:.2f}ms -> {stats['p50']:.2f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="群聊学习管理后台接口压力测试")
+    parser.add_argument("workdir", nargs="?", default="bench_data", help="generate_db.py生成数据的工作目录")
+    parser.add_argument("--repeat", type=int, default=20, help="每个项目计时的请求次数")
+    parser.add_argument("--warmup", type=int, default=2, help="每个项目不计时的预热请求次数")
+    parser.add_argument("--per-page", type=int, default=10)
+    parser.add_argument("--only", help="只测试接口或条件中包含该文本的项目")
+    parser.add_argument("--output", help="将结果写入JSON文件，可作为之后的基线")
+    parser.add_argument("--baseline", help="与之前的结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许比基线慢的比例")
+    args = parser.parse_args()
+    # start会切换工作目录，先将结果文件的路径转为绝对路径
+    output = args.output and os.path.abspath(args.output)
+    baseline = args.baseline and os.path.abspath(args.baseline)
+
+    client = start(args.workdir)
+    manifest = read_manifest()
+    scenarios = [
+        s
+        for s in build_scenarios(manifest, args.per_page)
+        if not args.only or args.only in s.key
+    ]
+    groups = {int(g): users for g, users in manifest["groups"].items()}
+    results: Dict[str, Dict[str, float]] = {}
+    with client:
+        client.portal.call(_connect, groups)
+        runner = Runner(client, args.repeat, args.warmup)
+        for scenario in scenarios:
+            results[scenario.key] = runner.run(scenario)
+    print(
+        f"聊天记录{manifest['messages']}条，学习内容{manifest['contexts']}条，"
+        f"回复{manifest['answers']}条，每个项目{args.repeat}次请求"
+    )
+    print_table(results)
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("以下项目比基线慢：")
+            print("\n".join(regressions))
+            raise SystemExit(1)
+        print("没有比基线慢的项目")
+
+
+async def _connect(groups: Dict[int, List[int]]):
+    connect_bot(groups)
+    # 等待连接时恢复发言统计等后台任务完成，避免影响计时
+    await asyncio.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
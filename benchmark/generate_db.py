@@ -0,0 +1,321 @@
+"""生成用于压力测试的聊天记录、学习内容和回复
+
+群和群友的活跃度、词语的使用频率都服从齐夫分布，发言时间带有昼夜变化，
+学习次数服从几何分布，与实际数据库的分布大致相同。
+
+    python benchmark/generate_db.py bench_data --messages 10000000 --contexts 1000000 --answers 3000000
+
+聊天记录与插件相同，以去重后的形式写入；指定--inline时按旧版本的形式写入，
+用于比较两种存储方式的数据库大小。
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import random
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Sequence, Set, Tuple
+
+from _harness import start, write_manifest
+
+WORDS = (
+    "哈哈 哈哈哈 笑死 确实 好家伙 草 牛 真的 假的 什么 怎么 为什么 可以 不行 没有 有没有 "
+    "今天 明天 昨天 晚上 早上 中午 睡觉 起床 吃饭 外卖 奶茶 火锅 烧烤 好吃 好饿 好困 好累 "
+    "上班 下班 摸鱼 加班 放假 周末 考试 作业 老师 同学 老板 工资 打工 买 卖 便宜 太贵 "
+    "游戏 抽卡 出货 保底 歪了 十连 上分 掉分 队友 开黑 来玩 等我 马上 在吗 在的 不在 "
+    "群主 管理 机器人 bot 色图 表情包 发图 图呢 涩 可爱 老婆 我老婆 羡慕 酸了 "
+    "好的 收到 明白 懂了 不懂 问号 啊这 无语 离谱 绝了 破防 急了 寄 芜湖 起飞 冲 "
+    "早 晚安 早安 午安 摸摸 抱抱 贴贴 谢谢 辛苦了 对不起 没事 算了 随便 都行 "
+    "下雨 好热 好冷 天气 出门 回家 宿舍 地铁 堵车 迟到 手机 电脑 显卡 键盘 "
+    "小说 动画 番剧 漫画 电影 音乐 唱歌 视频 直播 主播 up主 更新 鸽了 催更"
+).split()
+"""聊天常用词"""
+FACE_RATE = 0.05
+"""带QQ表情的消息比例"""
+IMAGE_RATE = 0.12
+"""图片消息比例"""
+STICKER_RATE = 0.5
+"""图片消息中表情包的比例，表情包从有限的图片中选取，会被反复发送"""
+STICKERS = 5000
+"""表情包的数量"""
+HOUR_WEIGHTS = (
+    3, 2, 1, 1, 1, 1, 2, 4, 6, 7, 8, 9, 10, 9, 8, 8, 8, 9, 10, 11, 12, 12, 10, 6
+)
+"""每小时的相对发言量"""
+MANIFEST_USERS = 200
+"""说明文件中每个群记录的群友数量，用作模拟bot返回的群成员"""
+
+
+def zipf_cum_weights(n: int, s: float = 1.1) -> List[float]:
+    return list(itertools.accumulate(1 / (i + 1) ** s for i in range(n)))
+
+
+def geometric(p: float) -> int:
+    """至少为1的几何分布"""
+    count = 1
+    while random.random() > p:
+        count += 1
+    return count
+
+
+class Generator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.end_time = int(time.time())
+        self.start_time = self.end_time - args.days * 86400
+        self.group_ids = [100000 + i for i in range(args.groups)]
+        self.user_ids = [200000 + i for i in range(args.users)]
+        self.group_weights = zipf_cum_weights(args.groups)
+        self.user_weights = zipf_cum_weights(args.users)
+        self.word_weights = zipf_cum_weights(len(WORDS))
+        self.sticker_weights = zipf_cum_weights(STICKERS)
+        self.members: Dict[int, Set[int]] = defaultdict(set)
+        self.daily: Counter = Counter()
+        """(群号, 日期, 统计项) -> 数量"""
+
+    def words(self, k: int) -> List[str]:
+        return random.choices(WORDS, cum_weights=self.word_weights, k=k)
+
+    def text(self) -> str:
+        return "".join(self.words(min(geometric(0.3), 12)))
+
+    def image(self) -> Tuple[str, str]:
+        """返回(消息, 原始消息)，原始消息带有协议端附加的图片链接"""
+        if random.random() < STICKER_RATE:
+            image_id = random.choices(range(STICKERS), cum_weights=self.sticker_weights)[0]
+        else:
+            image_id = STICKERS + random.getrandbits(64)
+        file = f"{image_id:032x}.image"
+        url = f"https://gchat.qpic.cn/gchatpic_new/0/0-0-{image_id:032X}/0?term=2"
+        return f"[CQ:image,file={file}]", f"[CQ:image,file={file},subType=0,url={url}]"
+
+    def message(self) -> Tuple[str, str, str]:
+        """返回(消息, 原始消息, 纯文本)"""
+        roll = random.random()
+        if roll < IMAGE_RATE:
+            return (*self.image(), "")
+        text = self.text()
+        if roll < IMAGE_RATE + FACE_RATE:
+            message = f"{text}[CQ:face,id={random.randrange(300)}]"
+            return message, message, text
+        return text, text, text
+
+    def times(self, n: int, start: int, end: int) -> List[int]:
+        """在时间段内按昼夜变化生成n个递增的时间"""
+        peak = max(HOUR_WEIGHTS)
+        result = []
+        while len(result) < n:
+            t = random.randrange(start, max(end, start + 1))
+            if random.random() * peak < HOUR_WEIGHTS[datetime.datetime.fromtimestamp(t).hour]:
+                result.append(t)
+        return sorted(result)
+
+    def date(self, timestamp: int) -> str:
+        return datetime.date.fromtimestamp(timestamp).isoformat()
+
+    async def insert(self, model, rows: Sequence):
+        from tortoise.transactions import in_transaction
+
+        async with in_transaction("learning_chat") as conn:
+            await model.bulk_create(rows, using_db=conn)
+
+    async def progress(self, name: str, model, total: int, make_batch):
+        start_time = time.perf_counter()
+        done = 0
+        while done < total:
+            size = min(self.args.batch, total - done)
+            rows = make_batch(done, size)
+            if asyncio.iscoroutine(rows):
+                rows = await rows
+            await self.insert(model, rows)
+            done += size
+            elapsed = time.perf_counter() - start_time
+            print(f"\r{name}: {done}/{total} ({done / elapsed:.0f}条/秒)", end="", flush=True)
+        print()
+
+    async def message_batch(self, offset: int, size: int):
+        from nonebot_plugin_learning_chat.models import ChatMessage
+        from nonebot_plugin_learning_chat.text_store import compact_messages
+
+        span = (self.end_time - self.start_time) / self.args.messages
+        times = self.times(
+            size,
+            self.start_time + int(offset * span),
+            self.start_time + int((offset + size) * span),
+        )
+        groups = random.choices(self.group_ids, cum_weights=self.group_weights, k=size)
+        users = random.choices(self.user_ids, cum_weights=self.user_weights, k=size)
+        rows = []
+        for i, (group_id, user_id, timestamp) in enumerate(zip(groups, users, times)):
+            message, raw_message, plain_text = self.message()
+            if len(self.members[group_id]) < MANIFEST_USERS:
+                self.members[group_id].add(user_id)
+            self.daily[(group_id, self.date(timestamp), "messages")] += 1
+            rows.append(
+                ChatMessage(
+                    group_id=group_id,
+                    user_id=user_id,
+                    message_id=offset + i + 1,
+                    message=message,
+                    raw_message=raw_message,
+                    plain_text=plain_text,
+                    time=timestamp,
+                )
+            )
+        # 默认与插件写入时相同，经过去重
+        return rows if self.args.inline else await compact_messages(rows)
+
+    def context_batch(self, offset: int, size: int):
+        from nonebot_plugin_learning_chat.models import ChatContext
+
+        return [
+            ChatContext(
+                keywords=" ".join(sorted(set(self.words(random.randint(2, 3))))),
+                time=random.randrange(self.start_time, self.end_time),
+                count=geometric(0.4),
+            )
+            for _ in range(size)
+        ]
+
+    def answer_batch(self, context_ids: List[int], context_weights: List[float]):
+        from nonebot_plugin_learning_chat.models import ChatAnswer
+
+        def make(offset: int, size: int):
+            contexts = random.choices(context_ids, cum_weights=context_weights, k=size)
+            groups = random.choices(self.group_ids, cum_weights=self.group_weights, k=size)
+            rows = []
+            for context_id, group_id in zip(contexts, groups):
+                timestamp = random.randrange(self.start_time, self.end_time)
+                count = geometric(0.35)
+                self.daily[(group_id, self.date(timestamp), "answers")] += count
+                rows.append(
+                    ChatAnswer(
+                        keywords=" ".join(self.words(random.randint(1, 3))),
+                        group_id=group_id,
+                        count=count,
+                        time=timestamp,
+                        messages=[self.message()[0] for _ in range(min(count, 3))],
+                        context_id=context_id,
+                    )
+                )
+            return rows
+
+        return make
+
+    async def run(self):
+        from nonebot_plugin_learning_chat.models import (
+            ChatMessage,
+            ChatContext,
+            ChatAnswer,
+            ChatBlackList,
+            ChatStat,
+        )
+
+        args = self.args
+        if await ChatMessage.exists() or await ChatContext.exists():
+            raise SystemExit("工作目录中的数据库已有数据，请使用新的工作目录")
+        random.seed(args.seed)
+        start_time = time.perf_counter()
+        await self.progress("聊天记录", ChatMessage, args.messages, self.message_batch)
+        await self.progress("学习内容", ChatContext, args.contexts, self.context_batch)
+        # SQLite批量写入不返回id，重新查询；热门内容排在前面，拥有更多回复
+        context_ids = await ChatContext.all().order_by("id").values_list("id", flat=True)
+        await self.progress(
+            "回复",
+            ChatAnswer,
+            args.answers,
+            self.answer_batch(context_ids, zipf_cum_weights(len(context_ids), 0.9)),
+        )
+        banned = random.sample(WORDS, min(args.blacklist, len(WORDS)))
+        await self.insert(
+            ChatBlackList,
+            [
+                ChatBlackList(
+                    keywords=word,
+                    global_ban=random.random() < 0.3,
+                    ban_group_id=[random.choice(self.group_ids)],
+                )
+                for word in banned
+            ],
+        )
+        stats: Dict[Tuple[int, str], Dict[str, int]] = defaultdict(dict)
+        for (group_id, date, field), count in self.daily.items():
+            stats[(group_id, date)][field] = count
+        rows = [
+            ChatStat(group_id=group_id, date=date, **counts)
+            for (group_id, date), counts in stats.items()
+        ]
+        for i in range(0, len(rows), args.batch):
+            await self.insert(ChatStat, rows[i : i + args.batch])
+
+        hot_context = context_ids[0] if context_ids else None
+        write_manifest(
+            {
+                "messages": args.messages,
+                "contexts": args.contexts,
+                "answers": args.answers,
+                "blacklist": len(banned),
+                "groups": {
+                    str(group_id): sorted(users)
+                    for group_id, users in self.members.items()
+                },
+                "hot_group": self.group_ids[0],
+                "cold_group": self.group_ids[-1],
+                "hot_user": self.user_ids[0],
+                "hot_context": hot_context,
+                "common_word": WORDS[0],
+                "rare_word": WORDS[-1],
+            }
+        )
+        print(f"生成完成，耗时{time.perf_counter() - start_time:.1f}s")
+        await self.report_size()
+
+    async def report_size(self):
+        from tortoise import Tortoise
+
+        conn = Tortoise.get_connection("learning_chat")
+        if conn.capabilities.dialect != "sqlite":
+            return
+        # WAL模式下新写入的数据还在-wal文件中，合并后数据库文件的大小才准确
+        await conn.execute_script("PRAGMA wal_checkpoint(TRUNCATE)")
+        database = Path("data") / "learning_chat" / "learning_chat.db"
+        print(
+            f"数据库大小{database.stat().st_size / 1024 / 1024:.1f}MB"
+            f"({'未去重' if self.args.inline else '去重'}存储)"
+        )
+        try:
+            tables = await conn.execute_query_dict(
+                "SELECT name, SUM(pgsize) AS size FROM dbstat "
+                "WHERE name IN ('message', 'text') GROUP BY name"
+            )
+        except Exception:
+            # SQLite未编译dbstat时无法统计单个表
+            return
+        for row in tables:
+            print(f"  {row['name']}表{row['size'] / 1024 / 1024:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成用于压力测试的群聊学习数据库")
+    parser.add_argument("workdir", nargs="?", default="bench_data", help="工作目录，数据库和配置文件会生成在其中")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--contexts", type=int, default=10000)
+    parser.add_argument("--answers", type=int, default=30000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--blacklist", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=5000, help="每个事务写入的行数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--inline", action="store_true", help="按未去重的旧形式写入聊天记录，用于比较数据库大小")
+    args = parser.parse_args()
+
+    client = start(args.workdir)
+    with client:
+        client.portal.call(Generator(args).run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+import time
+
+_load_start_time = time.perf_counter()
+
 from nonebot import require
 
 require("nonebot_plugin_tortoise_orm")
@@ -5,24 +9,41 @@ require("nonebot_plugin_tortoise_orm")
 
 import asyncio
 import random
-import time
+from pathlib import Path
+from typing import Optional, Set
 
-from nonebot import on_message, require, logger, get_adapter
+from nonebot import on_message, on_command, require, logger, get_adapter
 from nonebot.adapters.onebot.v11 import (
+    Bot,
     GroupMessageEvent,
     GROUP,
     Message,
     ActionFailed,
     Adapter,
 )
-from nonebot.params import Arg
+from nonebot.params import Arg, CommandArg
+from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
 from nonebot.rule import Rule
 from nonebot.typing import T_State
-from .handler import LearningChat
-from .models import ChatMessage
-from .config import config_manager, NICKNAME
-from . import web_api, web_page
+from .handler import LearningChat, Speech
+from .bulk_learn import learn_history
+from .partition import maintain_messages
+from .text_store import remove_orphan_texts, resume_text_migration
+from .models import ChatJob
+from .decay import forget_learned
+from .repeat import repeat_detector
+from .journal import reply_journal
+from .activity import activity_tracker
+from .stats import stat_counter
+from .explain import explain, format_explain
+from .coordination import coordinator
+from .idf import corpus_idf
+from .jobs import resume_jobs, run_in_background
+from .reload import reload_config
+from .corpus import export_to_file, import_corpus, read_corpus_file
+from .config import config_manager, NICKNAME, log_info
+from . import web_api
 
 require("nonebot_plugin_apscheduler")
 from nonebot_plugin_apscheduler import scheduler
@@ -39,8 +60,10 @@ __plugin_meta__ = PluginMetadata(
 
 
 async def ChatRule(event: GroupMessageEvent, state: T_State) -> bool:
-    if answers := await LearningChat(event).answer():
+    chat = LearningChat(event)
+    if answers := await chat.answer():
         state["answers"] = answers
+        state["answer_id"] = chat.answer_id
         return True
     return False
 
@@ -60,21 +83,22 @@ learning_chat = on_message(
 
 
 @learning_chat.handle()
-async def _(event: GroupMessageEvent, answers=Arg("answers")):
+async def _(event: GroupMessageEvent, state: T_State, answers=Arg("answers")):
     for answer in answers:
         try:
             logger.info(
                 "群聊学习", f'{NICKNAME}将向群<m>{event.group_id}</m>回复<m>"{answer}"</m>'
             )
             msg = await learning_chat.send(Message(answer))
-            await ChatMessage.create(
-                group_id=event.group_id,
-                user_id=event.self_id,
-                message_id=msg["message_id"],
-                message=answer,
-                raw_message=answer,
-                time=int(time.time()),
-                plain_text=Message(answer).extract_plain_text(),
+            reply_journal.record(
+                event.group_id,
+                event.self_id,
+                msg["message_id"],
+                answer,
+                state.get("answer_id"),
+            )
+            repeat_detector.feed(
+                event.group_id, event.self_id, answer, is_bot=True
             )
             await asyncio.sleep(random.random() + 0.5)
         except ActionFailed:
@@ -84,38 +108,207 @@ async def _(event: GroupMessageEvent, answers=Arg("answers")):
             )
 
 
-@scheduler.scheduled_job("interval", minutes=3, misfire_grace_time=5)
-async def speak_up():
-    if not config_manager.config.total_enable:
-        return
+export_cmd = on_command("导出学习数据", permission=SUPERUSER, priority=10, block=True)
+import_cmd = on_command("导入学习数据", permission=SUPERUSER, priority=10, block=True)
+learn_history_cmd = on_command(
+    "学习聊天记录", permission=SUPERUSER, priority=10, block=True
+)
+explain_cmd = on_command("解释回复", permission=SUPERUSER, priority=10, block=True)
+
+
+@explain_cmd.handle()
+async def _(event: GroupMessageEvent, arg: Message = CommandArg()):
+    if not (text := str(arg).strip()):
+        await explain_cmd.finish("请在命令后附带要解释的消息")
+    result = await explain(event.group_id, text, event.user_id)
+    await explain_cmd.finish(format_explain(result))
+
+
+@export_cmd.handle()
+async def _():
+    path = await export_to_file()
+    await export_cmd.finish(f"学习数据已导出至{path.absolute()}")
+
+
+@import_cmd.handle()
+async def _(arg: Message = CommandArg()):
+    if not (path := Path(arg.extract_plain_text().strip())).is_file():
+        await import_cmd.finish("请在命令后附带导出文件的路径")
+    try:
+        result = await import_corpus(read_corpus_file(path))
+    except Exception as e:
+        await import_cmd.finish(f"导入失败，{e}")
+    await import_cmd.finish(
+        f"导入成功，新增内容{result['context']}条，回复{result['answer']}条，禁用词{result['blacklist']}条"
+    )
+
+
+@learn_history_cmd.handle()
+async def _(arg: Message = CommandArg()):
+    if not (path := Path(arg.extract_plain_text().strip())).is_file():
+        await learn_history_cmd.finish("请在命令后附带聊天记录文件的路径")
+    await learn_history_cmd.send("开始学习聊天记录，请稍候...")
+    try:
+        result = await learn_history(path)
+    except Exception as e:
+        await learn_history_cmd.finish(f"学习失败，{e}")
+    await learn_history_cmd.finish(
+        f"学习完成，共{result['messages']}条消息，学习{result['learned']}次，"
+        f"新增内容{result['context']}条，回复{result['answer']}条，耗时{result['cost']:.1f}秒"
+    )
+
+
+def _get_bot() -> Optional[Bot]:
     try:
         bots = get_adapter(Adapter).bots
-        if len(bots) == 0:
-            return
-        bot = list(bots.values())[0]
     except ValueError:
+        return None
+    return next(iter(bots.values()), None)
+
+
+_speaking: Set[int] = set()
+"""正在主动发言的群，避免沉默计时和定期检查同时在一个群发言"""
+
+
+async def send_speech(bot: Bot, speech: Speech):
+    # 同一个群内的发言依次发送并间隔几秒，不同群之间互不等待
+    group_id, messages, answer_ids = speech
+    # 多个进程共用数据库时，最小间隔内只有一个进程能在该群主动发言
+    if not await coordinator.claim(
+        f"speak:{group_id}",
+        config_manager.get_group_config(group_id).speak_min_interval,
+    ):
         return
-    if not (speak := await LearningChat.speak(int(bot.self_id))):
+    _speaking.add(group_id)
+    stat_counter.incr(group_id, "speeches")
+    try:
+        for msg, answer_id in zip(messages, answer_ids):
+            try:
+                logger.info("群聊学习", f'{NICKNAME}向群<m>{group_id}</m>主动发言<m>"{msg}"</m>')
+                send_result = await bot.send_group_msg(
+                    group_id=group_id, message=Message(msg)
+                )
+                reply_journal.record(
+                    group_id,
+                    int(bot.self_id),
+                    send_result["message_id"],
+                    str(msg),
+                    answer_id,
+                )
+                repeat_detector.feed(
+                    group_id, int(bot.self_id), str(msg), is_bot=True
+                )
+                await asyncio.sleep(random.randint(2, 4))
+            except ActionFailed:
+                logger.info(
+                    "群聊学习",
+                    f'{NICKNAME}向群<m>{group_id}</m>主动发言<m>"{msg}"</m><r>发送失败，可能处于风控中</r>',
+                )
+    finally:
+        _speaking.discard(group_id)
+
+
+@activity_tracker.on_silence
+async def speak_on_silence(group_id: int):
+    """群沉默超过主动发言阈值时检查是否发言"""
+    if (
+        not config_manager.config.total_enable
+        or group_id in _speaking
+        or not (bot := _get_bot())
+        or not await coordinator.is_leader()
+    ):
         return
-    group_id, messages = speak
-    for msg in messages:
-        try:
-            logger.info("群聊学习", f'{NICKNAME}向群<m>{group_id}</m>主动发言<m>"{msg}"</m>')
-            send_result = await bot.send_group_msg(
-                group_id=group_id, message=Message(msg)
-            )
-            await ChatMessage.create(
-                group_id=group_id,
-                user_id=int(bot.self_id),
-                message_id=send_result["message_id"],
-                message=msg,
-                raw_message=msg,
-                time=int(time.time()),
-                plain_text=Message(msg).extract_plain_text(),
-            )
-            await asyncio.sleep(random.randint(2, 4))
-        except ActionFailed:
-            logger.info(
-                "群聊学习",
-                f'{NICKNAME}向群<m>{group_id}</m>主动发言<m>"{msg}"</m><r>发送失败，可能处于风控中</r>',
-            )
+    _speaking.add(group_id)
+    try:
+        for speech in await LearningChat.speak(int(bot.self_id), [group_id]):
+            await send_speech(bot, speech)
+    finally:
+        _speaking.discard(group_id)
+
+
+@scheduler.scheduled_job("interval", minutes=10, misfire_grace_time=5)
+async def speak_up():
+    """定期检查所有群，兜底沉默计时被错过的情况"""
+    if (
+        not config_manager.config.total_enable
+        or not (bot := _get_bot())
+        or not await coordinator.is_leader()
+    ):
+        return
+    if not (speeches := await LearningChat.speak(int(bot.self_id))):
+        return
+    await asyncio.gather(
+        *(send_speech(bot, s) for s in speeches if s.group_id not in _speaking)
+    )
+
+
+@scheduler.scheduled_job("interval", seconds=10, misfire_grace_time=5)
+async def flush_reply_journal_job():
+    await reply_journal.flush()
+    await reply_journal.flush_deferred()
+
+
+@scheduler.scheduled_job("interval", minutes=1, misfire_grace_time=10)
+async def flush_stats_job():
+    await stat_counter.flush()
+
+
+@scheduler.scheduled_job("interval", seconds=5, misfire_grace_time=5)
+async def reload_config_job():
+    await reload_config()
+
+
+@scheduler.scheduled_job("cron", hour=3, misfire_grace_time=600)
+async def build_idf_job():
+    if config_manager.config.idf_enable and await coordinator.is_leader():
+        await corpus_idf.build()
+
+
+@scheduler.scheduled_job("interval", minutes=1, misfire_grace_time=30)
+async def refresh_idf_job():
+    # 其他进程迁移完成并切换了IDF版本时重新加载
+    corpus_idf.refresh()
+    if corpus_idf.building or not await coordinator.is_leader():
+        return
+    if config_manager.config.idf_enable and corpus_idf.pending:
+        # 刚开启时立即统计一次，之后每天增量更新
+        run_in_background(corpus_idf.build(), "语料IDF统计")
+    elif not config_manager.config.idf_enable and corpus_idf.version:
+        run_in_background(corpus_idf.disable(), "停用语料IDF")
+
+
+@scheduler.scheduled_job("cron", hour=4, misfire_grace_time=600)
+async def maintain_messages_job():
+    if not await coordinator.is_leader():
+        return
+    deleted = await maintain_messages()
+    # 删除过聊天记录时清理不再被引用的文本
+    if deleted or await ChatJob.filter(
+        table="message", time__gt=int(time.time()) - 86400
+    ).exists():
+        await remove_orphan_texts()
+
+
+@scheduler.scheduled_job("cron", hour=5, misfire_grace_time=600)
+async def forget_learned_job():
+    if await coordinator.is_leader():
+        await forget_learned()
+
+
+@scheduler.scheduled_job("interval", seconds=10, misfire_grace_time=5)
+async def renew_leadership_job():
+    # 主进程持续续约，其他进程在主进程退出后接替，并继续其未完成的后台任务
+    if coordinator.enabled:
+        leader = coordinator.leader
+        if await coordinator.is_leader() and not leader:
+            await resume_jobs()
+            await resume_text_migration()
+
+
+@scheduler.scheduled_job("interval", minutes=10, misfire_grace_time=60)
+async def cleanup_leases_job():
+    if coordinator.enabled and await coordinator.is_leader():
+        await coordinator.cleanup()
+
+
+log_info("群聊学习", f"插件加载完成，耗时<m>{time.perf_counter() - _load_start_time:.2f}s</m>")
@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+from typing import Callable, Coroutine, Deque, Dict, Optional
+
+from nonebot.adapters import Bot
+
+from .models import ChatMessage
+from .journal import reply_journal
+from .jobs import run_in_background
+from .config import config_manager, driver, log_debug
+
+MIN_MESSAGES = 30
+"""今天的消息少于该数量的群不主动发言，也不设置沉默计时"""
+RECENT_USERS = 5
+"""记录最近发言的群友数量，用于主动发言时戳一戳"""
+
+
+def _today_time() -> int:
+    return int(time.mktime(datetime.date.today().timetuple()))
+
+
+class GroupActivity:
+    """某个群今天的发言统计"""
+
+    __slots__ = ("day", "count", "first_time", "last_time", "users", "timer")
+
+    def __init__(self, day: int, timestamp: int):
+        self.day = day
+        """统计开始的日期，跨天时重新统计"""
+        self.count = 0
+        """今天的消息数量"""
+        self.first_time = timestamp
+        """今天第一条消息的时间"""
+        self.last_time = timestamp
+        """最后一条消息的时间"""
+        self.users: Deque[int] = deque(maxlen=RECENT_USERS)
+        """最近发言的群友，最新的在前"""
+        self.timer: Optional[asyncio.TimerHandle] = None
+        """沉默计时，到期时检查是否主动发言"""
+
+    @property
+    def avg_interval(self) -> float:
+        """该群每多少秒发一条消息"""
+        return (self.last_time - self.first_time) / self.count
+
+    @property
+    def popularity(self) -> float:
+        """单位时间内的消息数量，用于群热度排序"""
+        duration = self.last_time - self.first_time
+        return self.count / duration if duration > 0 else float("inf")
+
+
+class ActivityTracker:
+    """按群维护今天的发言统计，并在群沉默超过主动发言阈值时触发检查，无需轮询数据库"""
+
+    def __init__(self):
+        self._groups: Dict[int, GroupActivity] = {}
+        self._handler: Optional[Callable[[int], Coroutine]] = None
+
+    def on_silence(self, func: Callable[[int], Coroutine]):
+        """注册群沉默计时到期时的处理函数，参数为群号"""
+        self._handler = func
+        return func
+
+    def get(self, group_id: int) -> Optional[GroupActivity]:
+        if (activity := self._groups.get(group_id)) and activity.day == _today_time():
+            return activity
+        return None
+
+    def snapshot(self) -> Dict[int, GroupActivity]:
+        """今天有发言的所有群"""
+        today = _today_time()
+        return {g: a for g, a in self._groups.items() if a.day == today}
+
+    def feed(
+        self, group_id: int, user_id: int, timestamp: int, arm: bool = True
+    ) -> GroupActivity:
+        """记录群里的一条新消息，并重新设置该群的沉默计时"""
+        today = _today_time()
+        if (activity := self._groups.get(group_id)) is None or activity.day != today:
+            if activity and activity.timer:
+                activity.timer.cancel()
+            activity = self._groups[group_id] = GroupActivity(today, timestamp)
+        activity.count += 1
+        activity.first_time = min(activity.first_time, timestamp)
+        activity.last_time = max(activity.last_time, timestamp)
+        activity.users.appendleft(user_id)
+        if arm:
+            self.arm(group_id)
+        return activity
+
+    def arm(self, group_id: int):
+        """按该群的平均发言间隔和主动发言阈值设置沉默计时"""
+        if not (activity := self._groups.get(group_id)):
+            return
+        if activity.timer:
+            activity.timer.cancel()
+            activity.timer = None
+        config = config_manager.get_group_config(group_id)
+        if (
+            self._handler is None
+            or activity.count < MIN_MESSAGES
+            or not config_manager.config.total_enable
+            or not config.enable
+            or not config.speak_enable
+        ):
+            return
+        fire_time = activity.last_time + activity.avg_interval * config.speak_threshold
+        # 上次发言后的最小间隔内不会发言，直接等到间隔结束
+        if last_reply := reply_journal.last(group_id):
+            fire_time = max(fire_time, last_reply.time + config.speak_min_interval)
+        # 多等一秒，避免计时到期时因取整仍略小于阈值
+        delay = max(fire_time - time.time(), 0) + 1
+        activity.timer = asyncio.get_running_loop().call_later(
+            delay, self._fire, group_id
+        )
+
+    def _fire(self, group_id: int):
+        if activity := self._groups.get(group_id):
+            activity.timer = None
+        if self._handler is None:
+            return
+        run_in_background(self._handler(group_id), f"群<m>{group_id}</m>主动发言")
+
+    def cancel_all(self):
+        for activity in self._groups.values():
+            if activity.timer:
+                activity.timer.cancel()
+                activity.timer = None
+
+    async def restore(self, self_id: int):
+        """从今天的聊天记录中恢复各群的发言统计并设置沉默计时，不包括bot发送的消息"""
+        self.cancel_all()
+        self._groups.clear()
+        for group_id, user_id, timestamp in (
+            await ChatMessage.filter(time__gte=_today_time(), user_id__not=self_id)
+            .order_by("time", "id")
+            .values_list("group_id", "user_id", "time")
+        ):
+            self.feed(group_id, user_id, timestamp, arm=False)
+        for group_id in self._groups:
+            self.arm(group_id)
+        log_debug("群聊学习", f"已从聊天记录恢复<m>{len(self._groups)}</m>个群的发言统计")
+
+    def rearm_all(self):
+        """配置修改后重新设置所有群的沉默计时"""
+        for group_id in self.snapshot():
+            self.arm(group_id)
+
+
+activity_tracker = ActivityTracker()
+
+
+@driver.on_bot_connect
+async def restore_activity(bot: Bot):
+    await activity_tracker.restore(int(bot.self_id))
+
+
+@driver.on_shutdown
+async def cancel_silence_timers():
+    activity_tracker.cancel_all()
@@ -0,0 +1,345 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, TextIO, Tuple, Union
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+from nonebot.adapters.onebot.v11 import Message
+
+from .models import ChatBlackList, extract_keyword_list, join_keywords
+from .handler import clean_message, is_allowed_message
+from .cache import context_cache
+from .keyword_index import keyword_index
+from .corpus import merge_contexts
+from .idf import corpus_idf, idf_path, load_extractor
+from .tokenizer import initialize, wait_warm_up
+from .config import ChatConfig, config_manager, NICKNAME, COMMAND_START, log_info
+
+READ_BATCH_SIZE = 20000
+"""每次交给一个分词进程解析和分词的行数"""
+WRITE_BATCH_SIZE = 5000
+"""每个事务写入的内容数量，学习到的内容达到该数量时写入数据库"""
+REPLY_WINDOW = 10000
+"""每个群保留的最近消息数量，用于查找被回复的消息"""
+COMMAND_WORDS = {"学说话", "快学", "开启学习", "闭嘴", "别学", "关闭学习", "不可以", "达咩", "不能说这"}
+
+
+class HistoryMessage(NamedTuple):
+    group_id: int
+    user_id: int
+    message_id: int
+    message: str
+    plain_text: str
+    reply_id: Optional[int]
+    time: int
+
+
+class LearnedMessage(NamedTuple):
+    user_id: int
+    message: str
+    keywords: str
+    keyword_list: List[str]
+    time: int
+
+
+def _parse_event(line: str) -> Optional[HistoryMessage]:
+    event = json.loads(line)
+    if event.get("post_type") not in {"message", "message_sent"} or (
+        event.get("message_type") != "group"
+    ):
+        return None
+    raw_message = event.get("raw_message") or str(Message(event["message"]))
+    reply = re.search(r"\[CQ:reply,id=(-?\d+)]", raw_message)
+    return HistoryMessage(
+        group_id=int(event["group_id"]),
+        user_id=int(event["user_id"]),
+        message_id=int(event["message_id"]),
+        message=clean_message(raw_message, bool(reply)),
+        plain_text=Message(raw_message).extract_plain_text(),
+        reply_id=int(reply[1]) if reply else None,
+        time=int(event["time"]),
+    )
+
+
+def _read_lines(f: TextIO) -> List[str]:
+    return list(itertools.islice(f, READ_BATCH_SIZE))
+
+
+_extractor = None
+"""分词进程中使用的关键词提取器，为None时使用当前生效的"""
+
+
+def _init_worker(dictionary: List[str], idf_file: Optional[str]):
+    """分词进程的初始化：加载自定义词典和当前生效的语料IDF"""
+    global _extractor
+    initialize(dictionary)
+    _extractor = load_extractor(Path(idf_file)) if idf_file else None
+
+
+def _tokenize(lines: List[str]) -> Tuple[int, List[HistoryMessage], List[List[str]]]:
+    """解析并分词一批消息，返回(无法解析的行数, 按群和时间排序的消息, 关键词列表)"""
+    invalid = 0
+    history: List[HistoryMessage] = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            message = _parse_event(line)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # 单行损坏不影响整个文件的学习
+            invalid += 1
+            continue
+        if message:
+            history.append(message)
+    history.sort(key=lambda m: (m.group_id, m.time))
+    return (
+        invalid,
+        history,
+        [extract_keyword_list(m.message, m.plain_text, _extractor) for m in history],
+    )
+
+
+class GroupHistory(NamedTuple):
+    """跨批次保留的每个群的学习上下文"""
+
+    recent: Deque[LearnedMessage]
+    by_message_id: "OrderedDict[int, LearnedMessage]"
+
+
+class BulkLearner:
+    """离线批量学习聊天记录，学习规则与LearningChat._learn一致"""
+
+    def __init__(self):
+        self.config: ChatConfig = config_manager.config
+        self.contexts: Dict[str, dict] = {}
+        self.blacklist: Dict[str, Tuple[bool, Set[int]]] = {}
+        self.groups: Dict[int, GroupHistory] = {}
+        self.learned = 0
+        self.new_contexts = 0
+        self.new_answers = 0
+
+    def _check_allow(
+        self, message: LearnedMessage, group_id: int, ban_words: Set[str]
+    ) -> bool:
+        if not is_allowed_message(message.message, ban_words):
+            return False
+        if ban := self.blacklist.get(message.keywords):
+            if ban[0] or group_id in ban[1]:
+                return False
+        return True
+
+    def _set_answer(
+        self, group_id: int, message: LearnedMessage, data: LearnedMessage
+    ):
+        if context := self.contexts.get(message.keywords):
+            if context["count"] < self.config.learn_max_count:
+                context["count"] += 1
+            context["time"] = data.time
+        else:
+            context = self.contexts[message.keywords] = {
+                "type": "context",
+                "keywords": message.keywords,
+                "time": data.time,
+                "count": 1,
+                "answers": {},
+            }
+        if answer := context["answers"].get((data.keywords, group_id)):
+            if answer["count"] < self.config.learn_max_count:
+                answer["count"] += 1
+            answer["time"] = data.time
+            if data.message not in answer["messages"]:
+                answer["messages"].append(data.message)
+        else:
+            context["answers"][(data.keywords, group_id)] = {
+                "keywords": data.keywords,
+                "group_id": group_id,
+                "count": 1,
+                "time": data.time,
+                "messages": [data.message],
+            }
+        self.learned += 1
+
+    def learn_group(
+        self,
+        group_id: int,
+        history: List[HistoryMessage],
+        keyword_lists: List[List[str]],
+    ):
+        config = config_manager.get_group_config(group_id)
+        if not self.config.total_enable or not config.enable:
+            return
+        ban_users = set(self.config.ban_users + config.ban_users)
+        ban_words = set(self.config.ban_words + config.ban_words)
+        if not (group := self.groups.get(group_id)):
+            group = self.groups[group_id] = GroupHistory(deque(maxlen=5), OrderedDict())
+        recent, by_message_id = group
+        for raw, keyword_list in zip(history, keyword_lists):
+            data = LearnedMessage(
+                user_id=raw.user_id,
+                message=raw.message,
+                keywords=join_keywords(raw.message, raw.plain_text, keyword_list),
+                keyword_list=keyword_list,
+                time=raw.time,
+            )
+            self._learn(
+                group_id, data, raw.reply_id, recent, by_message_id, ban_users, ban_words
+            )
+            # 与在线学习一样，所有消息都会被记录
+            recent.appendleft(data)
+            by_message_id[raw.message_id] = data
+            if len(by_message_id) > REPLY_WINDOW:
+                by_message_id.popitem(last=False)
+
+    def _learn(
+        self,
+        group_id: int,
+        data: LearnedMessage,
+        reply_id: Optional[int],
+        recent: Deque[LearnedMessage],
+        by_message_id: "OrderedDict[int, LearnedMessage]",
+        ban_users: Set[int],
+        ban_words: Set[str],
+    ):
+        if NICKNAME in data.message and any(w in data.message for w in COMMAND_WORDS):
+            return
+        if COMMAND_START and data.message.startswith(tuple(COMMAND_START)):
+            return
+        if data.user_id in ban_users or not self._check_allow(data, group_id, ban_words):
+            return
+        if reply_id is not None:
+            if (
+                (message := by_message_id.get(reply_id))
+                and message.user_id not in ban_users
+                and self._check_allow(message, group_id, ban_words)
+            ):
+                self._set_answer(group_id, message, data)
+            return
+        if not (messages := [m for m in recent if m.time >= data.time - 3600]):
+            return
+        if messages[0].message == data.message:
+            # 复读中
+            return
+        for message in messages:
+            if (
+                message.user_id not in ban_users
+                and set(data.keyword_list) & set(message.keyword_list)
+                and data.keyword_list != message.keyword_list
+                and self._check_allow(message, group_id, ban_words)
+            ):
+                self._set_answer(group_id, message, data)
+                return
+        if messages[0].user_id not in ban_users and self._check_allow(
+            messages[0], group_id, ban_words
+        ):
+            self._set_answer(group_id, messages[0], data)
+
+    async def _write(self):
+        """将学习到的内容合并写入数据库，之后再学习到的相同内容会继续合并"""
+        contexts = list(self.contexts.values())
+        self.contexts = {}
+        for i in range(0, len(contexts), WRITE_BATCH_SIZE):
+            batch = [
+                {**c, "answers": list(c["answers"].values())}
+                for c in contexts[i : i + WRITE_BATCH_SIZE]
+            ]
+            created = await merge_contexts(batch)
+            self.new_contexts += created[0]
+            self.new_answers += created[1]
+
+    def learn_batch(self, history: List[HistoryMessage], keyword_lists: List[List[str]]):
+        # 日志按时间顺序写入，批内按群排序后依次学习
+        start = 0
+        while start < len(history):
+            group_id = history[start].group_id
+            end = start
+            while end < len(history) and history[end].group_id == group_id:
+                end += 1
+            self.learn_group(group_id, history[start:end], keyword_lists[start:end])
+            start = end
+
+    def _executor(self, workers: int) -> Optional[Executor]:
+        """创建分词进程池，子进程通过fork继承已加载的插件，不支持fork的平台在线程中分词"""
+        if workers < 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        return ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(
+                list(self.config.dictionary),
+                str(idf_path(corpus_idf.version)) if corpus_idf.version else None,
+            ),
+        )
+
+    async def run(self, path: Union[str, Path], workers: Optional[int] = None) -> dict:
+        start_time = time.time()
+        for ban in await ChatBlackList.all():
+            self.blacklist[ban.keywords] = (ban.global_ban, set(ban.ban_group_id))
+        # 后台初始化持有分词器的锁时fork出的子进程会死锁
+        await wait_warm_up()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        executor = self._executor(workers)
+
+        # 读取在线程中进行，解析和分词分批交给多个进程并行处理，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        messages = invalid = 0
+        pending: Deque[asyncio.Future] = deque()
+        try:
+            with await loop.run_in_executor(
+                None, lambda: Path(path).open("r", encoding="utf-8")
+            ) as f:
+                eof = False
+                while True:
+                    # 保持每个进程都有待处理的批次，结果按读取顺序学习
+                    while not eof and len(pending) < max(workers, 1) * 2:
+                        if lines := await loop.run_in_executor(None, _read_lines, f):
+                            pending.append(loop.run_in_executor(executor, _tokenize, lines))
+                        else:
+                            eof = True
+                    if not pending:
+                        break
+                    batch_invalid, history, keyword_lists = await pending.popleft()
+                    invalid += batch_invalid
+                    messages += len(history)
+                    self.learn_batch(history, keyword_lists)
+                    if len(self.contexts) >= WRITE_BATCH_SIZE:
+                        await self._write()
+        finally:
+            for future in pending:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+        await self._write()
+        context_cache.clear()
+        keyword_index.clear()
+        cost = time.time() - start_time
+        log_info(
+            "群聊学习",
+            f"批量学习完成：共<m>{messages}</m>条消息，学习<m>{self.learned}</m>次，"
+            f"新增内容<m>{self.new_contexts}</m>条，回复<m>{self.new_answers}</m>条，"
+            f"跳过无法解析的<m>{invalid}</m>行，使用<m>{workers if executor else 0}</m>个分词进程，"
+            f"总耗时<m>{cost:.1f}s</m>，每分钟<m>{messages / max(cost, 1e-6) * 60:.0f}</m>条",
+        )
+        return {
+            "messages": messages,
+            "invalid": invalid,
+            "learned": self.learned,
+            "context": self.new_contexts,
+            "answer": self.new_answers,
+            "cost": cost,
+        }
+
+
+async def learn_history(path: Union[str, Path], workers: Optional[int] = None) -> dict:
+    """从OneBot事件格式的JSONL聊天记录中批量学习，workers为分词进程数，默认为CPU核数，0表示不使用子进程"""
+    return await BulkLearner().run(path, workers)
@@ -0,0 +1,150 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from tortoise.functions import Count
+
+from .models import ChatContext, ChatAnswer
+from .records import AnswerRecord, ContextRecord, load_answers, load_context
+from .sampler import AliasSampler
+from .config import config_manager
+
+chat_config = config_manager.config
+
+
+class ContextEntry:
+    """某个关键词对应的内容及其全部回复"""
+
+    __slots__ = ("context", "answers", "cross", "expire_time", "samplers")
+
+    def __init__(
+        self,
+        context: Optional[ContextRecord],
+        answers: List[AnswerRecord],
+        cross: Dict[str, int],
+        expire_time: float,
+    ):
+        self.context = context
+        """匹配的内容，为None时表示尚未学习"""
+        self.answers = answers
+        """该内容下所有群的回复"""
+        self.cross = cross
+        """回复关键词在多少个群(内容)中出现过"""
+        self.expire_time = expire_time
+        self.samplers: Dict[
+            Tuple[int, int, int], Optional[AliasSampler[Optional[AnswerRecord]]]
+        ] = {}
+        """(群id, 回复阈值, 跨群阈值) -> 已过滤屏蔽内容的回复选择器，None表示没有候选回复"""
+
+    def candidates(
+        self, group_id: int, count_threshold: int, cross_threshold: int
+    ) -> List[AnswerRecord]:
+        """本群的回复以及满足跨群条件的回复"""
+        return [
+            answer
+            for answer in self.answers
+            if answer.count >= count_threshold
+            and (
+                answer.group_id == group_id
+                or self.cross.get(answer.keywords, 0) >= cross_threshold
+            )
+        ]
+
+
+class ContextCache:
+    """回复路径上的内容和候选回复缓存，LRU淘汰并带有有效期"""
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, ContextEntry]" = OrderedDict()
+        self._answer_index: Dict[str, Set[str]] = {}
+        """回复关键词 -> 包含该回复的内容关键词"""
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def _load(self, keywords: str) -> ContextEntry:
+        expire_time = time.time() + chat_config.cache_ttl
+        # 以轻量记录缓存，避免大量模型对象占用内存
+        if not (
+            context := await load_context(ChatContext.filter(keywords=keywords).first())
+        ):
+            return ContextEntry(None, [], {}, expire_time)
+        cross: Dict[str, int] = {}
+        if answers := await load_answers(ChatAnswer.filter(context_id=context.id)):
+            cross = dict(
+                await ChatAnswer.filter(keywords__in=list({a.keywords for a in answers}))
+                .annotate(cross=Count("id"))
+                .group_by("keywords")
+                .values_list("keywords", "cross")
+            )
+        return ContextEntry(context, answers, cross, expire_time)
+
+    async def get(self, keywords: str) -> ContextEntry:
+        if (entry := self._entries.get(keywords)) and entry.expire_time > time.time():
+            self._entries.move_to_end(keywords)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        generation = self._generation
+        entry = await self._load(keywords)
+        if generation == self._generation and chat_config.cache_size > 0:
+            # 加载期间没有发生失效时才写入缓存
+            self._remove(keywords)
+            self._entries[keywords] = entry
+            for answer in entry.answers:
+                self._answer_index.setdefault(answer.keywords, set()).add(keywords)
+            while len(self._entries) > chat_config.cache_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def _remove(self, keywords: str) -> bool:
+        if not (entry := self._entries.pop(keywords, None)):
+            return False
+        for answer in entry.answers:
+            if (index := self._answer_index.get(answer.keywords)) is not None:
+                index.discard(keywords)
+                if not index:
+                    del self._answer_index[answer.keywords]
+        return True
+
+    def invalidate_context(self, keywords: str):
+        """内容或其回复发生变化"""
+        self._generation += 1
+        self.invalidations += self._remove(keywords)
+
+    def invalidate_answer(self, keywords: str):
+        """回复被新增、删除或禁用，影响所有包含该回复的内容"""
+        self._generation += 1
+        for context_keywords in list(self._answer_index.get(keywords, ())):
+            self.invalidations += self._remove(context_keywords)
+
+    def invalidate_group(self, group_id: int):
+        """群配置变化，只需丢弃该群的回复选择器"""
+        for entry in self._entries.values():
+            for key in [k for k in entry.samplers if k[0] == group_id]:
+                del entry.samplers[key]
+
+    def clear(self):
+        self._generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._answer_index.clear()
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": chat_config.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+context_cache = ContextCache()
@@ -1,5 +1,6 @@
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Optional, Set
 from pathlib import Path
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 from pydantic import BaseModel, Field
 
 from nonebot import get_driver, logger
@@ -8,6 +9,7 @@ from ruamel import yaml
 
 CONFIG_PATH = Path() / "data" / "learning_chat" / "learning_chat.yml"
 CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
+DEFAULT_DATABASE_URL = "sqlite://data/learning_chat/learning_chat.db"
 
 driver = get_driver()
 try:
@@ -34,12 +36,18 @@ class ChatGroupConfig(BaseModel):
     answer_threshold_weights: List[int] = Field(default=[10, 30, 60], alias="回复阈值权重")
     repeat_threshold: int = Field(default=3, alias="复读阈值")
     break_probability: float = Field(default=0.25, alias="打断复读概率")
+    fuzzy_match: bool = Field(default=False, alias="模糊匹配开关")
+    fuzzy_threshold: float = Field(default=0.5, alias="模糊匹配相似度")
     speak_enable: bool = Field(default=True, alias="主动发言开关")
     speak_threshold: int = Field(default=5, alias="主动发言阈值")
     speak_min_interval: int = Field(default=300, alias="主动发言最小间隔")
     speak_continuously_probability: float = Field(default=0.5, alias="连续主动发言概率")
     speak_continuously_max_len: int = Field(default=3, alias="最大连续主动发言句数")
     speak_poke_probability: float = Field(default=0.5, alias="主动发言附带戳一戳概率")
+    reply_rate_limit: int = Field(default=10, alias="每分钟最多回复次数")
+    learn_rate_limit: int = Field(default=60, alias="每分钟最多学习次数")
+    forget_days: int = Field(default=30, alias="回复遗忘周期")
+    forget_min_count: int = Field(default=1, alias="回复遗忘下限")
 
     def update(self, **kwargs):
         for key, value in kwargs.items():
@@ -62,6 +70,23 @@ class ChatConfig(BaseModel):
     cross_group_threshold: int = Field(default=3, alias="跨群回复阈值")
     learn_max_count: int = Field(default=6, alias="最高学习次数")
     dictionary: List[str] = Field(default_factory=list, alias="自定义词典")
+    speak_max_groups: int = Field(default=5, alias="每次主动发言最多群数")
+    forget_enable: bool = Field(default=False, alias="学习遗忘开关")
+    forget_days: int = Field(default=30, alias="内容遗忘周期")
+    forget_min_count: int = Field(default=1, alias="内容遗忘下限")
+    shed_latency: int = Field(default=500, alias="过载数据库延迟阈值")
+    shed_queue_depth: int = Field(default=100, alias="过载并发消息阈值")
+    shed_sample_rate: float = Field(default=0.1, alias="过载时学习比例")
+    cache_size: int = Field(default=5000, alias="回复缓存大小")
+    cache_ttl: int = Field(default=600, alias="回复缓存有效期")
+    message_partition_enable: bool = Field(default=False, alias="聊天记录按月分区")
+    message_retention_months: int = Field(default=0, alias="聊天记录保留月数")
+    database_url: str = Field(default=DEFAULT_DATABASE_URL, alias="数据库地址")
+    database_pool_size: int = Field(default=10, alias="数据库连接池大小")
+    sqlite_cache_size: int = Field(default=65536, alias="SQLite缓存大小(KB)")
+    sqlite_mmap_size: int = Field(default=256, alias="SQLite内存映射大小(MB)")
+    multi_worker: bool = Field(default=False, alias="多进程协同")
+    idf_enable: bool = Field(default=False, alias="语料IDF开关")
     group_config: Dict[int, ChatGroupConfig] = Field(default_factory=dict, alias="分群配置")
 
     def update(self, **kwargs):
@@ -70,25 +95,102 @@ class ChatConfig(BaseModel):
                 self.__setattr__(key, value)
 
 
+class ConfigDiff(NamedTuple):
+    fields: Set[str]
+    """发生变化的全局配置项"""
+    groups: Set[int]
+    """配置发生变化的群"""
+
+
 class ChatConfigManager:
     def __init__(self):
         self.file_path = CONFIG_PATH
+        self._mtime = 0
+        self.version = 0
+        """本进程保存配置的次数，用于通知其他进程"""
         if self.file_path.exists():
-            self.config = ChatConfig.parse_obj(
-                yaml.load(
-                    self.file_path.read_text(encoding="utf-8"), Loader=yaml.Loader
-                )
-            )
+            self.config = self._load()
         else:
             self.config = ChatConfig()
         self.save()
 
+    def _load(self) -> ChatConfig:
+        return ChatConfig.parse_obj(
+            yaml.load(self.file_path.read_text(encoding="utf-8"), Loader=yaml.Loader)
+        )
+
+    def _diff(self, old: ChatConfig, new: ChatConfig) -> ConfigDiff:
+        old_values = old.dict(exclude={"group_config"})
+        new_values = new.dict(exclude={"group_config"})
+        return ConfigDiff(
+            fields={k for k, v in new_values.items() if old_values.get(k) != v},
+            groups={
+                group_id
+                for group_id in set(old.group_config) | set(new.group_config)
+                if (c := old.group_config.get(group_id)) is None
+                or (n := new.group_config.get(group_id)) is None
+                or c.dict() != n.dict()
+            },
+        )
+
+    def update(self, **kwargs) -> ConfigDiff:
+        """修改全局配置并保存，返回发生变化的配置项"""
+        old = self.config.copy(deep=True)
+        self.config.update(**kwargs)
+        self.save()
+        return self._diff(old, self.config)
+
+    def update_groups(self, group_ids: List[int], **kwargs) -> ConfigDiff:
+        """修改多个群的配置并保存，返回配置发生变化的群"""
+        old = self.config.copy(deep=True)
+        for group_id in group_ids:
+            self.get_group_config(group_id).update(**kwargs)
+        self.save()
+        return self._diff(old, self.config)
+
+    def reload(self, force: bool = False) -> Optional[ConfigDiff]:
+        """配置文件被外部修改时重新读取，原地更新配置对象，未修改时返回None"""
+        try:
+            if not force and self.file_path.stat().st_mtime_ns == self._mtime:
+                return None
+            new = self._load()
+        except Exception as e:
+            self._mtime = self.file_path.stat().st_mtime_ns
+            logger.warning(f"群聊学习配置文件读取失败，将继续使用原配置: {e}")
+            return None
+        self._mtime = self.file_path.stat().st_mtime_ns
+        diff = self._diff(self.config, new)
+        # 其他模块持有config的引用，因此只能原地更新
+        for field in diff.fields:
+            setattr(self.config, field, getattr(new, field))
+        for group_id in diff.groups:
+            if group_id in new.group_config:
+                self.config.group_config[group_id] = new.group_config[group_id]
+            else:
+                self.config.group_config.pop(group_id, None)
+        return diff
+
     def get_group_config(self, group_id: int) -> ChatGroupConfig:
         if group_id not in self.config.group_config:
             self.config.group_config[group_id] = ChatGroupConfig()
             self.save()
         return self.config.group_config[group_id]
 
+    @property
+    def database_url(self) -> str:
+        """数据库连接地址，SQLite会附带连接参数，其他数据库会附带连接池大小"""
+        url = urlparse(self.config.database_url)
+        params = dict(parse_qsl(url.query))
+        if url.scheme == "sqlite":
+            params.setdefault("journal_mode", "WAL")
+            params.setdefault("synchronous", "NORMAL")
+            params.setdefault("cache_size", str(-self.config.sqlite_cache_size))
+            params.setdefault("mmap_size", str(self.config.sqlite_mmap_size * 1024 * 1024))
+        else:
+            params.setdefault("minsize", "1")
+            params.setdefault("maxsize", str(self.config.database_pool_size))
+        return urlunparse(url._replace(query=urlencode(params)))
+
     @property
     def config_list(self) -> List[str]:
         return list(self.config.dict(by_alias=True).keys())
@@ -102,6 +204,8 @@ class ChatConfigManager:
                 Dumper=yaml.RoundTripDumper,
                 allow_unicode=True,
             )
+        self._mtime = self.file_path.stat().st_mtime_ns
+        self.version += 1
 
 
 config_manager = ChatConfigManager()
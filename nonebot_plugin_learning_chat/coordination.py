@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Tuple
+
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import F, Q
+
+from .models import ChatLease
+from .config import config_manager, driver, log_info
+
+chat_config = config_manager.config
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+"""本进程的标识"""
+LEADER_LEASE = "scheduler"
+"""定时任务主进程的租约名称"""
+LEADER_TTL = 30
+"""主进程租约有效期，主进程每10秒续约一次"""
+LEARN_LOCK_TTL = 10
+"""学习锁的有效期，持有锁的进程异常退出时最多等待该时间"""
+RECENT_MESSAGES = 2000
+"""在内存中记录的最近处理过的消息数量，用于跳过重复收到的消息"""
+MESSAGE_CLAIM_TTL = 600
+"""消息处理权的有效期，在此期间其他进程收到同一条消息时跳过"""
+LEARN_PAUSE = "learn_pause"
+"""暂停所有进程学习写入的租约名称"""
+LEARN_PAUSE_TTL = 60
+"""暂停学习的最长时间，暂停的进程异常退出时其他进程最多等待该时间"""
+CONFIG_VERSION = "config_version"
+"""记录配置版本号的租约名称"""
+
+
+class Coordinator:
+    """多个进程共用同一个数据库时，通过数据库中的租约协调定时任务、学习和主动发言"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+        """每个锁正在持有或等待的数量，为0时删除该锁"""
+        self._recent: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self._paused = False
+        """本进程是否暂停了学习写入"""
+        self._config_version = 0
+        """已知的数据库中的配置版本号"""
+        self._published = config_manager.version
+        """已通知其他进程的本进程配置版本"""
+        self.leader = False
+
+    @property
+    def enabled(self) -> bool:
+        return chat_config.multi_worker
+
+    async def acquire(self, name: str, ttl: int) -> bool:
+        """获取或续约租约，租约已被其他进程持有且未到期时返回False"""
+        now = int(time.time())
+        if await ChatLease.filter(
+            Q(owner=WORKER_ID) | Q(expire_time__lt=now), name=name
+        ).update(owner=WORKER_ID, expire_time=now + ttl):
+            return True
+        try:
+            await ChatLease.create(name=name, owner=WORKER_ID, expire_time=now + ttl)
+        except IntegrityError:
+            return False
+        return True
+
+    async def release(self, name: str):
+        await ChatLease.filter(name=name, owner=WORKER_ID).update(expire_time=0)
+
+    async def is_leader(self) -> bool:
+        """本进程是否负责执行定时任务，每次调用时续约，未开启多进程协同时总是True"""
+        if not self.enabled:
+            return True
+        leader = await self.acquire(LEADER_LEASE, LEADER_TTL)
+        if leader != self.leader:
+            log_info(
+                "群聊学习",
+                f"进程<m>{WORKER_ID}</m>{'成为定时任务主进程' if leader else '不再是定时任务主进程'}",
+            )
+        self.leader = leader
+        return leader
+
+    async def claim(self, name: str, ttl: int) -> bool:
+        """获取某项操作的处理权，未开启多进程协同时总是True"""
+        return not self.enabled or await self.acquire(name, ttl)
+
+    async def claim_message(self, group_id: int, message_id: int) -> bool:
+        """同一条消息被多个bot连接或多个进程收到时只处理一次
+
+        本进程内重复收到的消息在内存中识别，开启多进程协同时再通过数据库中的租约认领
+        """
+        key = (group_id, message_id)
+        if key in self._recent:
+            return False
+        self._recent[key] = None
+        if len(self._recent) > RECENT_MESSAGES:
+            self._recent.popitem(last=False)
+        return await self.claim(f"message:{group_id}:{message_id}", MESSAGE_CLAIM_TTL)
+
+    @asynccontextmanager
+    async def learn_lock(self, keywords: str) -> AsyncIterator[bool]:
+        """同一个内容的学习写入依次进行，开启多进程协同时还会在数据库中加锁
+
+        内容不区分群，因此按内容的关键词加锁。返回是否获得了锁，
+        数据库中的锁等待超时时为False，此时调用方应放弃写入。学习暂停期间等待暂停结束
+        """
+        while self._paused:
+            await asyncio.sleep(0.05)
+        self._lock_users[keywords] = self._lock_users.get(keywords, 0) + 1
+        try:
+            async with self._locks.setdefault(keywords, asyncio.Lock()):
+                if not self.enabled:
+                    yield True
+                    return
+                # 关键词可能很长，租约名称使用其摘要
+                name = f"learn:{hashlib.md5(keywords.encode()).hexdigest()}"
+                deadline = time.monotonic() + LEARN_LOCK_TTL
+                while True:
+                    # 先加锁再检查暂停，暂停的进程会等待已加的锁释放
+                    if await self.acquire(name, LEARN_LOCK_TTL):
+                        if not await self._paused_elsewhere():
+                            break
+                        await self.release(name)
+                    if time.monotonic() > deadline:
+                        yield False
+                        return
+                    await asyncio.sleep(0.05)
+                try:
+                    yield True
+                finally:
+                    await self.release(name)
+        finally:
+            self._lock_users[keywords] -= 1
+            if not self._lock_users[keywords]:
+                del self._lock_users[keywords]
+                del self._locks[keywords]
+
+    async def _paused_elsewhere(self) -> bool:
+        return await (
+            ChatLease.filter(name=LEARN_PAUSE, expire_time__gte=int(time.time()))
+            .exclude(owner=WORKER_ID)
+            .exists()
+        )
+
+    @asynccontextmanager
+    async def pause_learning(self) -> AsyncIterator[None]:
+        """暂停所有进程的学习写入，等待进行中的写入完成后进入，用于切换关键词的提取方式
+
+        暂停期间本进程不能再使用learn_lock
+        """
+        self._paused = True
+        try:
+            while self._lock_users:
+                await asyncio.sleep(0.05)
+            if self.enabled:
+                await self.acquire(LEARN_PAUSE, LEARN_PAUSE_TTL)
+                # 持有锁的进程异常退出时最多等待锁的有效期
+                deadline = time.monotonic() + LEARN_LOCK_TTL
+                while (
+                    time.monotonic() < deadline
+                    and await ChatLease.filter(
+                        name__startswith="learn:", expire_time__gte=int(time.time())
+                    )
+                    .exclude(owner=WORKER_ID)
+                    .exists()
+                ):
+                    await asyncio.sleep(0.05)
+            yield
+        finally:
+            if self.enabled:
+                await self.release(LEARN_PAUSE)
+            self._paused = False
+
+    async def sync_config(self) -> bool:
+        """通知其他进程本进程修改了配置，返回其他进程是否修改了配置"""
+        if not self.enabled:
+            return False
+        published = config_manager.version != self._published
+        if published:
+            self._published = config_manager.version
+            if not await ChatLease.filter(name=CONFIG_VERSION).update(
+                version=F("version") + 1
+            ):
+                try:
+                    await ChatLease.create(
+                        name=CONFIG_VERSION, owner=WORKER_ID, expire_time=0, version=1
+                    )
+                except IntegrityError:
+                    await ChatLease.filter(name=CONFIG_VERSION).update(
+                        version=F("version") + 1
+                    )
+        version = (
+            await ChatLease.filter(name=CONFIG_VERSION)
+            .first()
+            .values_list("version", flat=True)
+        ) or 0
+        # 版本号只增加了本进程的修改时，无需重新加载
+        changed = bool(self._config_version) and version > self._config_version + (
+            1 if published else 0
+        )
+        self._config_version = version
+        return changed
+
+    async def cleanup(self) -> int:
+        """删除已过期的租约，返回删除的数量"""
+        return await ChatLease.filter(
+            expire_time__lt=int(time.time()) - LEADER_TTL
+        ).exclude(name=CONFIG_VERSION).delete()
+
+
+coordinator = Coordinator()
+
+
+@driver.on_shutdown
+async def release_leadership():
+    if coordinator.enabled and coordinator.leader:
+        await coordinator.release(LEADER_LEASE)
@@ -0,0 +1,276 @@
+import asyncio
+import gzip
+import itertools
+import time
+import zlib
+from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, TextIO, Tuple, Union
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+from tortoise.transactions import in_transaction
+
+from .models import ChatContext, ChatAnswer, ChatBlackList
+from .cache import context_cache
+from .keyword_index import keyword_index
+from .config import config_manager, log_info
+
+DATA_PATH = Path() / "data" / "learning_chat"
+EXPORT_PATH = DATA_PATH / "export"
+EXPORT_VERSION = 1
+BATCH_SIZE = 500
+"""每批导出或导入的内容数量"""
+
+chat_config = config_manager.config
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+async def export_corpus() -> AsyncIterator[str]:
+    """按行流式导出已学习的内容、回复和禁用列表，每批只读取固定数量的数据"""
+    yield _dumps({"type": "meta", "version": EXPORT_VERSION, "time": int(time.time())})
+    last_id = 0
+    while contexts := (
+        await ChatContext.filter(id__gt=last_id)
+        .order_by("id")
+        .limit(BATCH_SIZE)
+        .values("id", "keywords", "time", "count")
+    ):
+        last_id = contexts[-1]["id"]
+        answers: Dict[int, List[dict]] = {}
+        for answer in await ChatAnswer.filter(
+            context_id__in=[c["id"] for c in contexts]
+        ).values("context_id", "keywords", "group_id", "count", "time", "messages"):
+            answers.setdefault(answer.pop("context_id"), []).append(answer)
+        for context in contexts:
+            context_id = context.pop("id")
+            yield _dumps(
+                {"type": "context", **context, "answers": answers.get(context_id, [])}
+            )
+    last_id = 0
+    while bans := (
+        await ChatBlackList.filter(id__gt=last_id)
+        .order_by("id")
+        .limit(BATCH_SIZE)
+        .values("id", "keywords", "global_ban", "ban_group_id")
+    ):
+        last_id = bans[-1]["id"]
+        for ban in bans:
+            ban.pop("id")
+            yield _dumps({"type": "blacklist", **ban})
+
+
+async def export_corpus_bytes(compress: bool = False) -> AsyncIterator[bytes]:
+    """导出为字节流，可选gzip压缩"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    async for line in export_corpus():
+        data = line.encode("utf-8")
+        if compressor is None:
+            yield data
+        elif chunk := compressor.compress(data):
+            yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _open_export(compress: bool) -> Tuple[Path, TextIO]:
+    EXPORT_PATH.mkdir(parents=True, exist_ok=True)
+    path = EXPORT_PATH / time.strftime(
+        f"learning_chat_%Y%m%d_%H%M%S.jsonl{'.gz' if compress else ''}"
+    )
+    return path, (gzip.open if compress else open)(path, "wt", encoding="utf-8")
+
+
+async def export_to_file(compress: bool = True) -> Path:
+    """导出至数据目录下的文件，返回文件路径"""
+    # 文件读写和压缩在线程中进行，不阻塞事件循环
+    loop = asyncio.get_running_loop()
+    path, f = await loop.run_in_executor(None, _open_export, compress)
+    try:
+        lines: List[str] = []
+        async for line in export_corpus():
+            lines.append(line)
+            if len(lines) >= BATCH_SIZE:
+                await loop.run_in_executor(None, f.writelines, lines)
+                lines = []
+        await loop.run_in_executor(None, f.writelines, lines)
+    finally:
+        await loop.run_in_executor(None, f.close)
+    log_info("群聊学习", f"已导出学习数据至<m>{path}</m>")
+    return path
+
+
+def resolve_import_path(path: str) -> Optional[Path]:
+    """后台导入的文件只能位于数据目录下，可以是相对数据目录的路径，不存在或不在数据目录下时返回None"""
+    root = DATA_PATH.resolve()
+    for candidate in (Path(path), root / path):
+        file = candidate.resolve()
+        if root in file.parents and file.is_file():
+            return file
+    return None
+
+
+def _open_import(path: Path) -> TextIO:
+    with path.open("rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return (gzip.open if compressed else open)(path, "rt", encoding="utf-8")
+
+
+def _read_lines(f: TextIO) -> List[str]:
+    return list(itertools.islice(f, BATCH_SIZE))
+
+
+async def read_corpus_file(path: Union[str, Path]) -> AsyncIterator[str]:
+    """逐行读取导出文件，根据文件头自动识别gzip压缩"""
+    # 文件读取和解压在线程中分批进行，不阻塞事件循环
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, _open_import, Path(path))
+    try:
+        while lines := await loop.run_in_executor(None, _read_lines, f):
+            for line in lines:
+                yield line
+    finally:
+        await loop.run_in_executor(None, f.close)
+
+
+def _merge_count(left: int, right: int) -> int:
+    return min(left + right, chat_config.learn_max_count)
+
+
+async def merge_contexts(contexts: List[dict]) -> Tuple[int, int]:
+    """在一个事务中合并一批内容及其回复，返回(新增内容数, 新增回复数)"""
+    merged: Dict[str, dict] = {}
+    for context in contexts:
+        if exist := merged.get(context["keywords"]):
+            exist["count"] = _merge_count(exist["count"], context["count"])
+            exist["time"] = max(exist["time"], context["time"])
+            exist["answers"].extend(context["answers"])
+        else:
+            merged[context["keywords"]] = context
+    async with in_transaction("learning_chat"):
+        exists: Dict[str, ChatContext] = {}
+        for context in await ChatContext.filter(keywords__in=list(merged)).order_by("id"):
+            exists.setdefault(context.keywords, context)
+        for context in exists.values():
+            data = merged[context.keywords]
+            context.count = _merge_count(context.count, data["count"])
+            context.time = max(context.time, data["time"])
+        if exists:
+            await ChatContext.bulk_update(list(exists.values()), fields=["count", "time"])
+        new_contexts = [
+            ChatContext(keywords=k, time=c["time"], count=c["count"])
+            for k, c in merged.items()
+            if k not in exists
+        ]
+        if new_contexts:
+            await ChatContext.bulk_create(new_contexts)
+            for context in await ChatContext.filter(
+                keywords__in=[c.keywords for c in new_contexts]
+            ).order_by("id"):
+                exists.setdefault(context.keywords, context)
+
+        answers: Dict[Tuple[int, str, int], ChatAnswer] = {}
+        for answer in await ChatAnswer.filter(
+            context_id__in=[c.id for c in exists.values()]
+        ):
+            answers.setdefault(
+                (answer.context_id, answer.keywords, answer.group_id), answer  # type: ignore
+            )
+        updated, created = {}, {}
+        for keywords, data in merged.items():
+            context_id = exists[keywords].id
+            for a in data["answers"]:
+                key = (context_id, a["keywords"], a["group_id"])
+                if answer := answers.get(key):
+                    answer.count = _merge_count(answer.count, a["count"])
+                    answer.time = max(answer.time, a["time"])
+                    answer.messages.extend(
+                        m for m in a["messages"] if m not in answer.messages
+                    )
+                    if key not in created:
+                        updated[key] = answer
+                else:
+                    answers[key] = created[key] = ChatAnswer(
+                        keywords=a["keywords"],
+                        group_id=a["group_id"],
+                        count=a["count"],
+                        time=a["time"],
+                        messages=list(a["messages"]),
+                        context_id=context_id,
+                    )
+        if updated:
+            await ChatAnswer.bulk_update(
+                list(updated.values()), fields=["count", "time", "messages"]
+            )
+        if created:
+            await ChatAnswer.bulk_create(list(created.values()))
+    return len(new_contexts), len(created)
+
+
+async def merge_blacklist(bans: List[dict]) -> int:
+    """在一个事务中合并一批禁用词，返回新增的数量"""
+    async with in_transaction("learning_chat"):
+        exists = {
+            b.keywords: b
+            for b in await ChatBlackList.filter(keywords__in=[b["keywords"] for b in bans])
+        }
+        created: Dict[str, ChatBlackList] = {}
+        for ban in bans:
+            if exist := exists.get(ban["keywords"]) or created.get(ban["keywords"]):
+                exist.global_ban = exist.global_ban or ban["global_ban"]
+                exist.ban_group_id.extend(
+                    g for g in ban["ban_group_id"] if g not in exist.ban_group_id
+                )
+            else:
+                created[ban["keywords"]] = ChatBlackList(
+                    keywords=ban["keywords"],
+                    global_ban=ban["global_ban"],
+                    ban_group_id=list(ban["ban_group_id"]),
+                )
+        if exists:
+            await ChatBlackList.bulk_update(
+                list(exists.values()), fields=["global_ban", "ban_group_id"]
+            )
+        if created:
+            await ChatBlackList.bulk_create(list(created.values()))
+    return len(created)
+
+
+async def import_corpus(lines: AsyncIterable[str]) -> Dict[str, int]:
+    """分批合并导入的数据，已有的内容和回复会累加次数并合并消息"""
+    result = {"context": 0, "answer": 0, "blacklist": 0}
+    contexts: List[dict] = []
+    bans: List[dict] = []
+    async for line in lines:
+        if not (line := line.strip()):
+            continue
+        data = json.loads(line)
+        if data["type"] == "context":
+            contexts.append(data)
+        elif data["type"] == "blacklist":
+            bans.append(data)
+        if len(contexts) >= BATCH_SIZE:
+            new_contexts, new_answers = await merge_contexts(contexts)
+            result["context"] += new_contexts
+            result["answer"] += new_answers
+            contexts = []
+        if len(bans) >= BATCH_SIZE:
+            result["blacklist"] += await merge_blacklist(bans)
+            bans = []
+    if contexts:
+        new_contexts, new_answers = await merge_contexts(contexts)
+        result["context"] += new_contexts
+        result["answer"] += new_answers
+    if bans:
+        result["blacklist"] += await merge_blacklist(bans)
+    context_cache.clear()
+    keyword_index.clear()
+    log_info(
+        "群聊学习",
+        f"导入学习数据完成，新增内容<m>{result['context']}</m>条，回复<m>{result['answer']}</m>条，禁用词<m>{result['blacklist']}</m>条",
+    )
+    return result
@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Dict, Type, Union
+
+from tortoise.expressions import F
+from tortoise.queryset import QuerySet
+
+from .models import ChatContext, ChatAnswer
+from .jobs import batched_delete, BATCH_SIZE, BATCH_INTERVAL
+from .cache import context_cache
+from .keyword_index import keyword_index
+from .config import config_manager, ChatConfig, ChatGroupConfig, log_info
+
+chat_config = config_manager.config
+
+
+async def _decay(query: QuerySet, days: int) -> int:
+    """将超过一个遗忘周期未学习的数据次数减1，并将其时间后移一个周期，返回衰减的数量"""
+    period = days * 86400
+    # 次数不会减到0以下，回复时按次数计算概率
+    query = query.filter(time__lt=int(time.time()) - period, count__gt=1)
+    decayed = last_id = 0
+    while ids := (
+        await query.filter(id__gt=last_id)
+        .order_by("id")
+        .limit(BATCH_SIZE)
+        .values_list("id", flat=True)
+    ):
+        last_id = ids[-1]
+        await query.model.filter(id__in=ids).update(
+            count=F("count") - 1, time=F("time") + period
+        )
+        decayed += len(ids)
+        await asyncio.sleep(BATCH_INTERVAL)
+    return decayed
+
+
+async def _forget(
+    model: Type[Union[ChatContext, ChatAnswer]],
+    filters: dict,
+    config: Union[ChatConfig, ChatGroupConfig],
+) -> Dict[str, int]:
+    if config.forget_days <= 0:
+        return {"decayed": 0, "evicted": 0}
+    min_count = max(config.forget_min_count, 1)
+    # 超过一个周期未学习且衰减后会低于下限的数据直接删除，剩下的衰减后次数仍不低于下限，
+    # 最近学习的数据即使次数低于下限也保留，等待继续学习
+    evicted = await batched_delete(
+        model.filter(
+            count__lte=min_count,
+            time__lt=int(time.time()) - config.forget_days * 86400,
+            **filters,
+        )
+    )
+    decayed = await _decay(model.filter(**filters), config.forget_days)
+    return {"decayed": decayed, "evicted": evicted}
+
+
+async def forget_learned() -> Dict[str, int]:
+    """按遗忘周期衰减长时间未学习的内容和回复，并删除次数低于遗忘下限的数据"""
+    result = {"context": 0, "answer": 0, "decayed": 0}
+    if not chat_config.forget_enable:
+        return result
+    start_time = time.time()
+    groups = list(chat_config.group_config)
+    for group_id, config in list(chat_config.group_config.items()):
+        answers = await _forget(ChatAnswer, {"group_id": group_id}, config)
+        result["answer"] += answers["evicted"]
+        result["decayed"] += answers["decayed"]
+    # 没有分群配置的群使用默认配置
+    answers = await _forget(ChatAnswer, {"group_id__not_in": groups}, ChatGroupConfig())
+    result["answer"] += answers["evicted"]
+    result["decayed"] += answers["decayed"]
+    contexts = await _forget(ChatContext, {}, chat_config)
+    result["context"] += contexts["evicted"]
+    result["decayed"] += contexts["decayed"]
+    if any(result.values()):
+        context_cache.clear()
+        keyword_index.clear()
+    log_info(
+        "群聊学习",
+        f"学习遗忘完成：衰减<m>{result['decayed']}</m>条，删除内容<m>{result['context']}</m>条，"
+        f"回复<m>{result['answer']}</m>条，耗时<m>{time.time() - start_time:.1f}s</m>",
+    )
+    return result
@@ -0,0 +1,286 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from tortoise.functions import Count
+
+from .models import ChatMessage, ChatContext, ChatAnswer
+from .cache import ContextEntry
+from .records import AnswerRecord, load_answers, load_context
+from .handler import (
+    answer_thresholds,
+    answer_weights,
+    check_allow,
+    clean_message,
+    filter_answers,
+    is_allowed_message,
+    is_banned,
+)
+from .keyword_index import keyword_index
+from .limiter import rate_limiter
+from .repeat import repeat_detector
+from .config import ChatGroupConfig, config_manager, COMMAND_START, NICKNAME
+
+chat_config = config_manager.config
+
+
+class StepTimer:
+    """记录每次数据库查询和分词的耗时"""
+
+    def __init__(self):
+        self.timings: List[dict] = []
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append(
+                {"step": name, "ms": round((time.perf_counter() - start_time) * 1000, 2)}
+            )
+
+
+async def _timed_is_banned(timer: StepTimer, keywords: str, group_id: int) -> bool:
+    with timer.step("查询禁用列表(消息)"):
+        return await is_banned(keywords, group_id)
+
+
+async def _load_context(
+    timer: StepTimer, keywords: str
+) -> Optional[ContextEntry]:
+    """与ContextCache._load相同的查询，但不经过缓存，分别计时"""
+    with timer.step("查询内容"):
+        context = await load_context(ChatContext.filter(keywords=keywords).first())
+    if not context:
+        return None
+    with timer.step("查询回复"):
+        answers = await load_answers(ChatAnswer.filter(context_id=context.id))
+    cross: Dict[str, int] = {}
+    if answers:
+        with timer.step("查询跨群次数"):
+            cross = dict(
+                await ChatAnswer.filter(keywords__in=list({a.keywords for a in answers}))
+                .annotate(cross=Count("id"))
+                .group_by("keywords")
+                .values_list("keywords", "cross")
+            )
+    return ContextEntry(context, answers, cross, 0)
+
+
+async def explain(
+    group_id: int, message: str, user_id: int = 0, to_me: bool = False
+) -> dict:
+    """以只读方式模拟一条消息的回复判断，不写入数据库、不发送消息、不消耗回复次数"""
+    timer = StepTimer()
+    config = chat_config.group_config.get(group_id) or ChatGroupConfig()
+    data = ChatMessage(
+        group_id=group_id,
+        user_id=user_id,
+        message_id=0,
+        message=clean_message(message),
+        raw_message=message,
+        plain_text=message,
+        time=int(time.time()),
+    )
+    to_me = to_me or NICKNAME in data.message
+    with timer.step("分词"):
+        keyword_list, keywords = data.keyword_list, data.keywords
+    ban_words = set(chat_config.ban_words + config.ban_words)
+    ban_users = set(chat_config.ban_users + config.ban_users)
+    result = {
+        "group_id": group_id,
+        "message": data.message,
+        "keywords": keywords,
+        "keyword_list": keyword_list,
+        "to_me": to_me,
+        "config": {
+            "answer_threshold": config.answer_threshold,
+            "answer_threshold_weights": config.answer_threshold_weights,
+            "cross_group_threshold": chat_config.cross_group_threshold,
+            "repeat_threshold": config.repeat_threshold,
+            "break_probability": config.break_probability,
+            "fuzzy_match": config.fuzzy_match,
+            "fuzzy_threshold": config.fuzzy_threshold,
+            "reply_rate_limit": config.reply_rate_limit,
+        },
+        "checks": [],
+        "decision": "",
+        "context": None,
+        "thresholds": [],
+        "candidates": [],
+        "timings": timer.timings,
+    }
+    checks: List[dict] = result["checks"]
+
+    def check(name: str, passed: bool, detail: str = "") -> bool:
+        checks.append({"check": name, "passed": passed, "detail": detail})
+        return passed
+
+    def finish(decision: str) -> dict:
+        result["decision"] = decision
+        result["total_ms"] = round(sum(t["ms"] for t in timer.timings), 2)
+        return result
+
+    if not (
+        check("群聊学习开关", chat_config.total_enable and config.enable)
+        and check(
+            "命令前缀",
+            not (COMMAND_START and data.message.startswith(tuple(COMMAND_START))),
+        )
+        and check("屏蔽用户", user_id not in ban_users, str(user_id))
+        and check("消息内容", is_allowed_message(data.message, ban_words), "屏蔽词或不支持的消息类型")
+        and check("禁用列表", not await _timed_is_banned(timer, keywords, group_id), keywords)
+    ):
+        return finish("跳过")
+
+    if repeat_detector.is_repeat(group_id, data.message, data.time):
+        state = repeat_detector.get(group_id)
+        count, users = state.count + 1, state.users | {user_id}
+        repeat = (
+            check("bot未参与本轮复读", not state.bot_joined)
+            and check(
+                "复读次数", count >= config.repeat_threshold, f"{count}/{config.repeat_threshold}"
+            )
+            and check("复读人数", len(users) > 1, str(len(users)))
+            and check(
+                "回复频率",
+                rate_limiter.peek(group_id, "reply", config.reply_rate_limit),
+            )
+        )
+        return finish(
+            f"复读(打断概率{config.break_probability:.0%})" if repeat else "复读中，不回复"
+        )
+
+    if not check("消息长度", not data.is_plain_text or len(data.text) > 1):
+        return finish("消息过短，不回复")
+
+    entry = await _load_context(timer, keywords)
+    fuzzy_score = None
+    if not entry and config.fuzzy_match:
+        with timer.step("模糊匹配"):
+            matches = await keyword_index.search(keyword_list, config.fuzzy_threshold)
+        for match_keywords, score in matches:
+            if entry := await _load_context(timer, match_keywords):
+                fuzzy_score = round(score, 3)
+                break
+    if not check("已学习的内容", entry is not None):
+        return finish("尚未学习，不回复")
+    result["context"] = {
+        "id": entry.context.id,
+        "keywords": entry.context.keywords,
+        "count": entry.context.count,
+        "fuzzy_score": fuzzy_score,
+    }
+
+    # 与LearningChat使用相同的阈值、候选回复筛选和概率计算
+    thresholds, cross_threshold = answer_thresholds(config, keyword_list, to_me)
+    total_weight = sum(w for _, w in thresholds) or 1
+
+    allowed: Dict[int, bool] = {}
+
+    async def allow(answer: AnswerRecord) -> bool:
+        if answer.id not in allowed:
+            with timer.step(f"查询禁用列表(回复{answer.id})"):
+                allowed[answer.id] = await check_allow(answer, ban_words)
+        return allowed[answer.id]
+
+    min_threshold = min(t for t, _ in thresholds)
+    eligible = {a.id for a in entry.candidates(group_id, min_threshold, cross_threshold)}
+    rejected: Dict[int, List[str]] = {a.id: [] for a in entry.answers}
+    for answer in entry.answers:
+        if answer.id not in eligible:
+            if answer.group_id != group_id and (
+                cross := entry.cross.get(answer.keywords, 0)
+            ) < cross_threshold:
+                rejected[answer.id].append(f"其他群的回复，仅{cross}个群学过，跨群阈值为{cross_threshold}")
+            if answer.count < min_threshold:
+                rejected[answer.id].append(f"学习次数{answer.count}低于回复阈值{min_threshold}")
+        if not await allow(answer):
+            rejected[answer.id].append("含有屏蔽词、不支持的消息类型或已被禁用")
+
+    weights: Dict[int, Dict[int, float]] = {a.id: {} for a in entry.answers}
+    reply_probability = 0.0
+    for threshold, weight in thresholds:
+        candidates = await filter_answers(
+            entry, group_id, threshold, cross_threshold, allow
+        )
+        per_list = answer_weights(candidates)
+        for answer, p in zip(candidates, per_list):
+            weights[answer.id][threshold] = round(p, 4)
+        result["thresholds"].append(
+            {
+                "threshold": threshold,
+                "chance": round(weight / total_weight, 4),
+                "candidates": len(candidates),
+                "no_reply": round(1 - sum(per_list), 4),
+            }
+        )
+        reply_probability += weight / total_weight * sum(per_list)
+
+    result["candidates"] = [
+        {
+            "id": answer.id,
+            "keywords": answer.keywords,
+            "group_id": answer.group_id,
+            "count": answer.count,
+            "cross": entry.cross.get(answer.keywords, 0),
+            "messages": answer.messages[:5],
+            "weights": weights[answer.id],
+            "rejected": rejected[answer.id],
+        }
+        for answer in sorted(entry.answers, key=lambda a: a.count, reverse=True)
+    ]
+    result["reply_probability"] = round(reply_probability, 4)
+    if not check(
+        "回复频率", rate_limiter.peek(group_id, "reply", config.reply_rate_limit)
+    ):
+        return finish("回复过于频繁，不回复")
+    if reply_probability <= 0:
+        return finish("没有符合条件的候选回复，不回复")
+    return finish(f"以{reply_probability:.1%}的概率回复")
+
+
+def format_explain(result: dict) -> str:
+    """将判断过程整理为适合在群里发送的文本"""
+    lines = [
+        f"消息：{result['message']}",
+        f"关键词：{result['keywords']}",
+        f"结论：{result['decision']}",
+    ]
+    if failed := [c for c in result["checks"] if not c["passed"]]:
+        lines.append(
+            "未通过："
+            + "，".join(
+                c["check"] + (f"({c['detail']})" if c["detail"] else "") for c in failed
+            )
+        )
+    if context := result["context"]:
+        lines.append(
+            f"匹配内容：{context['keywords']}(学习{context['count']}次"
+            + (f"，相似度{context['fuzzy_score']}" if context["fuzzy_score"] else "")
+            + ")"
+        )
+    if result["thresholds"]:
+        lines.append(
+            "回复阈值："
+            + "，".join(
+                f"{t['threshold']}({t['chance']:.0%}，{t['candidates']}个候选)"
+                for t in result["thresholds"]
+            )
+        )
+    for candidate in result["candidates"][:5]:
+        lines.append(
+            f"· {(candidate['messages'] or [candidate['keywords']])[0]} ×{candidate['count']}"
+            + (
+                f"，{'；'.join(candidate['rejected'])}"
+                if candidate["rejected"]
+                else f"，权重{max(candidate['weights'].values(), default=0):.3f}"
+            )
+        )
+    lines.append(
+        f"耗时：{result['total_ms']}ms("
+        + "，".join(f"{t['step']}{t['ms']}ms" for t in result["timings"])
+        + ")"
+    )
+    return "\n".join(lines)
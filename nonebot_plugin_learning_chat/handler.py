@@ -3,19 +3,51 @@ import datetime
 import random
 import re
 import time
-from functools import cmp_to_key
 
 try:
     import jieba_fast.analyse as jieba_analyse
 except ImportError:
     import jieba.analyse as jieba_analyse
-from typing import List, Union, Optional, Tuple
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Sequence,
+    Set,
+    Union,
+    Optional,
+    Tuple,
+)
 from enum import IntEnum, auto
 from nonebot import get_adapter
 from nonebot.adapters.onebot.v11 import GroupMessageEvent, MessageSegment, ActionFailed, Adapter
-from tortoise.functions import Count
 from .models import ChatBlackList, ChatContext, ChatAnswer, ChatMessage
+from .cache import context_cache, ContextEntry
+from .records import (
+    AnswerRecord,
+    ContextRecord,
+    MessageRecord,
+    load_answers,
+    load_contexts,
+    load_messages,
+)
+from .sampler import AliasSampler
+from .repeat import repeat_detector
+from .journal import reply_journal
+from .reply_target import ReplyTarget, reply_targets
+from .text_store import save_messages
+from .stats import stat_counter
+from .coordination import coordinator
+from .idf import corpus_idf
+from .activity import activity_tracker, MIN_MESSAGES
+from .keyword_index import keyword_index
+from .limiter import rate_limiter, load_shedder
+from .tokenizer import warm_up_done
 from .config import (
+    ChatGroupConfig,
     config_manager,
     SUPERUSERS,
     NICKNAME,
@@ -46,6 +78,96 @@ ALL_WORDS = (
 )
 
 
+def clean_message(raw_message: str, is_reply: bool = False) -> str:
+    """去除消息中的艾特、回复和图片链接，作为学习用的消息"""
+    return re.sub(
+        r"(\[CQ:at,qq=.+])|(\[CQ:reply,id=.+])" if is_reply else r"(\[CQ:at,qq=.+])",
+        "",
+        re.sub(r"(,subType=\d+,url=.+])", r"]", raw_message),
+    ).strip()
+
+
+def is_allowed_message(raw_message: str, ban_words: Iterable[str]) -> bool:
+    """检查消息是否可以学习和回复，不包括禁用列表的检查"""
+    # if len(raw_message) < 2:
+    #     return False
+    if any(
+        i in raw_message
+        for i in {
+            "[CQ:xml",
+            "[CQ:json",
+            "[CQ:at",
+            "[CQ:video",
+            "[CQ:record",
+            "[CQ:share",
+        }
+    ):
+        return False
+    if any(i in raw_message for i in ban_words):
+        return False
+    if raw_message.startswith("&#91;") and raw_message.endswith("&#93;"):
+        return False
+    return True
+
+
+async def is_banned(keywords: str, group_id: int) -> bool:
+    """关键词是否在禁用列表中，全局禁用或在本群禁用"""
+    if ban_word := await ChatBlackList.filter(keywords=keywords).first():
+        return ban_word.global_ban or group_id in ban_word.ban_group_id
+    return False
+
+
+async def check_allow(
+    message: Union[ChatMessage, MessageRecord, AnswerRecord, ReplyTarget],
+    ban_words: Iterable[str],
+) -> bool:
+    """检查消息或回复是否可以学习和回复，包括禁用列表的检查"""
+    raw_message = (
+        message.messages[0] if isinstance(message, AnswerRecord) else message.message
+    )
+    if not is_allowed_message(raw_message, ban_words):
+        return False
+    return not await is_banned(message.keywords, message.group_id)
+
+
+def answer_thresholds(
+    config: ChatGroupConfig, keyword_list: List[str], to_me: bool
+) -> Tuple[List[Tuple[int, int]], int]:
+    """回复阈值的可选值及其权重，以及跨群阈值，对bot说的话阈值都为1"""
+    if to_me:
+        return [(1, 1)], 1
+    choices = range(
+        config.answer_threshold - len(config.answer_threshold_weights) + 1,
+        config.answer_threshold + 1,
+    )
+    adjust = 1 if len(keyword_list) == chat_config.KEYWORDS_SIZE else 0
+    return (
+        [(t - adjust, w) for t, w in zip(choices, config.answer_threshold_weights)],
+        chat_config.cross_group_threshold,
+    )
+
+
+async def filter_answers(
+    entry: ContextEntry,
+    group_id: int,
+    count_threshold: int,
+    cross_threshold: int,
+    allow: Callable[[AnswerRecord], Awaitable[bool]],
+) -> List[AnswerRecord]:
+    """本群该阈值下的候选回复：本群的回复以及满足跨群条件的回复，并检查是否在屏蔽列表中"""
+    return [
+        answer
+        for answer in entry.candidates(group_id, count_threshold, cross_threshold)
+        if await allow(answer)
+    ]
+
+
+def answer_weights(answers: Sequence[AnswerRecord]) -> List[float]:
+    """每个候选回复被选中的概率，剩余的概率为不回复"""
+    sum_count = sum(answer.count for answer in answers)
+    return [answer.count / sum_count * (1 - 1 / answer.count) for answer in answers]
+
+
 class Result(IntEnum):
     Learn = auto()
     Pass = auto()
@@ -53,46 +175,42 @@ class Result(IntEnum):
     Ban = auto()
     SetEnable = auto()
     SetDisable = auto()
+    SkipLearn = auto()
+
+
+class Speech(NamedTuple):
+    group_id: int
+    """发言的群"""
+    messages: List[Union[str, MessageSegment]]
+    """发言内容"""
+    answer_ids: List[Optional[int]]
+    """每条发言来源的回复id"""
 
 
 class LearningChat:
     def __init__(self, event: GroupMessageEvent):
-        if event.reply:
-            self.reply = event.reply
-            self.data = ChatMessage(
-                group_id=event.group_id,
-                user_id=event.user_id,
-                message_id=event.message_id,
-                message=re.sub(
-                    r"(\[CQ:at,qq=.+])|(\[CQ:reply,id=.+])",
-                    "",
-                    re.sub(r"(,subType=\d+,url=.+])", r"]", event.raw_message),
-                ).strip(),
-                raw_message=event.raw_message,
-                plain_text=event.get_plaintext(),
-                time=event.time,
-            )
-        else:
-            self.data = ChatMessage(
-                group_id=event.group_id,
-                user_id=event.user_id,
-                message_id=event.message_id,
-                message=re.sub(
-                    r"(\[CQ:at,qq=.+])",
-                    "",
-                    re.sub(r"(,subType=\d+,url=.+])", r"]", event.raw_message),
-                ).strip(),
-                raw_message=event.raw_message,
-                plain_text=event.get_plaintext(),
-                time=event.time,
-            )
-            self.reply = None
+        self.reply = event.reply
+        self.data = ChatMessage(
+            group_id=event.group_id,
+            user_id=event.user_id,
+            message_id=event.message_id,
+            message=clean_message(event.raw_message, bool(event.reply)),
+            raw_message=event.raw_message,
+            plain_text=event.get_plaintext(),
+            time=event.time,
+        )
         self.bot_id = event.self_id
         self.to_me = event.to_me or NICKNAME in self.data.message
         self.role = "superuser" if event.user_id in SUPERUSERS else event.sender.role
         self.config = config_manager.get_group_config(self.data.group_id)
         self.ban_users = set(chat_config.ban_users + self.config.ban_users)
         self.ban_words = set(chat_config.ban_words + self.config.ban_words)
+        self.answer_id: Optional[int] = None
+        """本次回复来源的回复id"""
+        self.learn_enable = True
+        """是否学习这条消息，限流或过载时为False，消息仍会被记录"""
+        self.allowed: Optional[bool] = None
+        """这条消息是否通过校验，没有校验时为None"""
 
     async def _learn(self) -> Result:
         if self.to_me and any(w in self.data.message for w in {"学说话", "快学", "开启学习"}):
@@ -114,17 +232,21 @@ class LearningChat:
         elif self.to_me and any(w in self.data.message for w in {"不可以", "达咩", "不能说这"}):
             # 如果是对某句话进行禁言
             return Result.Ban
-        elif not await self._check_allow(self.data):
+        elif not await self._check_self():
             # 本消息不合法，跳过
             log_debug("群聊学习", "➤消息未通过校验，跳过")
             return Result.Pass
+        elif not self.learn_enable:
+            # 学习过于频繁或数据库过载时不学习，但仍然可以复读和回复
+            log_debug("群聊学习", "➤学习过于频繁或数据库过载，跳过学习")
+            if repeat_detector.is_repeat(
+                self.data.group_id, self.data.message, self.data.time
+            ):
+                return Result.Repeat
+            return Result.SkipLearn
         elif self.reply:
             # 如果是回复消息
-            if not (
-                message := await ChatMessage.filter(
-                    message_id=self.reply.message_id
-                ).first()
-            ):
+            if not (message := await reply_targets.resolve(self.reply.message_id)):
                 # 回复的消息在数据库中有记录
                 log_debug("群聊学习", "➤回复的消息不在数据库中，跳过")
                 return Result.Pass
@@ -132,16 +254,28 @@ class LearningChat:
                 # 且回复的人不在屏蔽列表中
                 log_debug("群聊学习", "➤回复的人在屏蔽列表中，跳过")
                 return Result.Pass
-            if not await self._check_allow(message):
+            if not (
+                message.allowed
+                if message.allowed is not None
+                else await self._check_allow(message)
+            ):
                 # 且回复的内容通过校验
                 log_debug("群聊学习", "➤回复的消息未通过校验，跳过")
                 return Result.Pass
             # 则将该回复作为该消息的答案
             await self._set_answer(message)
             return Result.Learn
-        elif messages := await ChatMessage.filter(
-            group_id=self.data.group_id, time__gte=self.data.time - 3600
-        ).limit(5):
+        elif repeat_detector.is_repeat(
+            self.data.group_id, self.data.message, self.data.time
+        ):
+            # 与上一条消息相同，复读中
+            log_debug("群聊学习", "➤复读中，跳过")
+            return Result.Repeat
+        elif messages := await load_messages(
+            ChatMessage.filter(
+                group_id=self.data.group_id, time__gte=self.data.time - 3600
+            ).limit(5)
+        ):
             # 获取本群一个小时内的最后5条消息
             if messages[0].message == self.data.message:
                 # 判断是否为复读中
@@ -173,8 +307,61 @@ class LearningChat:
 
     async def answer(self) -> Optional[List[Union[MessageSegment, str]]]:
         """获取这句话的回复"""
-        result = await self._learn()
-        await self.data.save()
+        # 多个bot连接收到同一条消息时只处理一次
+        if not await coordinator.claim_message(
+            self.data.group_id, self.data.message_id
+        ):
+            return None
+        load_shedder.in_flight += 1
+        try:
+            return await self._answer()
+        finally:
+            load_shedder.in_flight -= 1
+
+    def _allow_reply(self) -> bool:
+        if rate_limiter.allow(
+            self.data.group_id, "reply", self.config.reply_rate_limit
+        ):
+            return True
+        log_debug("群聊学习", "➤➤回复过于频繁，不回复")
+        return False
+
+    async def _answer(self) -> Optional[List[Union[MessageSegment, str]]]:
+        self.learn_enable = (
+            rate_limiter.allow(
+                self.data.group_id, "learn", self.config.learn_rate_limit
+            )
+            and load_shedder.should_learn()
+        )
+        # 本群有bot刚发送的消息时先写入，保证学习时能查到，其余由定时任务批量写入
+        if reply_journal.has_pending(self.data.group_id):
+            try:
+                await reply_journal.flush()
+            except Exception as e:
+                # 写入失败的消息留待定时任务重试，不影响本条消息的处理
+                log_info("群聊学习", f"发送记录写入<r>失败</r>: {e!r}")
+        if warm_up_done():
+            result = await self._learn()
+        else:
+            # 分词器初始化完成前在事件循环中分词会阻塞等待初始化，只记录消息，不学习也不回复
+            log_debug("群聊学习", "➤分词器初始化中，跳过")
+            result = Result.Pass
+        if self.learn_enable:
+            start_time = time.perf_counter()
+            await save_messages([self.data])
+            load_shedder.record_latency(time.perf_counter() - start_time)
+        elif reply_journal.defer(self.data):
+            # 不学习时消息仍要记录，积攒一批后一次写入，减少过载时的写入次数
+            try:
+                await reply_journal.flush_deferred()
+            except Exception as e:
+                log_info("群聊学习", f"聊天记录写入<r>失败</r>: {e!r}")
+        reply_targets.add(self.data, self.allowed)
+        repeat_detector.feed(
+            self.data.group_id, self.data.user_id, self.data.message, self.data.time
+        )
+        activity_tracker.feed(self.data.group_id, self.data.user_id, self.data.time)
+        stat_counter.incr(self.data.group_id, "messages")
         if result == Result.Ban:
             # 禁用某句话
             if self.role not in {"superuser", "admin", "owner"}:
@@ -185,6 +372,7 @@ class LearningChat:
             else:
                 ban_result = await self._ban()
             if ban_result:
+                stat_counter.incr(self.data.group_id, "bans")
                 return [random.choice(SORRY_WORDS)]
             else:
                 return [random.choice(DOUBT_WORDS)]
@@ -208,126 +396,109 @@ class LearningChat:
             # 跳过
             return None
         elif result == Result.Repeat:
-            if (
-                await ChatMessage.filter(
-                    group_id=self.data.group_id, time__gte=self.data.time - 3600
-                )
-                .limit(self.config.repeat_threshold + 5)
-                .filter(user_id=self.bot_id, message=self.data.message)
-                .exists()
-            ):
-                # 如果在阈值+5条消息内，bot已经回复过这句话，则跳过
-                log_debug("群聊学习", "➤➤已经复读过了，跳过")
+            if not (state := repeat_detector.get(self.data.group_id)):
                 return None
-            if not (
-                messages := await ChatMessage.filter(
-                    group_id=self.data.group_id, time__gte=self.data.time - 3600
-                ).limit(self.config.repeat_threshold)
-            ):
+            if state.bot_joined:
+                # 如果bot已经复读或打断过这轮复读，则跳过
+                log_debug("群聊学习", "➤➤已经复读过了，跳过")
                 return None
             # 如果达到阈值，且不是全都为同一个人在说，则进行复读
             if (
-                len(messages) >= self.config.repeat_threshold
-                and all(message.message == self.data.message for message in messages)
-                and any(message.user_id != self.data.user_id for message in messages)
+                state.count >= self.config.repeat_threshold
+                and len(state.users) > 1
+                and self._allow_reply()
             ):
+                stat_counter.incr(self.data.group_id, "repeats")
                 if random.random() < self.config.break_probability:
                     log_debug("群聊学习", "➤➤达到复读阈值，打断复读！")
                     return [random.choice(BREAK_REPEAT_WORDS)]
                 else:
-                    log_debug("群聊学习", f"➤➤达到复读阈值，复读<m>{messages[0].message}</m>")
+                    log_debug("群聊学习", f"➤➤达到复读阈值，复读<m>{state.message}</m>")
                     return [self.data.message]
             return None
         else:
             # 回复
-            if self.data.is_plain_text and len(self.data.plain_text) <= 1:
+            if self.data.is_plain_text and len(self.data.text) <= 1:
                 log_debug("群聊学习", "➤➤消息过短，不回复")
                 return None
-            if not (
-                context := await ChatContext.filter(keywords=self.data.keywords).first()
-            ):
-                log_debug("群聊学习", "➤➤尚未有已学习的回复，不回复")
-                return None
+            if not (entry := await context_cache.get(self.data.keywords)).context:
+                if self.config.fuzzy_match:
+                    entry = await self._fuzzy_match() or entry
+                if not entry.context:
+                    log_debug("群聊学习", "➤➤尚未有已学习的回复，不回复")
+                    return None
 
             # 获取回复阈值
-            if not self.to_me:
-                answer_choices = list(
-                    range(
-                        self.config.answer_threshold
-                        - len(self.config.answer_threshold_weights)
-                        + 1,
-                        self.config.answer_threshold + 1,
-                    )
-                )
-
-                answer_count_threshold = random.choices(
-                    answer_choices, weights=self.config.answer_threshold_weights
-                )[0]
-
-                if len(self.data.keyword_list) == chat_config.KEYWORDS_SIZE:
-                    answer_count_threshold -= 1
-                cross_group_threshold = chat_config.cross_group_threshold
-            else:
-                answer_count_threshold = 1
-                cross_group_threshold = 1
+            thresholds, cross_group_threshold = answer_thresholds(
+                self.config, self.data.keyword_list, self.to_me
+            )
+            answer_count_threshold = random.choices(
+                [t for t, _ in thresholds], weights=[w for _, w in thresholds]
+            )[0]
             log_debug(
                 "群聊学习",
                 f"➤➤本次回复阈值为<m>{answer_count_threshold}</m>，跨群阈值为<m>{cross_group_threshold}</m>",
             )
-            # 获取满足跨群条件的回复
-            answers_cross = await ChatAnswer.filter(
-                context=context,
-                count__gte=answer_count_threshold,
-                keywords__in=await ChatAnswer.annotate(cross=Count("keywords"))
-                .group_by("keywords")
-                .filter(cross__gte=cross_group_threshold)
-                .values_list("keywords", flat=True),
-            )
-
-            answer_same_group = await ChatAnswer.filter(
-                context=context,
-                count__gte=answer_count_threshold,
-                group_id=self.data.group_id,
-            )
-
-            candidate_answers: List[Optional[ChatAnswer]] = []
-            # 检查候选回复是否在屏蔽列表中
-            for answer in set(answers_cross) | set(answer_same_group):
-                if not await self._check_allow(answer):
-                    continue
-                # if answer_count_threshold > 0:
-                #     answer.count -= answer_count_threshold - 1
-                candidate_answers.append(answer)
-            if not candidate_answers:
+            if not (
+                sampler := await self._get_sampler(
+                    entry, answer_count_threshold, cross_group_threshold
+                )
+            ):
                 log_debug("群聊学习", "➤➤没有符合条件的候选回复")
                 return None
-
-            # 从候选回复中进行选择
-            sum_count = sum(answer.count for answer in candidate_answers)
-            per_list = [
-                answer.count / sum_count * (1 - 1 / answer.count)
-                for answer in candidate_answers
-            ]
-
-            per_list.append(1 - sum(per_list))
-            answer_dict = tuple(zip(candidate_answers, per_list))
-            log_debug(
-                "群聊学习",
-                f'➤➤候选回复有<m>{"|".join([f"""{a.keywords}({round(p, 3)})""" for a, p in answer_dict])}|不回复({round(per_list[-1], 3)})</m>',
-            )
-
-            if (
-                result := random.choices(candidate_answers + [None], weights=per_list)[
-                    0
-                ]
-            ) is None:
+            if (result := sampler.sample()) is None:
                 log_debug("群聊学习", "➤➤但不进行回复")
                 return None
+            if not self._allow_reply():
+                return None
             result_message = random.choice(result.messages)
+            self.answer_id = result.id
+            stat_counter.incr(self.data.group_id, "replies")
             log_debug("群聊学习", f"➤➤将回复<m>{result_message}</m>")
             await asyncio.sleep(random.random() + 0.5)
             return [result_message]
 
+    async def _fuzzy_match(self) -> Optional[ContextEntry]:
+        """通过关键词索引查找最相似的已学习内容"""
+        for keywords, score in await keyword_index.search(
+            self.data.keyword_list, self.config.fuzzy_threshold
+        ):
+            if (entry := await context_cache.get(keywords)).context:
+                log_debug("群聊学习", f"➤➤模糊匹配到内容<m>{keywords}</m>，相似度<m>{score:.2f}</m>")
+                return entry
+        return None
+
+    async def _get_sampler(
+        self, entry: ContextEntry, count_threshold: int, cross_threshold: int
+    ) -> Optional[AliasSampler[Optional[AnswerRecord]]]:
+        """获取该内容在本群该阈值下的回复选择器，在内容的回复变化前只构建一次"""
+        key = (self.data.group_id, count_threshold, cross_threshold)
+        if key in entry.samplers:
+            return entry.samplers[key]
+        candidate_answers: List[Optional[AnswerRecord]] = list(
+            await filter_answers(
+                entry,
+                self.data.group_id,
+                count_threshold,
+                cross_threshold,
+                self._check_allow,
+            )
+        )
+        if not candidate_answers:
+            entry.samplers[key] = None
+            return None
+
+        # 从候选回复中进行选择
+        per_list = answer_weights(candidate_answers)  # type: ignore
+        per_list.append(1 - sum(per_list))
+        answer_dict = tuple(zip(candidate_answers, per_list))
+        log_debug(
+            "群聊学习",
+            f'➤➤候选回复有<m>{"|".join([f"""{a.keywords}({round(p, 3)})""" for a, p in answer_dict])}|不回复({round(per_list[-1], 3)})</m>',
+        )
+        entry.samplers[key] = AliasSampler(candidate_answers + [None], per_list)
+        return entry.samplers[key]
+
     async def _ban(self, message_id: Optional[int] = None) -> bool:
         """屏蔽消息"""
         bots = get_adapter(Adapter).bots
@@ -335,23 +506,27 @@ class LearningChat:
             return False
         bot = list(bots.values())[0]
         if message_id:
-            if (
-                not (message := await ChatMessage.filter(message_id=message_id).first())
+            if sent := reply_journal.find(self.data.group_id, message_id):
+                # 最近发送的消息，使用其来源回复的关键词
+                if sent.message in ALL_WORDS:
+                    return False
+                keywords = await sent.keywords()
+            elif (
+                not (message := await reply_targets.resolve(message_id))
                 or message.message in ALL_WORDS
             ):
                 return False
-            keywords = message.keywords
+            else:
+                keywords = message.keywords
             try:
                 await bot.delete_msg(message_id=message_id)
             except ActionFailed:
                 log_info("群聊学习", f"待禁用消息<m>{message_id}</m>尝试撤回<r>失败</r>")
-        elif (
-            last_reply := await ChatMessage.filter(
-                group_id=self.data.group_id, user_id=self.bot_id
-            ).first()
-        ) and (last_reply.message not in ALL_WORDS):
+        elif (last_reply := reply_journal.last(self.data.group_id)) and (
+            last_reply.message not in ALL_WORDS
+        ):
             # 没有指定消息ID，则屏蔽最后一条回复
-            keywords = last_reply.keywords
+            keywords = await last_reply.keywords()
             try:
                 await bot.delete_msg(message_id=last_reply.message_id)
             except ActionFailed:
@@ -384,6 +559,9 @@ class LearningChat:
             ).delete()
         await ChatContext.filter(keywords=keywords).delete()
         await ban_word.save()
+        context_cache.invalidate_answer(keywords)
+        context_cache.invalidate_context(keywords)
+        reply_targets.invalidate_keywords(keywords)
         return True
 
     @staticmethod
@@ -426,59 +604,45 @@ class LearningChat:
                 await ChatAnswer.filter(keywords=data.keywords).delete()
         await ChatContext.filter(keywords=data.keywords).delete()
         await ban_word.save()
+        context_cache.invalidate_answer(data.keywords)
+        context_cache.invalidate_context(data.keywords)
+        reply_targets.invalidate_keywords(data.keywords)
 
     @staticmethod
     async def speak(
-        self_id: int,
-    ) -> Optional[Tuple[int, List[Union[str, MessageSegment]]]]:
-        # 主动发言
+        self_id: int, group_ids: Optional[Iterable[int]] = None
+    ) -> List[Speech]:
+        """主动发言，为符合条件的群各生成一组发言，每次最多speak_max_groups个群，group_ids为空时检查所有群"""
+        if not warm_up_done():
+            return []
         cur_time = int(time.time())
         today_time = time.mktime(datetime.date.today().timetuple())
-        # 获取两小时内消息超过10条的群列表
-        groups = (
-            await ChatMessage.filter(time__gte=today_time)
-            .annotate(count=Count("id"))
-            .group_by("group_id")
-            .filter(count__gte=10)
-            .values_list("group_id", flat=True)
-        )
-        if not groups:
-            return None
-        total_messages = {}
-        # 获取这些群的两小时内的所有消息
-        for group_id in groups:
-            if messages := await ChatMessage.filter(
-                group_id=group_id, time__gte=today_time
-            ):
-                total_messages[group_id] = messages
-        if not total_messages:
-            return None
+        # 今天各群的发言统计由消息接收时维护，无需查询聊天记录
+        activity = activity_tracker.snapshot()
+        if group_ids is not None:
+            activity = {g: activity[g] for g in group_ids if g in activity}
+        if not activity:
+            return []
 
         # 根据消息平均间隔来对群进行排序
-        def group_popularity_cmp(
-            left_group: Tuple[int, List[ChatMessage]],
-            right_group: Tuple[int, List[ChatMessage]],
-        ):
-            def cmp(a, b):
-                return (a > b) - (a < b)
-
-            left_group_id, left_messages = left_group
-            right_group_id, right_messages = right_group
-            left_duration = left_messages[0].time - left_messages[-1].time
-            right_duration = right_messages[0].time - right_messages[-1].time
-            return cmp(
-                len(left_messages) / left_duration, len(right_messages) / right_duration
-            )
-
-        popularity: List[Tuple[int, List[ChatMessage]]] = sorted(
-            total_messages.items(), key=cmp_to_key(group_popularity_cmp), reverse=True
+        popularity = sorted(
+            activity.items(), key=lambda g: g[1].popularity, reverse=True
         )
         log_debug(
             "群聊学习", f'主动发言：群热度排行<m>{">>".join([str(g[0]) for g in popularity])}</m>'
         )
-        for group_id, messages in popularity:
-            if len(messages) < 30:
-                log_debug("群聊学习", f"主动发言：群<m>{group_id}</m>消息小于30条，不发言")
+        speeches: List[Speech] = []
+        # 相同回复阈值的群共用一次内容查询
+        contexts_by_threshold: Dict[int, List[ChatContext]] = {}
+        for group_id, group_activity in popularity:
+            if 0 < chat_config.speak_max_groups <= len(speeches):
+                log_debug(
+                    "群聊学习",
+                    f"主动发言：本次已有<m>{len(speeches)}</m>个群发言，其余群等待下次",
+                )
+                break
+            if group_activity.count < MIN_MESSAGES:
+                log_debug("群聊学习", f"主动发言：群<m>{group_id}</m>消息小于{MIN_MESSAGES}条，不发言")
                 continue
 
             config = config_manager.get_group_config(group_id)
@@ -500,11 +664,10 @@ class LearningChat:
                 log_debug("群聊学习", f"主动发言：群<m>{group_id}</m>未开启，不发言")
                 continue
 
+            last_message_time = group_activity.last_time
             # 如果最后一条消息是自己发的，则不主动发言
-            if last_reply := await ChatMessage.filter(
-                group_id=group_id, user_id=self_id
-            ).first():
-                if last_reply.time >= messages[0].time:
+            if last_reply := reply_journal.last(group_id):
+                if last_reply.time >= last_message_time:
                     log_debug(
                         "群聊学习",
                         f"主动发言：群<m>{group_id}</m>最后一条消息是{NICKNAME}发的{last_reply.message}，不发言",
@@ -515,9 +678,9 @@ class LearningChat:
                     continue
 
             # 该群每多少秒发一条消息
-            avg_interval = (messages[0].time - messages[-1].time) / len(messages)
+            avg_interval = group_activity.avg_interval
             # 如果该群已沉默的时间小于阈值，则不主动发言
-            silent_time = cur_time - messages[0].time
+            silent_time = cur_time - last_message_time
             threshold = avg_interval * config.speak_threshold
             if silent_time < threshold:
                 log_debug(
@@ -526,158 +689,182 @@ class LearningChat:
                 )
                 continue
 
-            if contexts := await ChatContext.filter(
-                count__gte=config.answer_threshold
-            ).all():
-                speak_list = []
-                # context = random.choices(contexts, weights=[context.count for context in contexts])[0]
-                # contexts.sort(key=lambda x: x.count, reverse=True)
-                random.shuffle(contexts)
-                for context in contexts:
-                    if (
-                        not speak_list
-                        or random.random() < config.speak_continuously_probability
-                    ) and len(speak_list) < config.speak_continuously_max_len:
-                        if answers := await ChatAnswer.filter(
-                            context=context,
-                            group_id=group_id,
-                            count__gte=config.answer_threshold,
+            if config.answer_threshold not in contexts_by_threshold:
+                contexts_by_threshold[config.answer_threshold] = await load_contexts(
+                    ChatContext.filter(count__gte=config.answer_threshold)
+                )
+            if not (contexts := contexts_by_threshold[config.answer_threshold]):
+                continue
+            speak_list, answer_ids = await LearningChat._compose_speech(
+                group_id, config, list(contexts), ban_words, today_time
+            )
+            if not speak_list:
+                log_debug("群聊学习", f"主动发言：群<m>{group_id}</m>没有找到符合条件的发言，不发言")
+                continue
+            if random.random() < config.speak_poke_probability and (
+                last_speak_users := {
+                    user_id for user_id in group_activity.users if user_id != self_id
+                }
+            ):
+                select_user = random.choice(list(last_speak_users))
+                speak_list.append(MessageSegment("poke", {"qq": select_user}))
+                answer_ids.append(None)
+            speeches.append(Speech(group_id, speak_list, answer_ids))
+        if not speeches:
+            log_debug("群聊学习", "主动发言：没有符合条件的群，不主动发言")
+        return speeches
+
+    @staticmethod
+    async def _compose_speech(
+        group_id: int,
+        config: ChatGroupConfig,
+        contexts: List[ContextRecord],
+        ban_words: Set[str],
+        today_time: float,
+    ) -> Tuple[List[Union[str, MessageSegment]], List[Optional[int]]]:
+        """从内容中随机挑选回复组成一组发言，返回(发言列表, 每句发言的来源回复id)"""
+        speak_list: List[Union[str, MessageSegment]] = []
+        answer_ids: List[Optional[int]] = []
+        # context = random.choices(contexts, weights=[context.count for context in contexts])[0]
+        # contexts.sort(key=lambda x: x.count, reverse=True)
+        random.shuffle(contexts)
+        for context in contexts:
+            if (
+                not speak_list
+                or random.random() < config.speak_continuously_probability
+            ) and len(speak_list) < config.speak_continuously_max_len:
+                if answers := await load_answers(
+                    ChatAnswer.filter(
+                        context_id=context.id,
+                        group_id=group_id,
+                        count__gte=config.answer_threshold,
+                    )
+                ):
+                    answer = random.choices(
+                        answers,
+                        weights=[
+                            answer.count + 1
+                            if answer.time >= today_time
+                            else answer.count
+                            for answer in answers
+                        ],
+                    )[0]
+                    message = random.choice(answer.messages)
+                    if len(message) < 2:
+                        continue
+                    if message.startswith("&#91;") and message.endswith("&#93;"):
+                        continue
+                    if any(word in message for word in ban_words):
+                        continue
+                    speak_list.append(message)
+                    answer_ids.append(answer.id)
+                    follow_answer = answer
+                    while (
+                        random.random() < config.speak_continuously_probability
+                        and len(speak_list) < config.speak_continuously_max_len
+                    ):
+                        if (
+                            follow_context_id := await ChatContext.filter(
+                                keywords=follow_answer.keywords
+                            )
+                            .first()
+                            .values_list("id", flat=True)
+                        ) and (
+                            follow_answers := await load_answers(
+                                ChatAnswer.filter(
+                                    group_id=group_id,
+                                    context_id=follow_context_id,
+                                    count__gte=config.answer_threshold,
+                                )
+                            )
                         ):
-                            answer = random.choices(
-                                answers,
+                            follow_answer = random.choices(
+                                follow_answers,
                                 weights=[
-                                    answer.count + 1
-                                    if answer.time >= today_time
-                                    else answer.count
-                                    for answer in answers
+                                    a.count + 1 if a.time >= today_time else a.count
+                                    for a in follow_answers
                                 ],
                             )[0]
-                            message = random.choice(answer.messages)
+                            message = random.choice(follow_answer.messages)
                             if len(message) < 2:
                                 continue
                             if message.startswith("&#91;") and message.endswith(
                                 "&#93;"
                             ):
                                 continue
-                            if any(word in message for word in ban_words):
-                                continue
-                            speak_list.append(message)
-                            follow_answer = answer
-                            while (
-                                random.random() < config.speak_continuously_probability
-                                and len(speak_list) < config.speak_continuously_max_len
-                            ):
-                                if (
-                                    follow_context := await ChatContext.filter(
-                                        keywords=follow_answer.keywords
-                                    ).first()
-                                ) and (
-                                    follow_answers := await ChatAnswer.filter(
-                                        group_id=group_id,
-                                        context=follow_context,
-                                        count__gte=config.answer_threshold,
-                                    )
-                                ):
-                                    follow_answer = random.choices(
-                                        follow_answers,
-                                        weights=[
-                                            a.count + 1
-                                            if a.time >= today_time
-                                            else a.count
-                                            for a in follow_answers
-                                        ],
-                                    )[0]
-                                    message = random.choice(follow_answer.messages)
-                                    if len(message) < 2:
-                                        continue
-                                    if message.startswith("&#91;") and message.endswith(
-                                        "&#93;"
-                                    ):
-                                        continue
-                                    if all(word not in message for word in ban_words):
-                                        speak_list.append(message)
-                                else:
-                                    break
-                    else:
-                        break
-                if speak_list:
-                    if random.random() < config.speak_poke_probability:
-                        last_speak_users = {
-                            message.user_id
-                            for message in messages[:5]
-                            if message.user_id != self_id
-                        }
-                        select_user = random.choice(list(last_speak_users))
-                        speak_list.append(MessageSegment("poke", {"qq": select_user}))
-                    return group_id, speak_list
-                else:
-                    log_debug("群聊学习", f"主动发言：群<m>{group_id}</m>没有找到符合条件的发言，不发言")
-            log_debug("群聊学习", "主动发言：没有符合条件的群，不主动发言")
-            return None
+                            if all(word not in message for word in ban_words):
+                                speak_list.append(message)
+                                answer_ids.append(follow_answer.id)
+                        else:
+                            break
+            else:
+                break
+        return speak_list, answer_ids
 
-    async def _set_answer(self, message: ChatMessage):
-        if context := await ChatContext.filter(keywords=message.keywords).first():
-            if context.count < chat_config.learn_max_count:
-                context.count += 1
-            context.time = self.data.time
-            if answer := await ChatAnswer.filter(
-                keywords=self.data.keywords,
-                group_id=self.data.group_id,
-                context=context,
-            ).first():
-                if answer.count < chat_config.learn_max_count:
-                    answer.count += 1
-                answer.time = self.data.time
-                if self.data.message not in answer.messages:
-                    answer.messages.append(self.data.message)
+    async def _set_answer(
+        self, message: Union[ChatMessage, MessageRecord, ReplyTarget]
+    ):
+        async with coordinator.learn_lock(message.keywords) as locked:
+            if not locked:
+                # 其他进程长时间持有锁，放弃本次学习，避免重复创建内容
+                log_debug("群聊学习", "➤等待学习锁超时，跳过学习")
+                return
+            if coordinator.enabled and corpus_idf.stale:
+                # 其他进程刚切换了语料IDF，本条消息的关键词是按旧版本提取的
+                corpus_idf.refresh()
+                log_debug("群聊学习", "➤语料IDF已更新，跳过学习")
+                return
+            if context := await ChatContext.filter(keywords=message.keywords).first():
+                if context.count < chat_config.learn_max_count:
+                    context.count += 1
+                context.time = self.data.time
+                if answer := await ChatAnswer.filter(
+                    keywords=self.data.keywords,
+                    group_id=self.data.group_id,
+                    context=context,
+                ).first():
+                    if answer.count < chat_config.learn_max_count:
+                        answer.count += 1
+                    answer.time = self.data.time
+                    if self.data.message not in answer.messages:
+                        answer.messages.append(self.data.message)
+                else:
+                    answer = ChatAnswer(
+                        keywords=self.data.keywords,
+                        group_id=self.data.group_id,
+                        time=self.data.time,
+                        context=context,
+                        messages=[self.data.message],
+                    )
+                    context_cache.invalidate_answer(self.data.keywords)
+                await answer.save()
+                await context.save()
             else:
-                answer = ChatAnswer(
+                context = await ChatContext.create(
+                    keywords=message.keywords, time=self.data.time
+                )
+                keyword_index.add(context.id, context.keywords)
+                stat_counter.incr(self.data.group_id, "contexts")
+                answer = await ChatAnswer.create(
                     keywords=self.data.keywords,
                     group_id=self.data.group_id,
                     time=self.data.time,
                     context=context,
                     messages=[self.data.message],
                 )
-            await answer.save()
-            await context.save()
-        else:
-            context = await ChatContext.create(
-                keywords=message.keywords, time=self.data.time
-            )
-            answer = await ChatAnswer.create(
-                keywords=self.data.keywords,
-                group_id=self.data.group_id,
-                time=self.data.time,
-                context=context,
-                messages=[self.data.message],
+                context_cache.invalidate_answer(self.data.keywords)
+            context_cache.invalidate_context(message.keywords)
+            stat_counter.incr(self.data.group_id, "answers")
+            log_debug(
+                "群聊学习", f"➤将被学习为<m>{message.message}</m>的回答，已学次数为<m>{answer.count}</m>"
             )
-        log_debug(
-            "群聊学习", f"➤将被学习为<m>{message.message}</m>的回答，已学次数为<m>{answer.count}</m>"
-        )
 
-    async def _check_allow(self, message: Union[ChatMessage, ChatAnswer]) -> bool:
-        raw_message = (
-            message.message if isinstance(message, ChatMessage) else message.messages[0]
-        )
-        # if len(raw_message) < 2:
-        #     return False
-        if any(
-            i in raw_message
-            for i in {
-                "[CQ:xml",
-                "[CQ:json",
-                "[CQ:at",
-                "[CQ:video",
-                "[CQ:record",
-                "[CQ:share",
-            }
-        ):
-            return False
-        if any(i in raw_message for i in self.ban_words):
-            return False
-        if raw_message.startswith("&#91;") and raw_message.endswith("&#93;"):
-            return False
-        if ban_word := await ChatBlackList.filter(keywords=message.keywords).first():
-            if ban_word.global_ban or message.group_id in ban_word.ban_group_id:
-                return False
-        return True
+    async def _check_self(self) -> bool:
+        """校验这条消息，并记录结果供被回复时使用"""
+        self.allowed = await self._check_allow(self.data)
+        return self.allowed
+
+    async def _check_allow(
+        self, message: Union[ChatMessage, MessageRecord, AnswerRecord, ReplyTarget]
+    ) -> bool:
+        return await check_allow(message, self.ban_words)
@@ -0,0 +1,594 @@
+import asyncio
+import json
+import math
+import pickle
+import time
+from collections import Counter
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import jieba_fast as jieba
+    import jieba_fast.analyse as jieba_analyse
+except ImportError:
+    import jieba
+    import jieba.analyse as jieba_analyse
+from tortoise.transactions import in_transaction
+
+from .models import (
+    ChatAnswer,
+    ChatBlackList,
+    ChatContext,
+    ChatJob,
+    ChatMessage,
+    ChatReply,
+    derive_plain_text,
+    extract_keyword_list,
+    join_keywords,
+    set_keyword_extractor,
+)
+from .records import MessageRecord, load_messages
+from .cache import context_cache
+from .keyword_index import keyword_index
+from .reply_target import reply_targets
+from .corpus import merge_blacklist
+from .coordination import coordinator
+from .config import config_manager, driver, log_info
+
+chat_config = config_manager.config
+
+IDF_DIR = Path() / "data" / "learning_chat" / "idf"
+"""语料IDF文件和统计状态的目录"""
+STATE_PATH = IDF_DIR / "state.pickle"
+"""增量统计的状态"""
+ACTIVE_PATH = IDF_DIR / "active.json"
+"""正在使用的IDF版本，已学习内容的关键词迁移完成后才会更新"""
+STATE_VERSION = 2
+BATCH_SIZE = 5000
+"""每批读取和分词的聊天记录数量"""
+MIGRATE_BATCH_SIZE = 500
+"""迁移关键词时每个事务修改的内容数量"""
+MIN_DOCUMENTS = 5000
+"""语料少于该数量时不生成IDF文件，继续使用jieba内置的IDF"""
+MIN_DF = 2
+"""只在一条消息中出现过的词不写入IDF文件，按最罕见的词处理"""
+REBUILD_GROWTH = 0.5
+"""语料比当前版本生效时增加该比例后才生成新版本，避免关键词每天变化"""
+
+
+def idf_path(version: int) -> Path:
+    return IDF_DIR / f"idf_{version}.txt"
+
+
+def _max_rss() -> Optional[float]:
+    """进程内存峰值，单位为MB，Windows上无法获取"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class DocumentFrequency:
+    """增量统计每个词在多少条消息中出现过，所有群共用同一个词表"""
+
+    def __init__(self):
+        self.version = STATE_VERSION
+        self.last_id = 0
+        """已统计的最后一条聊天记录id"""
+        self.words: List[str] = []
+        self.vocab: Dict[str, int] = {}
+        """词 -> 词id"""
+        self.df: List[int] = []
+        """词id -> 出现过该词的消息数量"""
+        self.documents = 0
+
+    def tokenize(self, rows: Sequence[Tuple[int, str, str]]) -> List[int]:
+        """对一批聊天记录分词，返回每条消息中不重复的词id"""
+        # 与关键词提取相同的过滤规则
+        stop_words = jieba_analyse.default_tfidf.stop_words
+        ids: List[int] = []
+        for _, message, plain_text in rows:
+            if not (text := derive_plain_text(message, plain_text)):
+                continue
+            words = {
+                word
+                for word in jieba.dt.cut(text)
+                if len(word.strip()) >= 2
+                and word.lower() not in stop_words
+                # IDF文件以空格分隔词和数值
+                and not any(c.isspace() for c in word)
+            }
+            self.documents += 1
+            for word in words:
+                if (word_id := self.vocab.get(word)) is None:
+                    word_id = self.vocab[word] = len(self.words)
+                    self.words.append(word)
+                ids.append(word_id)
+        return ids
+
+    def count(self, ids: List[int]):
+        if not ids:
+            return
+        if np is None:
+            self.df.extend([0] * (len(self.words) - len(self.df)))
+            for word_id, count in Counter(ids).items():
+                self.df[word_id] += count
+            return
+        vocab_size = len(self.words)
+        if not isinstance(self.df, np.ndarray) or len(self.df) < vocab_size:
+            # 统计期间使用按倍数扩容的数组，保存时转回列表
+            df = np.zeros(max(vocab_size, len(self.df) * 2), dtype=np.int64)
+            df[: len(self.df)] = self.df
+            self.df = df
+        self.df[:vocab_size] += np.bincount(
+            np.asarray(ids, dtype=np.int64), minlength=vocab_size
+        )
+
+    def add_batch(self, rows: Sequence[Tuple[int, str, str]]):
+        self.count(self.tokenize(rows))
+        self.last_id = rows[-1][0]
+
+    def idf(self) -> Dict[str, float]:
+        counts = self.df[: len(self.words)]
+        if np is None:
+            return {
+                word: math.log(self.documents / count)
+                for word, count in zip(self.words, counts)
+                if count >= MIN_DF
+            }
+        counts = np.asarray(counts, dtype=np.float64)
+        mask = counts >= MIN_DF
+        values = np.log(self.documents / counts[mask])
+        return {
+            self.words[word_id]: value
+            for word_id, value in zip(np.flatnonzero(mask).tolist(), values.tolist())
+        }
+
+    def write(self, path: Path):
+        """写入当前统计结果的IDF文件"""
+        IDF_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+        with temp_path.open("w", encoding="utf-8") as f:
+            f.writelines(f"{word} {value:.4f}\n" for word, value in self.idf().items())
+        temp_path.replace(path)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # 状态文件不依赖NumPy
+        state["df"] = [int(count) for count in self.df[: len(self.words)]]
+        return state
+
+    def save(self):
+        IDF_DIR.mkdir(parents=True, exist_ok=True)
+        temp_path = STATE_PATH.with_suffix(".tmp")
+        with temp_path.open("wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        temp_path.replace(STATE_PATH)
+
+    @classmethod
+    def load(cls) -> "DocumentFrequency":
+        """读取上次的统计状态，没有或版本不符时重新统计"""
+        try:
+            with STATE_PATH.open("rb") as f:
+                state = pickle.load(f)
+            if state.version == STATE_VERSION:
+                return state
+        except Exception:
+            pass
+        return cls()
+
+
+def read_active() -> dict:
+    """正在使用的IDF版本，version为0时使用jieba内置的IDF"""
+    try:
+        with ACTIVE_PATH.open(encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {"version": 0, "documents": 0}
+
+
+def _active_mtime() -> float:
+    try:
+        return ACTIVE_PATH.stat().st_mtime
+    except OSError:
+        return 0
+
+
+def write_active(version: int, documents: int):
+    IDF_DIR.mkdir(parents=True, exist_ok=True)
+    temp_path = ACTIVE_PATH.with_suffix(".tmp")
+    with temp_path.open("w", encoding="utf-8") as f:
+        json.dump({"version": version, "documents": documents}, f)
+    temp_path.replace(ACTIVE_PATH)
+
+
+def load_extractor(path: Path) -> "jieba_analyse.TFIDF":
+    """读取IDF文件，创建与jieba默认提取器使用相同停用词的关键词提取器"""
+    extractor = jieba_analyse.TFIDF(str(path))
+    extractor.stop_words = jieba_analyse.default_tfidf.stop_words
+    # 没有出现在语料中的词比任何已统计的词都罕见
+    if extractor.idf_freq:
+        extractor.median_idf = max(extractor.idf_freq.values())
+    return extractor
+
+
+async def _stored_keywords() -> Set[str]:
+    """已学习的内容、回复和禁用词中出现过的所有关键词"""
+    keywords: Set[str] = set()
+    for model in (ChatContext, ChatAnswer, ChatBlackList):
+        last_id = 0
+        while rows := (
+            await model.filter(id__gt=last_id)
+            .order_by("id")
+            .limit(BATCH_SIZE)
+            .values_list("id", "keywords")
+        ):
+            last_id = rows[-1][0]
+            keywords.update(row[1] for row in rows)
+    return keywords
+
+
+def _vote(
+    records: List[MessageRecord],
+    old: "jieba_analyse.TFIDF",
+    new: "jieba_analyse.TFIDF",
+    stored: Set[str],
+    votes: Dict[str, Counter],
+):
+    """统计已学习的关键词在新的IDF下变成了什么"""
+    for record in records:
+        if not record.plain_text and not record.is_plain_text:
+            continue
+        text = record.text
+        keywords = join_keywords(
+            record.message, text, extract_keyword_list(record.message, text, old)
+        )
+        if keywords in stored:
+            votes.setdefault(keywords, Counter())[
+                join_keywords(
+                    record.message, text, extract_keyword_list(record.message, text, new)
+                )
+            ] += 1
+
+
+async def keyword_mapping(
+    old: "jieba_analyse.TFIDF", new: "jieba_analyse.TFIDF"
+) -> Dict[str, str]:
+    """用新旧两个提取器重新提取聊天记录的关键词，得到已学习的关键词 -> 新关键词"""
+    stored = await _stored_keywords()
+    votes: Dict[str, Counter] = {}
+    loop = asyncio.get_running_loop()
+    last_id = 0
+    while records := await load_messages(
+        ChatMessage.filter(id__gt=last_id).order_by("id").limit(BATCH_SIZE)
+    ):
+        last_id = records[-1].id
+        await loop.run_in_executor(None, _vote, records, old, new, stored, votes)
+    # 同一关键词在不同消息中可能变成不同的结果，取最多的
+    mapping = {}
+    for keywords, counter in votes.items():
+        if (new_keywords := counter.most_common(1)[0][0]) != keywords:
+            mapping[keywords] = new_keywords
+    return mapping
+
+
+async def _merge_answers(context_id: int, answers: List[ChatAnswer]):
+    """将回复保存到该内容下，关键词和群相同的回复合并到id最小的行，发送记录改为指向保留的行"""
+    kept: Dict[Tuple[str, int], ChatAnswer] = {}
+    merged: Dict[int, int] = {}
+    for answer in sorted(answers, key=lambda a: a.id):
+        if not (target := kept.get((answer.keywords, answer.group_id))):
+            kept[(answer.keywords, answer.group_id)] = answer
+            continue
+        target.count = min(target.count + answer.count, chat_config.learn_max_count)
+        target.time = max(target.time, answer.time)
+        target.messages.extend(m for m in answer.messages if m not in target.messages)
+        merged[answer.id] = target.id
+    for answer in kept.values():
+        answer.context_id = context_id
+        await answer.save()
+    for answer_id, target_id in merged.items():
+        await ChatReply.filter(answer_id=answer_id).update(answer_id=target_id)
+    if merged:
+        await ChatAnswer.filter(id__in=list(merged)).delete()
+
+
+async def _rename_context(context_id: int, mapping: Dict[str, str]) -> Optional[str]:
+    """在原有的行上替换内容及其回复的关键词，返回新的内容关键词，已被合并删除时返回None"""
+    if not (context := await ChatContext.filter(id=context_id).first()):
+        return None
+    answers = await ChatAnswer.filter(context_id=context_id)
+    old_keywords = context.keywords
+    async with in_transaction("learning_chat"):
+        if old_keywords in mapping:
+            context.keywords = mapping[old_keywords]
+            await context.save(update_fields=["keywords"])
+        for answer in answers:
+            context_cache.invalidate_answer(answer.keywords)
+            answer.keywords = mapping.get(answer.keywords, answer.keywords)
+        await _merge_answers(context_id, answers)
+    context_cache.invalidate_context(old_keywords)
+    context_cache.invalidate_context(context.keywords)
+    keyword_index.remove(context_id)
+    keyword_index.add(context_id, context.keywords)
+    return context.keywords
+
+
+async def _merge_duplicates(keywords: str) -> int:
+    """将关键词相同的内容合并到id最小的行，已有的回复、发送记录和后台任务都指向保留的行，返回合并掉的数量"""
+    contexts = await ChatContext.filter(keywords=keywords).order_by("id")
+    if len(contexts) < 2:
+        return 0
+    kept, merged = contexts[0], contexts[1:]
+    ids = [c.id for c in merged]
+    async with in_transaction("learning_chat"):
+        for context in merged:
+            kept.count = min(kept.count + context.count, chat_config.learn_max_count)
+            kept.time = max(kept.time, context.time)
+        await kept.save()
+        await _merge_answers(
+            kept.id, await ChatAnswer.filter(context_id__in=[kept.id, *ids])
+        )
+        await ChatJob.filter(context_id__in=ids).update(context_id=kept.id)
+        await ChatContext.filter(id__in=ids).delete()
+    context_cache.invalidate_context(keywords)
+    for context_id in ids:
+        keyword_index.remove(context_id)
+    return len(ids)
+
+
+async def _lock_all(stack: AsyncExitStack, keywords: Iterable[str]) -> bool:
+    """按固定顺序对多个关键词加学习锁，同一关键词只加一次，返回是否全部获得"""
+    for k in sorted(set(keywords)):
+        if not await stack.enter_async_context(coordinator.learn_lock(k)):
+            return False
+    return True
+
+
+class Migration:
+    """将已学习内容和回复的关键词替换为新IDF下的结果，保留原有的行和id"""
+
+    def __init__(self, mapping: Dict[str, str]):
+        self.mapping = mapping
+        self.renamed: Set[str] = set()
+        """被替换成的内容关键词，可能与已有的内容相同，需要合并"""
+        self.skipped: List[int] = []
+        """等待学习锁超时而跳过的内容，在暂停学习后重新迁移"""
+        self.migrated = 0
+        self.merged = 0
+
+    async def rename(
+        self, since: int = 0, ids: Sequence[int] = (), lock: bool = True
+    ) -> int:
+        """迁移id大于since或在ids中的内容，返回扫描到的最大id"""
+        last_id = since
+        while contexts := (
+            await ChatContext.filter(id__gt=last_id)
+            .order_by("id")
+            .limit(MIGRATE_BATCH_SIZE)
+            .values_list("id", "keywords")
+        ):
+            last_id = contexts[-1][0]
+            await self._rename_batch(contexts, lock)
+        if ids:
+            await self._rename_batch(
+                await ChatContext.filter(id__in=list(ids)).values_list("id", "keywords"), lock
+            )
+        return last_id
+
+    async def _rename_batch(self, contexts: List[Tuple[int, str]], lock: bool):
+        answers: Dict[int, List[str]] = {}
+        for context_id, keywords in await ChatAnswer.filter(
+            context_id__in=[c[0] for c in contexts]
+        ).values_list("context_id", "keywords"):
+            answers.setdefault(context_id, []).append(keywords)
+        for context_id, keywords in contexts:
+            if keywords not in self.mapping and not any(
+                k in self.mapping for k in answers.get(context_id, ())
+            ):
+                continue
+            # 与学习写入互斥，学习会按旧关键词或新关键词查找内容
+            async with AsyncExitStack() as stack:
+                if lock and not await _lock_all(
+                    stack, (keywords, self.mapping.get(keywords, keywords))
+                ):
+                    self.skipped.append(context_id)
+                    continue
+                if (new_keywords := await _rename_context(context_id, self.mapping)) is None:
+                    continue
+            self.migrated += 1
+            if new_keywords != keywords:
+                self.renamed.add(new_keywords)
+
+    async def merge(self, lock: bool = True):
+        """合并替换后关键词相同的内容"""
+        renamed, self.renamed = self.renamed, set()
+        for keywords in sorted(renamed):
+            async with AsyncExitStack() as stack:
+                if lock and not await _lock_all(stack, (keywords,)):
+                    self.renamed.add(keywords)
+                    continue
+                self.merged += await _merge_duplicates(keywords)
+
+
+async def _migrate_blacklist(mapping: Dict[str, str]) -> int:
+    migrated = 0
+    old_keywords = list(mapping)
+    for i in range(0, len(old_keywords), MIGRATE_BATCH_SIZE):
+        if not (
+            bans := await ChatBlackList.filter(
+                keywords__in=old_keywords[i : i + MIGRATE_BATCH_SIZE]
+            ).values("id", "keywords", "global_ban", "ban_group_id")
+        ):
+            continue
+        async with in_transaction("learning_chat"):
+            await ChatBlackList.filter(id__in=[b.pop("id") for b in bans]).delete()
+            for ban in bans:
+                ban["keywords"] = mapping[ban["keywords"]]
+            await merge_blacklist(bans)
+        migrated += len(bans)
+    return migrated
+
+
+class CorpusIdf:
+    """根据本bot的聊天记录统计IDF，代替jieba内置的通用IDF提取关键词，减少口头禅被当作关键词
+
+    所有群使用同一份IDF。新版本只在语料明显增加时生成，生效前将已学习内容的关键词迁移为新IDF下的结果，
+    保证已学习的内容在各群和生效前后都能匹配。
+    """
+
+    def __init__(self):
+        self.version = 0
+        """当前进程加载的IDF版本"""
+        self.extractor: Optional["jieba_analyse.TFIDF"] = None
+        self.documents: Optional[int] = None
+        """上次统计时的有效语料数量，启动后尚未统计时为None"""
+        self.building = False
+        self._mtime = 0.0
+        """上次读取时生效版本文件的修改时间"""
+
+    @property
+    def pending(self) -> bool:
+        """开启后尚未生效且语料可能已经足够，需要立即统计"""
+        return not self.version and (self.documents is None or self.documents >= MIN_DOCUMENTS)
+
+    @property
+    def stale(self) -> bool:
+        """其他进程已切换了生效的版本，本进程尚未重新加载"""
+        return _active_mtime() != self._mtime
+
+    def refresh(self):
+        """生效的版本变化(包括其他进程迁移完成)时重新加载"""
+        mtime = _active_mtime()
+        if (version := read_active()["version"]) == self.version:
+            self._mtime = mtime
+            return
+        try:
+            extractor = load_extractor(idf_path(version)) if version else None
+        except Exception as e:
+            log_info("群聊学习", f"语料IDF文件<m>{idf_path(version).name}</m>读取<r>失败</r>: {e}")
+            return
+        set_keyword_extractor(extractor)
+        self.version, self.extractor, self._mtime = version, extractor, mtime
+        # 缓存中的关键词是按旧IDF提取的
+        context_cache.clear()
+        keyword_index.clear()
+        reply_targets.clear()
+        log_info(
+            "群聊学习",
+            f"已加载语料IDF<m>{version}</m>" if version else "未使用语料IDF，使用jieba内置的IDF",
+        )
+
+    async def build(self) -> bool:
+        """统计上次之后新增的聊天记录，语料足够且明显增加时生成新版本并迁移关键词，返回是否生成"""
+        if self.building:
+            return False
+        self.building = True
+        try:
+            return await self._build()
+        finally:
+            self.building = False
+
+    async def disable(self):
+        """关闭后将关键词迁移回jieba内置IDF下的结果"""
+        if self.building or not self.version:
+            return
+        self.building = True
+        try:
+            await self._activate(0, 0)
+        finally:
+            self.building = False
+
+    async def _activate(self, version: int, documents: int):
+        start_time = time.perf_counter()
+        new = load_extractor(idf_path(version)) if version else jieba_analyse.default_tfidf
+        mapping = await keyword_mapping(
+            self.extractor or jieba_analyse.default_tfidf, new
+        )
+        # 先在学习继续进行时迁移已有的内容，每条内容迁移时与学习写入互斥
+        migration = Migration(mapping)
+        last_id = await migration.rename()
+        await migration.merge()
+        bans = await _migrate_blacklist(mapping)
+        # 迁移期间学习到的内容仍是旧关键词，暂停学习后补充迁移，再切换版本
+        async with coordinator.pause_learning():
+            skipped, migration.skipped = migration.skipped, []
+            await migration.rename(since=last_id, ids=skipped, lock=False)
+            await migration.merge(lock=False)
+            write_active(version, documents)
+            self.refresh()
+        for path in IDF_DIR.glob("*.txt"):
+            if path != idf_path(version):
+                path.unlink()
+        log_info(
+            "群聊学习",
+            (f"语料IDF<m>{version}</m>已生效" if version else "已停用语料IDF")
+            + f"，迁移了<m>{len(mapping)}</m>个关键词，修改内容<m>{migration.migrated}</m>条，"
+            f"合并内容<m>{migration.merged}</m>条，禁用词<m>{bans}</m>条，"
+            f"耗时<m>{time.perf_counter() - start_time:.1f}s</m>",
+        )
+
+    async def _build(self) -> bool:
+        start_time = time.perf_counter()
+        start_rss = _max_rss()
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(None, DocumentFrequency.load)
+        added = 0
+        while rows := (
+            await ChatMessage.filter(id__gt=state.last_id)
+            .order_by("id")
+            .limit(BATCH_SIZE)
+            .values_list("id", "message", "plain_text")
+        ):
+            # 分词和计数在线程中进行，不阻塞事件循环
+            await loop.run_in_executor(None, state.add_batch, rows)
+            added += len(rows)
+        active = read_active()
+        version = 0
+        if state.documents >= MIN_DOCUMENTS and (
+            not active["version"]
+            or state.documents >= active["documents"] * (1 + REBUILD_GROWTH)
+        ):
+            version = int(time.time())
+            await loop.run_in_executor(None, state.write, idf_path(version))
+        await loop.run_in_executor(None, state.save)
+        self.documents = state.documents
+        end_rss = _max_rss()
+        log_info(
+            "群聊学习",
+            f"语料IDF统计完成：新增<m>{added}</m>条消息，共<m>{state.documents}</m>条有效语料，"
+            f"词表<m>{len(state.words)}</m>个词，"
+            + (
+                "生成新版本，"
+                if version
+                else f"语料不足{MIN_DOCUMENTS}条，暂不生成，"
+                if state.documents < MIN_DOCUMENTS
+                else "语料增加不多，继续使用当前版本，"
+            )
+            + f"耗时<m>{time.perf_counter() - start_time:.1f}s</m>"
+            + ("(NumPy)" if np is not None else "")
+            + (
+                f"，进程内存峰值<m>{end_rss:.0f}MB</m>(增加{end_rss - start_rss:.0f}MB)"
+                if start_rss is not None and end_rss is not None
+                else ""
+            ),
+        )
+        if version:
+            await self._activate(version, state.documents)
+        return bool(version)
+
+
+corpus_idf = CorpusIdf()
+
+
+@driver.on_startup
+async def load_corpus_idf():
+    corpus_idf.refresh()
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from typing import Coroutine, Dict, Optional, Set, Type
+
+from tortoise.models import Model
+from tortoise.queryset import QuerySet
+
+from .models import ChatJob, ChatMessage, ChatContext, ChatAnswer, ChatBlackList
+from .cache import context_cache
+from .reply_target import reply_targets
+from .keyword_index import keyword_index
+from .coordination import coordinator
+from .config import driver, log_info
+
+JOB_MODELS: Dict[str, Type[Model]] = {
+    "message": ChatMessage,
+    "context": ChatContext,
+    "answer": ChatAnswer,
+    "blacklist": ChatBlackList,
+}
+BATCH_SIZE = 1000
+"""每批删除的数量"""
+BATCH_INTERVAL = 0.1
+"""每批之间让出数据库的时间"""
+
+_running: Dict[int, ChatJob] = {}
+_tasks: Set["asyncio.Task[None]"] = set()
+"""后台运行中的协程，事件循环只持有任务的弱引用，需要保留引用避免被回收"""
+
+
+def run_in_background(coro: Coroutine, name: str) -> "asyncio.Task[None]":
+    """在后台运行协程，保留任务引用直到完成，异常退出时记录日志"""
+    task = asyncio.create_task(coro)
+
+    def done(task: "asyncio.Task[None]"):
+        _tasks.discard(task)
+        if not task.cancelled() and (e := task.exception()):
+            log_info("群聊学习", f"后台任务{name}<r>异常退出</r>: {e!r}")
+
+    _tasks.add(task)
+    task.add_done_callback(done)
+    return task
+
+
+def _job_query(job: ChatJob) -> QuerySet:
+    query = JOB_MODELS[job.table].filter(id__lte=job.max_id)
+    if job.context_id:
+        query = query.filter(context_id=job.context_id)
+    return query
+
+
+async def batched_delete(query: QuerySet, job: Optional[ChatJob] = None) -> int:
+    """分批删除查询到的数据，每批之间让出数据库，返回删除的数量"""
+    deleted = 0
+    while job is None or job.status == "running":
+        if not (
+            ids := await query.order_by("id").limit(BATCH_SIZE).values_list("id", flat=True)
+        ):
+            break
+        await query.model.filter(id__in=ids).delete()
+        deleted += len(ids)
+        if job is not None:
+            job.progress += len(ids)
+            await job.save(update_fields=["progress"])
+        await asyncio.sleep(BATCH_INTERVAL)
+    return deleted
+
+
+async def _run_job(job: ChatJob):
+    _running[job.id] = job
+    try:
+        await batched_delete(_job_query(job), job)
+        context_cache.clear()
+        keyword_index.clear()
+        reply_targets.clear()
+        if job.status == "running":
+            job.status = "finished"
+            log_info("群聊学习", f"后台任务<m>{job.id}</m>已完成，共删除<m>{job.progress}</m>条数据")
+    except Exception as e:
+        job.status = "failed"
+        log_info("群聊学习", f"后台任务<m>{job.id}</m><r>执行失败</r>: {e}")
+    finally:
+        await job.save(update_fields=["status"])
+        _running.pop(job.id, None)
+
+
+async def create_delete_job(table: str, context_id: Optional[int] = None) -> ChatJob:
+    """创建一个后台批量删除任务，同一数据表已有进行中的任务时直接返回该任务"""
+    if table not in JOB_MODELS:
+        raise ValueError(f"不支持的数据表{table}")
+    if job := await ChatJob.filter(
+        table=table, context_id=context_id, status="running"
+    ).first():
+        return _running.get(job.id, job)
+    model = JOB_MODELS[table]
+    max_id = (
+        await model.all().order_by("-id").limit(1).values_list("id", flat=True)
+    ) or [0]
+    job = ChatJob(
+        table=table,
+        context_id=context_id,
+        max_id=max_id[0],
+        time=int(time.time()),
+    )
+    job.total = await _job_query(job).count()
+    await job.save()
+    log_info("群聊学习", f"创建后台任务<m>{job.id}</m>，删除<m>{job.total}</m>条{table}数据")
+    run_in_background(_run_job(job), f"<m>{job.id}</m>")
+    return job
+
+
+async def cancel_job(job_id: int) -> bool:
+    """取消进行中的任务，已删除的数据不会恢复"""
+    if job := _running.get(job_id):
+        job.status = "cancelled"
+        return True
+    return bool(
+        await ChatJob.filter(id=job_id, status="running").update(status="cancelled")
+    )
+
+
+def job_to_dict(data: dict) -> dict:
+    """为任务数据补充内存中的最新进度"""
+    if running := _running.get(data["id"]):
+        data.update(status=running.status, progress=running.progress)
+    data["percent"] = (
+        round(data["progress"] / data["total"] * 100, 1) if data["total"] else 100
+    )
+    return data
+
+
+@driver.on_startup
+async def resume_jobs():
+    # 恢复重启前未完成的任务，多进程时只由主进程执行
+    if not await coordinator.is_leader():
+        return
+    for job in await ChatJob.filter(status="running", table__in=list(JOB_MODELS)):
+        if job.id in _running:
+            continue
+        log_info("群聊学习", f"恢复后台任务<m>{job.id}</m>，已完成<m>{job.progress}/{job.total}</m>")
+        run_in_background(_run_job(job), f"<m>{job.id}</m>")
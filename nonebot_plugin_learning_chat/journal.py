@@ -0,0 +1,200 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from nonebot.adapters import Bot
+from nonebot.adapters.onebot.v11 import Message
+from tortoise.transactions import in_transaction
+
+from .models import ChatMessage, ChatReply, ChatAnswer
+from .records import load_messages
+from .text_store import discard_text_ids, save_messages
+from .config import driver
+
+RECENT_SIZE = 20
+"""每个群在内存中保留的最近发送消息数量"""
+RESTORE_SECONDS = 86400
+"""启动时从发送记录中恢复的时长"""
+DEFERRED_BATCH_SIZE = 100
+"""过载时暂缓写入的群友消息达到该数量时一次写入"""
+
+
+class SentMessage:
+    """bot发送过的一条消息"""
+
+    __slots__ = ("group_id", "user_id", "message_id", "message", "answer_id", "time")
+
+    def __init__(
+        self,
+        group_id: int,
+        user_id: int,
+        message_id: int,
+        message: str,
+        answer_id: Optional[int],
+        timestamp: int,
+    ):
+        self.group_id = group_id
+        self.user_id = user_id
+        """发送消息的bot"""
+        self.message_id = message_id
+        self.message = message
+        self.answer_id = answer_id
+        """消息来源的回复id"""
+        self.time = timestamp
+
+    async def keywords(self) -> str:
+        """禁用时使用的关键词，优先使用来源回复的关键词"""
+        if self.answer_id and (
+            answer := await ChatAnswer.filter(id=self.answer_id).first()
+        ):
+            return answer.keywords
+        return ChatMessage(
+            message=self.message, plain_text=Message(self.message).extract_plain_text()
+        ).keywords
+
+
+class ReplyJournal:
+    """bot发送的回复和主动发言记录，按群索引在内存中，并分批写入数据库
+
+    过载或学习限流时群友的消息也在这里暂存，积攒一批后再写入聊天记录
+    """
+
+    def __init__(self):
+        self._recent: Dict[int, Deque[SentMessage]] = {}
+        self._pending: List[SentMessage] = []
+        self._deferred: List[ChatMessage] = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def record(
+        self,
+        group_id: int,
+        user_id: int,
+        message_id: int,
+        message: str,
+        answer_id: Optional[int] = None,
+    ) -> SentMessage:
+        """记录一条已发送的消息，等待下次批量写入"""
+        sent = SentMessage(
+            group_id, user_id, message_id, message, answer_id, int(time.time())
+        )
+        self._recent.setdefault(group_id, deque(maxlen=RECENT_SIZE)).append(sent)
+        self._pending.append(sent)
+        return sent
+
+    def defer(self, message: ChatMessage) -> bool:
+        """暂缓写入一条群友的消息，返回是否已积攒够一批"""
+        self._deferred.append(message)
+        return len(self._deferred) >= DEFERRED_BATCH_SIZE
+
+    def has_pending(self, group_id: int) -> bool:
+        """该群是否有尚未写入的已发送消息"""
+        return any(s.group_id == group_id for s in self._pending)
+
+    def last(self, group_id: int) -> Optional[SentMessage]:
+        """该群最后一条bot发送的消息"""
+        return recent[-1] if (recent := self._recent.get(group_id)) else None
+
+    def find(self, group_id: int, message_id: int) -> Optional[SentMessage]:
+        """在该群最近发送的消息中查找"""
+        for sent in reversed(self._recent.get(group_id, ())):
+            if sent.message_id == message_id:
+                return sent
+        return None
+
+    async def flush(self):
+        """将待写入的消息一次性写入聊天记录和发送记录"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            async with in_transaction("learning_chat"):
+                await save_messages(
+                    [
+                        ChatMessage(
+                            group_id=s.group_id,
+                            user_id=s.user_id,
+                            message_id=s.message_id,
+                            message=s.message,
+                            raw_message=s.message,
+                            plain_text=Message(s.message).extract_plain_text(),
+                            time=s.time,
+                        )
+                        for s in pending
+                    ]
+                )
+                await ChatReply.bulk_create(
+                    [
+                        ChatReply(
+                            group_id=s.group_id,
+                            message_id=s.message_id,
+                            message=s.message,
+                            answer_id=s.answer_id,
+                            time=s.time,
+                        )
+                        for s in pending
+                    ]
+                )
+        except Exception:
+            # 写入失败时放回队列，下次重试，避免丢失bot发送过的消息
+            discard_text_ids()
+            self._pending[:0] = pending
+            raise
+
+    async def flush_deferred(self):
+        """写入暂缓写入的群友消息，失败时留待下次写入"""
+        if not self._deferred:
+            return
+        deferred, self._deferred = self._deferred, []
+        try:
+            await save_messages(deferred)
+        except Exception:
+            discard_text_ids()
+            self._deferred[:0] = deferred
+            raise
+
+    async def restore(self, self_id: int):
+        """从聊天记录中恢复各群最近发送的消息，已在内存中的群不受影响
+
+        发送记录表是后来添加的，升级前bot发送的消息只在聊天记录中，
+        因此以聊天记录中bot自己的消息为准，从发送记录中补充来源回复
+        """
+        since = int(time.time()) - RESTORE_SECONDS
+        answer_ids = {
+            (group_id, message_id): answer_id
+            for group_id, message_id, answer_id in await ChatReply.filter(
+                time__gte=since
+            ).values_list("group_id", "message_id", "answer_id")
+        }
+        restored: Dict[int, Deque[SentMessage]] = {}
+        for message in await load_messages(
+            ChatMessage.filter(user_id=self_id, time__gte=since).order_by("time", "id")
+        ):
+            restored.setdefault(message.group_id, deque(maxlen=RECENT_SIZE)).append(
+                SentMessage(
+                    message.group_id,
+                    self_id,
+                    message.message_id,
+                    message.message,
+                    answer_ids.get((message.group_id, message.message_id)),
+                    message.time,
+                )
+            )
+        for group_id, recent in restored.items():
+            self._recent.setdefault(group_id, recent)
+
+
+reply_journal = ReplyJournal()
+
+
+@driver.on_bot_connect
+async def restore_reply_journal(bot: Bot):
+    await reply_journal.restore(int(bot.self_id))
+
+
+@driver.on_shutdown
+async def flush_reply_journal():
+    await reply_journal.flush()
+    await reply_journal.flush_deferred()
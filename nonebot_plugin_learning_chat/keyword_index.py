@@ -0,0 +1,97 @@
+import asyncio
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from .models import ChatContext
+from .config import log_debug
+
+BUILD_BATCH_SIZE = 5000
+"""构建索引时每批读取的内容数量"""
+
+
+def split_keywords(keywords: str) -> Optional[Tuple[str, ...]]:
+    """内容的关键词元组，关键词不足2个时不参与模糊匹配"""
+    words = tuple(dict.fromkeys(keywords.split(" ")))
+    return words if len(words) >= 2 else None
+
+
+class KeywordIndex:
+    """关键词 -> 内容id的倒排索引，只需遍历含有相同关键词的内容即可找到相似内容"""
+
+    def __init__(self):
+        self._postings: Dict[str, Set[int]] = {}
+        self._contexts: Dict[int, Tuple[str, Tuple[str, ...]]] = {}
+        """内容id -> (内容关键词, 去重后的关键词元组)"""
+        self._lock = asyncio.Lock()
+        self._generation = 0
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def add(self, context_id: int, keywords: str):
+        if context_id in self._contexts or not (words := split_keywords(keywords)):
+            return
+        self._contexts[context_id] = (keywords, words)
+        for word in words:
+            self._postings.setdefault(word, set()).add(context_id)
+
+    def remove(self, context_id: int):
+        for word in self._contexts.pop(context_id, ("", ()))[1]:
+            if (posting := self._postings.get(word)) is not None:
+                posting.discard(context_id)
+                if not posting:
+                    del self._postings[word]
+
+    async def build(self):
+        """分批读取所有内容构建索引"""
+        async with self._lock:
+            if self.ready:
+                return
+            generation = self._generation
+            last_id = 0
+            while contexts := (
+                await ChatContext.filter(id__gt=last_id)
+                .order_by("id")
+                .limit(BUILD_BATCH_SIZE)
+                .values_list("id", "keywords")
+            ):
+                last_id = contexts[-1][0]
+                for context_id, keywords in contexts:
+                    self.add(context_id, keywords)
+                await asyncio.sleep(0)
+            # 构建期间被清空时，下次查询重新构建
+            self.ready = generation == self._generation
+            log_debug(
+                "群聊学习",
+                f"关键词索引构建完成，共<m>{len(self._contexts)}</m>条内容，<m>{len(self._postings)}</m>个关键词",
+            )
+
+    def clear(self):
+        """内容被批量修改后清空，下次查询时重新构建"""
+        self._generation += 1
+        self._postings.clear()
+        self._contexts.clear()
+        self.ready = False
+
+    async def search(
+        self, keyword_list: Sequence[str], threshold: float, limit: int = 5
+    ) -> List[Tuple[str, float]]:
+        """按Jaccard相似度查找最相似的内容，返回(内容关键词, 相似度)列表"""
+        if not self.ready:
+            await self.build()
+        if len(words := set(keyword_list)) < 2:
+            return []
+        overlaps: Dict[int, int] = {}
+        for word in words:
+            for context_id in self._postings.get(word, ()):
+                overlaps[context_id] = overlaps.get(context_id, 0) + 1
+        scores: Dict[str, float] = {}
+        for context_id, overlap in overlaps.items():
+            keywords, context_words = self._contexts[context_id]
+            score = overlap / (len(words) + len(context_words) - overlap)
+            if score >= threshold and score > scores.get(keywords, 0):
+                scores[keywords] = score
+        return sorted(scores.items(), key=lambda r: r[1], reverse=True)[:limit]
+
+
+keyword_index = KeywordIndex()
@@ -0,0 +1,119 @@
+import random
+import time
+from typing import Dict, Tuple
+
+from .config import config_manager, log_info
+
+chat_config = config_manager.config
+
+LATENCY_ALPHA = 0.2
+"""数据库延迟指数移动平均的平滑系数"""
+LATENCY_EXPIRE = 30
+"""超过该秒数没有新的延迟样本时，不再根据延迟判断过载"""
+
+
+class TokenBucket:
+    """令牌桶，每分钟补充rate个令牌，最多积攒rate个"""
+
+    __slots__ = ("rate", "tokens", "last_time")
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last_time = time.monotonic()
+
+    def available(self) -> float:
+        """当前可用的令牌数量，不消耗令牌"""
+        return min(
+            self.rate,
+            self.tokens + (time.monotonic() - self.last_time) * self.rate / 60,
+        )
+
+    def take(self) -> bool:
+        self.tokens = self.available()
+        self.last_time = time.monotonic()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """按群和用途划分的令牌桶，某个群刷屏不会影响其他群"""
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+
+    def allow(self, group_id: int, kind: str, rate: int) -> bool:
+        """rate为每分钟允许的次数，0为不限制"""
+        if rate <= 0:
+            return True
+        bucket = self._buckets.get((group_id, kind))
+        if bucket is None or bucket.rate != rate:
+            bucket = self._buckets[(group_id, kind)] = TokenBucket(rate)
+        return bucket.take()
+
+    def peek(self, group_id: int, kind: str, rate: int) -> bool:
+        """与allow相同，但不消耗次数"""
+        if rate <= 0 or (bucket := self._buckets.get((group_id, kind))) is None:
+            return True
+        return bucket.rate != rate or bucket.available() >= 1
+
+
+class LoadShedder:
+    """根据数据库延迟和正在处理的消息数量判断是否过载，过载时只对部分消息进行学习"""
+
+    def __init__(self):
+        self.latency = 0.0
+        """数据库写入延迟的指数移动平均，单位为秒"""
+        self.latency_time = 0.0
+        self.in_flight = 0
+        """正在处理的消息数量"""
+        self.shedding = False
+        self.skipped = 0
+
+    def record_latency(self, seconds: float):
+        if time.monotonic() - self.latency_time > LATENCY_EXPIRE:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_ALPHA * (seconds - self.latency)
+        self.latency_time = time.monotonic()
+
+    @property
+    def overloaded(self) -> bool:
+        latency_threshold = chat_config.shed_latency / 1000
+        return bool(
+            (
+                latency_threshold > 0
+                and self.latency > latency_threshold
+                and time.monotonic() - self.latency_time <= LATENCY_EXPIRE
+            )
+            or (0 < chat_config.shed_queue_depth <= self.in_flight)
+        )
+
+    def should_learn(self) -> bool:
+        """未过载时总是学习，过载时按采样比例学习"""
+        if (overloaded := self.overloaded) != self.shedding:
+            self.shedding = overloaded
+            log_info(
+                "群聊学习",
+                f"数据库延迟<m>{self.latency * 1000:.0f}ms</m>，正在处理<m>{self.in_flight}</m>条消息，"
+                + ("<r>进入过载模式，暂停部分学习</r>" if overloaded else "已恢复正常学习"),
+            )
+        if not overloaded or random.random() < chat_config.shed_sample_rate:
+            return True
+        self.skipped += 1
+        return False
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "shedding": self.shedding,
+            "latency_ms": round(self.latency * 1000, 1),
+            "in_flight": self.in_flight,
+            "skipped": self.skipped,
+        }
+
+
+rate_limiter = RateLimiter()
+load_shedder = LoadShedder()
@@ -1,14 +1,15 @@
 from nonebot_plugin_tortoise_orm import add_model
+from .config import config_manager
 
 add_model(
     __name__,
     db_name="learning_chat",
-    db_url="sqlite://data/learning_chat/learning_chat.db",
+    db_url=config_manager.database_url,
 )
 
 import functools
 from functools import cached_property
-from typing import List
+from typing import List, Optional
 
 try:
     import ujson as json
@@ -22,7 +23,6 @@ except ImportError:
     import jieba.analyse as jieba_analyse
 from tortoise import fields
 from tortoise.models import Model
-from .config import config_manager
 
 
 config = config_manager.config
@@ -31,7 +31,50 @@ config = config_manager.config
 # DATABASE_PATH.parent.mkdir(parents=True, exist_ok=True)
 JSON_DUMPS = functools.partial(json.dumps, ensure_ascii=False)
 jieba.setLogLevel(jieba.logging.INFO)
-jieba.load_userdict(config.dictionary)  # 加载用户自定义的词典
+# 分词器和用户自定义的词典在启动后于后台加载，见tokenizer.warm_up
+
+
+keyword_extractor: Optional["jieba_analyse.TFIDF"] = None
+"""使用语料IDF的关键词提取器，为None时使用jieba内置的IDF，见idf模块"""
+
+
+def set_keyword_extractor(extractor: Optional["jieba_analyse.TFIDF"]):
+    global keyword_extractor
+    keyword_extractor = extractor
+
+
+def extract_keyword_list(
+    message: str, plain_text: str, extractor: Optional["jieba_analyse.TFIDF"] = None
+) -> List[str]:
+    """获取消息纯文本部分的关键词列表，未指定提取器时使用当前生效的"""
+    if "[CQ:" in message and not len(plain_text):
+        return []
+    extractor = extractor or keyword_extractor or jieba_analyse.default_tfidf
+    return extractor.extract_tags(plain_text, topK=config.KEYWORDS_SIZE)
+
+
+def join_keywords(message: str, plain_text: str, keyword_list: List[str]) -> str:
+    """将关键词列表组合为关键词结果，关键词不足时使用原消息"""
+    if "[CQ:" in message and not len(plain_text):
+        return message
+    return message if len(keyword_list) < 2 else " ".join(keyword_list)
+
+
+def derive_plain_text(message: str, plain_text: str) -> str:
+    """纯文本与消息相同时不会存储，读取时由消息推导"""
+    return plain_text if plain_text or "[CQ:" in message else message
+
+
+class ChatText(Model):
+    id: int = fields.IntField(pk=True, generated=True, auto_increment=True)
+    """自增主键"""
+    hash: str = fields.CharField(max_length=40, unique=True)
+    """文本的sha1"""
+    text: str = fields.TextField()
+    """文本内容"""
+
+    class Meta:
+        table = "text"
 
 
 class ChatMessage(Model):
@@ -44,17 +87,21 @@ class ChatMessage(Model):
     message_id: int = fields.IntField()
     """消息id"""
     message: str = fields.TextField()
-    """消息"""
-    raw_message: str = fields.TextField()
-    """原始消息"""
-    plain_text: str = fields.TextField()
-    """纯文本消息"""
+    """消息，已存入文本表时为空"""
+    raw_message: str = fields.TextField(default="")
+    """原始消息，与消息相同或已存入文本表时为空"""
+    plain_text: str = fields.TextField(default="")
+    """纯文本消息，与消息相同时为空"""
     time: int = fields.IntField()
     """时间戳"""
+    text_id: Optional[int] = fields.IntField(null=True)
+    """原始消息在文本表中的id"""
+    message_text_id: Optional[int] = fields.IntField(null=True)
+    """消息在文本表中的id，没有纯文本的表情和图片消息存入文本表"""
 
     class Meta:
         table = "message"
-        indexes = ("group_id", "time")
+        indexes = (("group_id", "time"), ("message_id",))
         ordering = ["-time"]
 
     @cached_property
@@ -62,21 +109,20 @@ class ChatMessage(Model):
         """是否纯文本"""
         return "[CQ:" not in self.message
 
+    @cached_property
+    def text(self) -> str:
+        """纯文本消息，从数据库读取时可能需要由消息推导"""
+        return derive_plain_text(self.message, self.plain_text)
+
     @cached_property
     def keyword_list(self) -> List[str]:
         """获取纯文本部分的关键词列表"""
-        if not self.is_plain_text and not len(self.plain_text):
-            return []
-        return jieba_analyse.extract_tags(self.plain_text, topK=config.KEYWORDS_SIZE)
+        return extract_keyword_list(self.message, self.text)
 
     @cached_property
     def keywords(self) -> str:
         """获取纯文本部分的关键词结果"""
-        if not self.is_plain_text and not len(self.plain_text):
-            return self.message
-        return (
-            self.message if len(self.keyword_list) < 2 else " ".join(self.keyword_list)
-        )
+        return join_keywords(self.message, self.text, self.keyword_list)
 
 
 class ChatContext(Model):
@@ -137,3 +183,91 @@ class ChatBlackList(Model):
     class Meta:
         table = "blacklist"
         indexes = ("keywords",)
+
+
+class ChatJob(Model):
+    id: int = fields.IntField(pk=True, generated=True, auto_increment=True)
+    """自增主键"""
+    table: str = fields.CharField(max_length=16)
+    """操作的数据表"""
+    context_id: Optional[int] = fields.IntField(null=True)
+    """限定的内容id"""
+    max_id: int = fields.IntField(default=0)
+    """任务创建时的最大id，之后新增的数据不受影响"""
+    status: str = fields.CharField(max_length=16, default="running")
+    """任务状态"""
+    total: int = fields.IntField(default=0)
+    """需处理的总数"""
+    progress: int = fields.IntField(default=0)
+    """已处理的数量"""
+    time: int = fields.IntField()
+    """创建时间戳"""
+
+    class Meta:
+        table = "job"
+        indexes = ("status",)
+        ordering = ["-time"]
+
+
+class ChatReply(Model):
+    id: int = fields.IntField(pk=True, generated=True, auto_increment=True)
+    """自增主键"""
+    group_id: int = fields.IntField()
+    """群id"""
+    message_id: int = fields.IntField()
+    """bot发送的消息id"""
+    message: str = fields.TextField()
+    """发送的消息"""
+    answer_id: Optional[int] = fields.IntField(null=True)
+    """消息来源的回复id，复读等非学习内容为空"""
+    time: int = fields.IntField()
+    """时间戳"""
+
+    class Meta:
+        table = "reply"
+        indexes = ("group_id", "time")
+        ordering = ["-time"]
+
+
+class ChatStat(Model):
+    id: int = fields.IntField(pk=True, generated=True, auto_increment=True)
+    """自增主键"""
+    group_id: int = fields.IntField()
+    """群id"""
+    date: str = fields.CharField(max_length=10)
+    """日期，格式为YYYY-MM-DD"""
+    messages: int = fields.IntField(default=0)
+    """收到的消息数量"""
+    contexts: int = fields.IntField(default=0)
+    """新学习的内容数量"""
+    answers: int = fields.IntField(default=0)
+    """学习回复的次数"""
+    replies: int = fields.IntField(default=0)
+    """回复次数"""
+    repeats: int = fields.IntField(default=0)
+    """复读和打断复读次数"""
+    bans: int = fields.IntField(default=0)
+    """禁用次数"""
+    speeches: int = fields.IntField(default=0)
+    """主动发言次数"""
+
+    class Meta:
+        table = "stat"
+        unique_together = ("group_id", "date")
+        ordering = ["date"]
+
+
+class ChatLease(Model):
+    id: int = fields.IntField(pk=True, generated=True, auto_increment=True)
+    """自增主键"""
+    name: str = fields.CharField(max_length=128, unique=True)
+    """租约名称"""
+    owner: str = fields.CharField(max_length=128)
+    """持有租约的进程"""
+    expire_time: int = fields.IntField()
+    """租约到期时间戳"""
+    version: int = fields.IntField(default=0)
+    """版本号，用于通知配置修改"""
+
+    class Meta:
+        table = "lease"
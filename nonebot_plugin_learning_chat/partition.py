@@ -0,0 +1,283 @@
+import datetime
+import re
+import time
+from typing import Dict, List, Optional, Set, Union
+
+from pypika import Order, Table
+from pypika.functions import Count
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from .models import ChatMessage, ChatReply
+from .jobs import batched_delete
+from .config import config_manager, log_info
+
+chat_config = config_manager.config
+
+HOT_TABLE = ChatMessage._meta.db_table
+PARTITION_PATTERN = re.compile(rf"^{HOT_TABLE}_(\d{{6}})$")
+ARCHIVE_BATCH_SIZE = 2000
+"""每批归档的消息数量"""
+MIN_HOT_SECONDS = 86400
+"""至少保留在当前分区中的时长，保证跨月时最近的消息仍然可以被查询"""
+
+
+def _connection() -> BaseDBAsyncClient:
+    return Tortoise.get_connection("learning_chat")
+
+
+def _quote(conn: BaseDBAsyncClient, name: str) -> str:
+    return f"`{name}`" if conn.capabilities.dialect == "mysql" else f'"{name}"'
+
+
+def _month_start(months_ago: int = 0) -> int:
+    today = datetime.date.today()
+    month = today.year * 12 + today.month - 1 - months_ago
+    return int(time.mktime(datetime.date(month // 12, month % 12 + 1, 1).timetuple()))
+
+
+def partition_name(timestamp: int) -> str:
+    """消息所属的按月分区表名"""
+    return f"{HOT_TABLE}_{datetime.date.fromtimestamp(timestamp):%Y%m}"
+
+
+async def list_partitions() -> List[str]:
+    """已归档的分区表，按月份从新到旧排列"""
+    conn = _connection()
+    dialect = conn.capabilities.dialect
+    if dialect == "sqlite":
+        sql = "SELECT name FROM sqlite_master WHERE type='table'"
+    elif dialect == "postgres":
+        sql = (
+            "SELECT table_name AS name FROM information_schema.tables "
+            "WHERE table_schema = current_schema()"
+        )
+    else:
+        sql = (
+            "SELECT table_name AS name FROM information_schema.tables "
+            "WHERE table_schema = DATABASE()"
+        )
+    names = [
+        row.get("name") or row.get("NAME") or row.get("TABLE_NAME")
+        for row in await conn.execute_query_dict(sql)
+    ]
+    return sorted((n for n in names if n and PARTITION_PATTERN.match(n)), reverse=True)
+
+
+async def _columns(conn: BaseDBAsyncClient, name: str) -> List[str]:
+    if conn.capabilities.dialect == "sqlite":
+        rows = await conn.execute_query_dict(f"PRAGMA table_info({_quote(conn, name)})")
+        return [row["name"] for row in rows]
+    schema = (
+        "current_schema()" if conn.capabilities.dialect == "postgres" else "DATABASE()"
+    )
+    rows = await conn.execute_query_dict(
+        "SELECT column_name AS name FROM information_schema.columns "
+        f"WHERE table_schema = {schema} AND table_name = '{name}'"
+    )
+    return [row.get("name") or row.get("NAME") or row.get("COLUMN_NAME") for row in rows]
+
+
+async def add_message_column(column: str, definition: str) -> List[str]:
+    """为当前分区和所有已归档分区添加缺少的列，保证归档时列顺序一致，返回添加了该列的表"""
+    conn = _connection()
+    altered = []
+    for name in [HOT_TABLE, *await list_partitions()]:
+        if column not in await _columns(conn, name):
+            await conn.execute_script(
+                f"ALTER TABLE {_quote(conn, name)} ADD COLUMN {_quote(conn, column)} {definition}"
+            )
+            altered.append(name)
+    return altered
+
+
+async def add_message_index(*columns: str) -> bool:
+    """旧数据库的当前分区缺少索引时添加，索引名与建表时生成的相同，返回是否添加"""
+    conn = _connection()
+    name = conn.schema_generator(conn)._generate_index_name("idx", ChatMessage, list(columns))
+    dialect = conn.capabilities.dialect
+    if dialect == "sqlite":
+        sql = f"SELECT name FROM sqlite_master WHERE type='index' AND name = '{name}'"
+    elif dialect == "postgres":
+        sql = (
+            "SELECT indexname FROM pg_indexes "
+            f"WHERE schemaname = current_schema() AND indexname = '{name}'"
+        )
+    else:
+        sql = (
+            "SELECT index_name FROM information_schema.statistics "
+            f"WHERE table_schema = DATABASE() AND table_name = '{HOT_TABLE}' "
+            f"AND index_name = '{name}'"
+        )
+    if await conn.execute_query_dict(sql):
+        return False
+    # 归档分区只用于按时间查询，不需要索引
+    await conn.execute_script(
+        f"CREATE INDEX {_quote(conn, name)} ON {_quote(conn, HOT_TABLE)} "
+        f"({', '.join(_quote(conn, column) for column in columns)})"
+    )
+    return True
+
+
+async def read_partition_messages(name: str, last_id: int, limit: int) -> List[dict]:
+    """按id顺序读取分区中原始消息不为空的消息，用于转换旧聊天记录"""
+    conn = _connection()
+    table = Table(name)
+    return await conn.execute_query_dict(
+        conn.query_class.from_(table)
+        .select(table.id, table.message, table.raw_message, table.plain_text)
+        .where((table.id > last_id) & (table.raw_message != ""))
+        .orderby(table.id)
+        .limit(limit)
+        .get_sql()
+    )
+
+
+async def count_partition_messages(name: str) -> int:
+    """分区中原始消息不为空的消息数量"""
+    conn = _connection()
+    table = Table(name)
+    rows = await conn.execute_query_dict(
+        conn.query_class.from_(table)
+        .select(Count("*").as_("total"))
+        .where(table.raw_message != "")
+        .get_sql()
+    )
+    return rows[0]["total"] if rows else 0
+
+
+async def update_partition_messages(name: str, rows: List[dict]):
+    """在一个事务中按id更新分区中的消息"""
+    table = Table(name)
+    async with in_transaction("learning_chat") as conn:
+        for row in rows:
+            query = conn.query_class.update(table).where(table.id == row["id"])
+            for column, value in row.items():
+                if column != "id":
+                    query = query.set(table.field(column), value)
+            await conn.execute_query(query.get_sql())
+
+
+async def distinct_message_values(column: str) -> Set[int]:
+    """当前分区和所有已归档分区中某一列不为空的所有取值"""
+    conn = _connection()
+    values: Set[int] = set()
+    for name in [HOT_TABLE, *await list_partitions()]:
+        table = Table(name)
+        rows = await conn.execute_query_dict(
+            conn.query_class.from_(table)
+            .select(table.field(column).as_("value"))
+            .distinct()
+            .where(table.field(column).notnull())
+            .get_sql()
+        )
+        values.update(row["value"] for row in rows)
+    return values
+
+
+async def _archive_batch(cutoff: int, exists: List[str]) -> int:
+    if not (
+        rows := await ChatMessage.filter(time__lt=cutoff)
+        .order_by("id")
+        .limit(ARCHIVE_BATCH_SIZE)
+        .values_list("id", "time")
+    ):
+        return 0
+    partitions: Dict[str, List[int]] = {}
+    for message_id, timestamp in rows:
+        partitions.setdefault(partition_name(timestamp), []).append(message_id)
+    async with in_transaction("learning_chat") as conn:
+        for name, ids in partitions.items():
+            if name not in exists:
+                await conn.execute_script(
+                    f"CREATE TABLE IF NOT EXISTS {_quote(conn, name)} "
+                    f"AS SELECT * FROM {_quote(conn, HOT_TABLE)} WHERE 1 = 0"
+                )
+                exists.append(name)
+            table, hot = Table(name), Table(HOT_TABLE)
+            await conn.execute_query(
+                conn.query_class.into(table)
+                .from_(hot)
+                .select("*")
+                .where(hot.id.isin(ids))
+                .get_sql()
+            )
+        await ChatMessage.filter(id__in=[r[0] for r in rows]).using_db(conn).delete()
+    return len(rows)
+
+
+async def archive_messages() -> int:
+    """将本月之前的消息分批移动到按月分区表中，返回归档的消息数量"""
+    cutoff = min(_month_start(), int(time.time()) - MIN_HOT_SECONDS)
+    exists = await list_partitions()
+    archived = 0
+    while count := await _archive_batch(cutoff, exists):
+        archived += count
+    if archived:
+        log_info("群聊学习", f"已将<m>{archived}</m>条聊天记录归档至按月分区")
+    return archived
+
+
+async def drop_expired_messages() -> int:
+    """删除超过保留月数的消息，分区表整表删除，返回删除的分区或消息数量"""
+    if chat_config.message_retention_months <= 0:
+        return 0
+    cutoff = _month_start(chat_config.message_retention_months - 1)
+    expired = [
+        name for name in await list_partitions() if name < partition_name(cutoff)
+    ]
+    conn = _connection()
+    for name in expired:
+        await conn.execute_script(f"DROP TABLE IF EXISTS {_quote(conn, name)}")
+        log_info("群聊学习", f"已删除过期的聊天记录分区<m>{name}</m>")
+    # 未分区时或尚未归档的过期消息直接分批删除
+    deleted = await batched_delete(ChatMessage.filter(time__lt=cutoff))
+    deleted += await batched_delete(ChatReply.filter(time__lt=cutoff))
+    if deleted:
+        log_info("群聊学习", f"已删除<m>{deleted}</m>条过期的聊天记录")
+    return len(expired) + deleted
+
+
+async def maintain_messages() -> int:
+    """聊天记录的定期归档和过期清理，返回删除的分区或消息数量"""
+    if chat_config.message_partition_enable:
+        await archive_messages()
+    return await drop_expired_messages()
+
+
+async def query_partition(
+    name: str,
+    page: int,
+    per_page: int,
+    order_by: str,
+    desc: bool,
+    filters: Dict[str, Union[int, str]],
+) -> Optional[dict]:
+    """分页查询已归档分区中的消息，分区不存在时返回None"""
+    if name not in await list_partitions():
+        return None
+    conn = _connection()
+    table = Table(name)
+    query = conn.query_class.from_(table)
+    for field, value in filters.items():
+        if field == "message":
+            # 与text_store.message_search相同，存入文本表的消息只按纯文本搜索
+            query = query.where(
+                table.message.like(f"%{value}%") | table.plain_text.like(f"%{value}%")
+            )
+            continue
+        query = query.where(
+            table.field(field).like(f"%{value}%")
+            if isinstance(value, str)
+            else table.field(field) == value
+        )
+    total = await conn.execute_query_dict(query.select(Count("*").as_("total")).get_sql())
+    items = await conn.execute_query_dict(
+        query.select("*")
+        .orderby(table.field(order_by), order=Order.desc if desc else Order.asc)
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+        .get_sql()
+    )
+    return {"items": items, "total": total[0]["total"] if total else 0}
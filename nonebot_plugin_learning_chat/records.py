@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from tortoise.queryset import QuerySet, QuerySetSingle
+
+from .models import (
+    ChatAnswer,
+    ChatContext,
+    ChatMessage,
+    ChatText,
+    derive_plain_text,
+    extract_keyword_list,
+    join_keywords,
+)
+
+TEXT_CACHE_SIZE = 4096
+"""在内存中缓存的文本数量，常见的表情和图片无需每次查询文本表"""
+
+_texts: "OrderedDict[int, str]" = OrderedDict()
+"""文本id -> 文本，文本表的内容写入后不会修改"""
+
+
+class ContextRecord(NamedTuple):
+    """只读的内容记录，比模型对象占用的内存少得多"""
+
+    id: int
+    keywords: str
+    time: int
+    count: int
+
+
+class AnswerRecord(NamedTuple):
+    """只读的回复记录"""
+
+    id: int
+    keywords: str
+    group_id: int
+    count: int
+    time: int
+    messages: List[str]
+    context_id: Optional[int]
+
+
+class MessageRecord:
+    """只读的聊天记录，关键词在第一次使用时计算"""
+
+    __slots__ = (
+        "id",
+        "group_id",
+        "user_id",
+        "message_id",
+        "message",
+        "plain_text",
+        "time",
+        "_keyword_list",
+        "_keywords",
+    )
+
+    FIELDS = ("id", "group_id", "user_id", "message_id", "message", "plain_text", "time")
+    """从数据库读取的字段，与构造参数的顺序相同"""
+
+    def __init__(
+        self,
+        id: int,
+        group_id: int,
+        user_id: int,
+        message_id: int,
+        message: str,
+        plain_text: str,
+        time: int,
+    ):
+        self.id = id
+        self.group_id = group_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.message = message
+        self.plain_text = plain_text
+        """数据库中存储的纯文本，与消息相同时为空，使用text获取实际的纯文本"""
+        self.time = time
+        self._keyword_list: Optional[List[str]] = None
+        self._keywords: Optional[str] = None
+
+    @property
+    def is_plain_text(self) -> bool:
+        return "[CQ:" not in self.message
+
+    @property
+    def text(self) -> str:
+        return derive_plain_text(self.message, self.plain_text)
+
+    @property
+    def keyword_list(self) -> List[str]:
+        if self._keyword_list is None:
+            self._keyword_list = extract_keyword_list(self.message, self.text)
+        return self._keyword_list
+
+    @property
+    def keywords(self) -> str:
+        if self._keywords is None:
+            self._keywords = join_keywords(self.message, self.text, self.keyword_list)
+        return self._keywords
+
+
+async def load_texts(text_ids: Iterable[int]) -> Dict[int, str]:
+    """读取文本表中的文本，返回文本id -> 文本"""
+    result: Dict[int, str] = {}
+    missing = []
+    for text_id in set(text_ids):
+        if (text := _texts.get(text_id)) is not None:
+            _texts.move_to_end(text_id)
+            result[text_id] = text
+        else:
+            missing.append(text_id)
+    if missing:
+        for text_id, text in await ChatText.filter(id__in=missing).values_list("id", "text"):
+            result[text_id] = _texts[text_id] = text
+        while len(_texts) > TEXT_CACHE_SIZE:
+            _texts.popitem(last=False)
+    return result
+
+
+async def load_contexts(query: "QuerySet[ChatContext]") -> List[ContextRecord]:
+    return list(map(ContextRecord._make, await query.values_list(*ContextRecord._fields)))
+
+
+async def load_context(query: "QuerySetSingle[Optional[ChatContext]]") -> Optional[ContextRecord]:
+    row = await query.values_list(*ContextRecord._fields)
+    return ContextRecord._make(row) if row else None
+
+
+async def load_answers(query: "QuerySet[ChatAnswer]") -> List[AnswerRecord]:
+    return list(map(AnswerRecord._make, await query.values_list(*AnswerRecord._fields)))
+
+
+async def load_messages(query: "QuerySet[ChatMessage]") -> List[MessageRecord]:
+    rows = await query.values_list(*MessageRecord.FIELDS, "message_text_id")
+    texts = await load_texts(row[-1] for row in rows if row[-1])
+    records = []
+    for *fields, message_text_id in rows:
+        record = MessageRecord(*fields)
+        if message_text_id:
+            record.message = texts.get(message_text_id, "")
+        records.append(record)
+    return records
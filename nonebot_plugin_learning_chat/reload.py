@@ -0,0 +1,55 @@
+from .models import ChatContext, ChatAnswer
+from .cache import context_cache
+from .reply_target import reply_targets
+from .tokenizer import update_dictionary
+from .web_cache import page_cache
+from .activity import activity_tracker
+from .coordination import coordinator
+from .config import config_manager, ConfigDiff, log_info
+
+CACHE_FIELDS = {"ban_words", "learn_max_count"}
+"""会影响已缓存回复的全局配置项"""
+
+
+async def apply_config_diff(diff: ConfigDiff):
+    """只对发生变化的配置进行处理"""
+    config = config_manager.config
+    if diff.fields or diff.groups:
+        page_cache.clear()
+    if "dictionary" in diff.fields:
+        await update_dictionary(config.dictionary)
+    if "learn_max_count" in diff.fields:
+        await ChatContext.filter(count__gt=config.learn_max_count).update(
+            count=config.learn_max_count
+        )
+        await ChatAnswer.filter(count__gt=config.learn_max_count).update(
+            count=config.learn_max_count
+        )
+    if "total_enable" in diff.fields:
+        activity_tracker.rearm_all()
+    else:
+        for group_id in diff.groups:
+            activity_tracker.arm(group_id)
+    if diff.fields & CACHE_FIELDS:
+        context_cache.clear()
+    else:
+        for group_id in diff.groups:
+            context_cache.invalidate_group(group_id)
+    if "ban_words" in diff.fields:
+        reply_targets.clear()
+    else:
+        for group_id in diff.groups:
+            reply_targets.invalidate_group(group_id)
+
+
+async def reload_config():
+    """检查配置文件是否被外部修改，有修改时重新加载"""
+    # 其他进程修改配置时，即使文件修改时间没有变化也重新读取
+    if not (diff := config_manager.reload(force=await coordinator.sync_config())):
+        return
+    if diff.fields or diff.groups:
+        log_info(
+            "群聊学习",
+            f"配置文件已重新加载，修改了<m>{len(diff.fields)}</m>项全局配置和<m>{len(diff.groups)}</m>个群的配置",
+        )
+        await apply_config_diff(diff)
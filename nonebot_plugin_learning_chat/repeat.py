@@ -0,0 +1,93 @@
+import time
+from typing import Dict, Optional, Set
+
+from nonebot.adapters import Bot
+
+from .models import ChatMessage
+from .records import load_messages
+from .config import driver, log_debug
+
+REPEAT_TIMEOUT = 3600
+"""超过该时间没有人复读，则视为复读已结束"""
+
+
+class RepeatState:
+    """某个群当前正在连续出现的同一句消息"""
+
+    __slots__ = ("message", "count", "users", "bot_joined", "time")
+
+    def __init__(self, message: str, timestamp: int):
+        self.message = message
+        """正在复读的消息"""
+        self.count = 0
+        """连续出现的次数，包括bot发送的"""
+        self.users: Set[int] = set()
+        """参与复读的群友，不包括bot"""
+        self.bot_joined = False
+        """bot是否已经复读或打断过"""
+        self.time = timestamp
+        """最后一次复读的时间"""
+
+
+class RepeatDetector:
+    """按群维护的复读状态，每条消息O(1)更新，判断复读时无需查询数据库"""
+
+    def __init__(self):
+        self._states: Dict[int, RepeatState] = {}
+
+    def get(self, group_id: int) -> Optional[RepeatState]:
+        return self._states.get(group_id)
+
+    def is_repeat(self, group_id: int, message: str, timestamp: int) -> bool:
+        """该消息是否与群里上一条消息相同"""
+        return bool(
+            (state := self._states.get(group_id))
+            and state.message == message
+            and timestamp - state.time <= REPEAT_TIMEOUT
+        )
+
+    def feed(
+        self,
+        group_id: int,
+        user_id: int,
+        message: str,
+        timestamp: Optional[int] = None,
+        is_bot: bool = False,
+    ) -> RepeatState:
+        """记录群里的一条新消息，返回更新后的复读状态"""
+        timestamp = timestamp or int(time.time())
+        if not self.is_repeat(group_id, message, timestamp):
+            self._states[group_id] = RepeatState(message, timestamp)
+        state = self._states[group_id]
+        state.count += 1
+        state.time = timestamp
+        if is_bot:
+            state.bot_joined = True
+        else:
+            state.users.add(user_id)
+        return state
+
+    async def restore(self, self_id: int):
+        """从最近一小时的聊天记录中恢复各群的复读状态"""
+        self._states.clear()
+        for message in await load_messages(
+            ChatMessage.filter(time__gte=int(time.time()) - REPEAT_TIMEOUT).order_by(
+                "time", "id"
+            )
+        ):
+            self.feed(
+                message.group_id,
+                message.user_id,
+                message.message,
+                message.time,
+                message.user_id == self_id,
+            )
+        log_debug("群聊学习", f"已从聊天记录恢复<m>{len(self._states)}</m>个群的复读状态")
+
+
+repeat_detector = RepeatDetector()
+
+
+@driver.on_bot_connect
+async def restore_repeat_state(bot: Bot):
+    await repeat_detector.restore(int(bot.self_id))
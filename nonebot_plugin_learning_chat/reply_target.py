@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from typing import Optional
+
+from .models import ChatMessage, extract_keyword_list, join_keywords
+from .records import load_messages
+
+RECENT_SIZE = 10000
+"""在内存中保留的最近聊天记录数量，被回复的消息大多在其中"""
+
+
+class ReplyTarget:
+    """被回复的消息，学习和禁用只需要这些字段，关键词在第一次使用时计算"""
+
+    __slots__ = ("group_id", "user_id", "message", "text", "allowed", "_keywords")
+
+    def __init__(
+        self,
+        group_id: int,
+        user_id: int,
+        message: str,
+        text: str,
+        allowed: Optional[bool],
+        keywords: Optional[str] = None,
+    ):
+        self.group_id = group_id
+        self.user_id = user_id
+        self.message = message
+        self.text = text
+        self.allowed = allowed
+        """保存时是否通过校验，为None时需要重新校验"""
+        self._keywords = keywords
+
+    @property
+    def keywords(self) -> str:
+        if self._keywords is None:
+            self._keywords = join_keywords(
+                self.message, self.text, extract_keyword_list(self.message, self.text)
+            )
+        return self._keywords
+
+
+class ReplyTargetResolver:
+    """按消息id查找被回复的消息，最近保存的消息直接从内存中取得，不需要查询数据库和分词"""
+
+    def __init__(self, size: int = RECENT_SIZE):
+        self.size = size
+        self._targets: "OrderedDict[int, ReplyTarget]" = OrderedDict()
+
+    def add(self, message: ChatMessage, allowed: Optional[bool]):
+        """记录刚保存的消息，学习时已经计算过的关键词直接沿用，否则在被回复时才分词"""
+        self._targets[message.message_id] = ReplyTarget(
+            message.group_id,
+            message.user_id,
+            message.message,
+            message.text,
+            allowed,
+            # cached_property计算后保存在实例字典中
+            message.__dict__.get("keywords"),
+        )
+        self._targets.move_to_end(message.message_id)
+        while len(self._targets) > self.size:
+            self._targets.popitem(last=False)
+
+    async def resolve(self, message_id: int) -> Optional[ReplyTarget]:
+        if target := self._targets.get(message_id):
+            return target
+        # 较早的消息通过消息id索引查询
+        if not (
+            records := await load_messages(
+                ChatMessage.filter(message_id=message_id).limit(1)
+            )
+        ):
+            return None
+        record = records[0]
+        return ReplyTarget(record.group_id, record.user_id, record.message, record.text, None)
+
+    def invalidate_keywords(self, keywords: str):
+        """关键词被禁用后，相关消息需要重新校验，尚未分词的消息校验结果与关键词无关"""
+        for target in self._targets.values():
+            if target.allowed is not None and target._keywords == keywords:
+                target.allowed = None
+
+    def invalidate_group(self, group_id: int):
+        """群的屏蔽词修改后，该群的消息需要重新校验"""
+        for target in self._targets.values():
+            if target.group_id == group_id:
+                target.allowed = None
+
+    def discard(self, message_id: int):
+        self._targets.pop(message_id, None)
+
+    def clear(self):
+        self._targets.clear()
+
+
+reply_targets = ReplyTargetResolver()
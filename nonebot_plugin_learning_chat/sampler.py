@@ -0,0 +1,37 @@
+import random
+from typing import Generic, List, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+class AliasSampler(Generic[T]):
+    """Vose别名法加权随机选择，构建O(n)，每次选择O(1)"""
+
+    __slots__ = ("items", "weights", "_prob", "_alias")
+
+    def __init__(self, items: Sequence[T], weights: Sequence[float]):
+        if len(items) != len(weights) or not items:
+            raise ValueError("items和weights长度必须相同且不能为空")
+        self.items: List[T] = list(items)
+        self.weights: List[float] = [max(w, 0.0) for w in weights]
+        n = len(self.items)
+        total = sum(self.weights)
+        scaled = [w * n / total for w in self.weights] if total > 0 else [1.0] * n
+        self._prob = [0.0] * n
+        self._alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, g = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = g
+            scaled[g] -= 1 - scaled[s]
+            (small if scaled[g] < 1 else large).append(g)
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def sample(self) -> T:
+        i = random.randrange(len(self.items))
+        if random.random() >= self._prob[i]:
+            i = self._alias[i]
+        return self.items[i]
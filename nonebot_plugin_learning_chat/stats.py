@@ -0,0 +1,103 @@
+import datetime
+from typing import Dict, List, Optional, Tuple
+
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+
+from .models import ChatStat
+from .config import driver
+
+STAT_FIELDS = {
+    "messages": "消息",
+    "contexts": "新内容",
+    "answers": "学习",
+    "replies": "回复",
+    "repeats": "复读",
+    "bans": "禁用",
+    "speeches": "主动发言",
+}
+"""统计项及其名称"""
+
+
+def _today() -> str:
+    return datetime.date.today().isoformat()
+
+
+class StatCounter:
+    """按群和日期累计的统计，在内存中计数并定期合并写入统计表，查询时无需扫描原始数据"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[int, str], Dict[str, int]] = {}
+
+    def incr(self, group_id: int, field: str, count: int = 1):
+        counts = self._pending.setdefault((group_id, _today()), {})
+        counts[field] = counts.get(field, 0) + count
+
+    async def flush(self):
+        """将内存中的计数累加到统计表"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        async with in_transaction("learning_chat"):
+            for (group_id, date), counts in pending.items():
+                if not await ChatStat.filter(group_id=group_id, date=date).update(
+                    **{field: F(field) + count for field, count in counts.items()}
+                ):
+                    await ChatStat.create(group_id=group_id, date=date, **counts)
+
+    async def query(
+        self, group_id: Optional[int] = None, days: int = 30
+    ) -> Tuple[List[dict], List[dict]]:
+        """返回(每日统计, 各群统计)，包含尚未写入的计数"""
+        start = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+        query = ChatStat.filter(date__gte=start)
+        if group_id:
+            query = query.filter(group_id=group_id)
+        rows = [
+            (row["group_id"], row["date"], row)
+            for row in await query.values("group_id", "date", *STAT_FIELDS)
+        ]
+        rows.extend(
+            (g, date, counts)
+            for (g, date), counts in self._pending.items()
+            if date >= start and (not group_id or g == group_id)
+        )
+        daily: Dict[str, dict] = {}
+        groups: Dict[int, dict] = {}
+        for g, date, counts in rows:
+            day = daily.setdefault(date, {"date": date, **dict.fromkeys(STAT_FIELDS, 0)})
+            group = groups.setdefault(g, {"group_id": g, **dict.fromkeys(STAT_FIELDS, 0)})
+            for field in STAT_FIELDS:
+                day[field] += counts.get(field, 0)
+                group[field] += counts.get(field, 0)
+        return (
+            [daily[date] for date in sorted(daily)],
+            sorted(groups.values(), key=lambda g: g["messages"], reverse=True),
+        )
+
+
+stat_counter = StatCounter()
+
+
+def stats_chart(daily: List[dict]) -> dict:
+    """每日统计的echarts折线图配置"""
+    return {
+        "tooltip": {"trigger": "axis"},
+        "legend": {"data": list(STAT_FIELDS.values())},
+        "xAxis": {"type": "category", "data": [day["date"] for day in daily]},
+        "yAxis": {"type": "value"},
+        "series": [
+            {
+                "name": name,
+                "type": "line",
+                "smooth": True,
+                "data": [day[field] for day in daily],
+            }
+            for field, name in STAT_FIELDS.items()
+        ],
+    }
+
+
+@driver.on_shutdown
+async def flush_stats():
+    await stat_counter.flush()
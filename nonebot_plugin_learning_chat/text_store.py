@@ -0,0 +1,333 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from tortoise.expressions import Q
+
+from .models import ChatJob, ChatMessage, ChatText, derive_plain_text
+from .records import load_texts
+from .partition import (
+    add_message_column,
+    add_message_index,
+    count_partition_messages,
+    distinct_message_values,
+    list_partitions,
+    read_partition_messages,
+    update_partition_messages,
+)
+from .jobs import run_in_background
+from .coordination import coordinator
+from .config import driver, log_info
+
+TEXT_ID_CACHE_SIZE = 4096
+"""在内存中缓存的文本id数量，常见的表情图片无需每次查询文本表"""
+SEEN_MESSAGE_SIZE = 20000
+"""记录最近出现过的表情和图片消息数量"""
+MIGRATE_BATCH_SIZE = 1000
+"""迁移旧聊天记录时每批处理的数量"""
+MIGRATE_INTERVAL = 0.1
+"""迁移每批之间让出数据库的时间"""
+MIGRATE_JOB_TABLE = "text"
+"""记录迁移进度的后台任务的数据表名"""
+
+_text_ids: "OrderedDict[str, int]" = OrderedDict()
+"""文本sha1 -> 文本id"""
+_seen_messages: "OrderedDict[int, None]" = OrderedDict()
+"""最近出现过的表情和图片消息的hash"""
+_migrate_task: "Optional[asyncio.Task[None]]" = None
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+async def intern_texts(texts: Iterable[str]) -> Dict[str, int]:
+    """将文本存入文本表，相同的文本只存一份，返回文本 -> 文本id"""
+    hashes = {text_hash(text): text for text in set(texts)}
+    result: Dict[str, int] = {}
+    for digest, text in hashes.items():
+        if (text_id := _text_ids.get(digest)) is not None:
+            _text_ids.move_to_end(digest)
+            result[text] = text_id
+    if missing := [digest for digest in hashes if hashes[digest] not in result]:
+        found = dict(
+            await ChatText.filter(hash__in=missing).values_list("hash", "id")
+        )
+        if created := [
+            ChatText(hash=digest, text=hashes[digest])
+            for digest in missing
+            if digest not in found
+        ]:
+            # 并发写入相同文本时忽略唯一约束冲突，再查询一次id
+            await ChatText.bulk_create(created, ignore_conflicts=True)
+            found.update(
+                await ChatText.filter(
+                    hash__in=[text.hash for text in created]
+                ).values_list("hash", "id")
+            )
+        for digest, text_id in found.items():
+            result[hashes[digest]] = text_id
+            _text_ids[digest] = text_id
+        while len(_text_ids) > TEXT_ID_CACHE_SIZE:
+            _text_ids.popitem(last=False)
+    return result
+
+
+def discard_text_ids():
+    """写入聊天记录的事务回滚后，缓存中新建文本的id可能已不存在"""
+    _text_ids.clear()
+
+
+class CompactText(NamedTuple):
+    """写入数据库的文本列"""
+
+    message: str
+    raw_message: str
+    plain_text: str
+    text_id: Optional[int]
+    message_text_id: Optional[int]
+
+
+def should_intern_message(message: str, plain_text: str) -> bool:
+    """没有纯文本的表情和图片消息大量重复，可以存入文本表"""
+    return "[CQ:" in message and not plain_text
+
+
+def _seen_before(message: str) -> bool:
+    """记录一条表情或图片消息，返回最近是否出现过
+
+    只发送过一次的图片存入文本表反而更占空间，因此消息再次出现时才存入文本表
+    """
+    key = hash(message)
+    if key in _seen_messages:
+        _seen_messages.move_to_end(key)
+        return True
+    _seen_messages[key] = None
+    while len(_seen_messages) > SEEN_MESSAGE_SIZE:
+        _seen_messages.popitem(last=False)
+    return False
+
+
+def _texts_to_intern(message: str, raw_message: str, plain_text: str) -> List[str]:
+    texts = []
+    if should_intern_message(message, plain_text) and _seen_before(message):
+        texts.append(message)
+    if raw_message and raw_message != message:
+        texts.append(raw_message)
+    return texts
+
+
+def _compact(
+    message: str, raw_message: str, plain_text: str, text_ids: Dict[str, int]
+) -> CompactText:
+    text_id = (
+        text_ids[raw_message] if raw_message and raw_message != message else None
+    )
+    if should_intern_message(message, plain_text) and message in text_ids:
+        return CompactText("", "", "", text_id, text_ids[message])
+    return CompactText(
+        message, "", "" if plain_text == message else plain_text, text_id, None
+    )
+
+
+async def compact_messages(messages: Iterable[ChatMessage]) -> List[ChatMessage]:
+    """生成用于写入数据库的消息：与消息相同的原始消息和纯文本留空，
+    不同的原始消息以及重复出现的表情和图片消息存入文本表"""
+    messages = list(messages)
+    text_ids = await intern_texts(
+        text
+        for m in messages
+        for text in _texts_to_intern(m.message, m.raw_message, m.plain_text)
+    )
+    return [
+        ChatMessage(
+            group_id=m.group_id,
+            user_id=m.user_id,
+            message_id=m.message_id,
+            time=m.time,
+            **_compact(m.message, m.raw_message, m.plain_text, text_ids)._asdict(),
+        )
+        for m in messages
+    ]
+
+
+async def save_messages(messages: Iterable[ChatMessage]):
+    """以去重后的形式写入聊天记录，传入的消息对象保持原样"""
+    if compacted := await compact_messages(messages):
+        await ChatMessage.bulk_create(compacted)
+
+
+async def expand_rows(rows: List[dict]) -> List[dict]:
+    """为查询到的聊天记录补全消息、原始消息和纯文本"""
+    texts = await load_texts(
+        text_id
+        for row in rows
+        for text_id in (row.get("text_id"), row.get("message_text_id"))
+        if text_id
+    )
+    for row in rows:
+        if message_text_id := row.get("message_text_id"):
+            row["message"] = texts.get(message_text_id, "")
+        row["plain_text"] = derive_plain_text(row["message"], row["plain_text"])
+        row["raw_message"] = (
+            texts.get(row.get("text_id")) or row["raw_message"] or row["message"]
+        )
+    return rows
+
+
+async def expand_message(message: ChatMessage) -> ChatMessage:
+    """为从数据库读取的聊天记录补全存入文本表的消息"""
+    if message.message_text_id:
+        texts = await load_texts([message.message_text_id])
+        message.message = texts.get(message.message_text_id, "")
+    return message
+
+
+def message_search(text: str) -> Q:
+    """搜索消息，存入文本表的消息没有纯文本，不参与搜索"""
+    return Q(message__contains=text) | Q(plain_text__contains=text)
+
+
+async def _compact_rows(rows: List[dict]) -> List[dict]:
+    """转换一批旧聊天记录，返回id和需要更新的列"""
+    text_ids = await intern_texts(
+        text
+        for row in rows
+        for text in _texts_to_intern(row["message"], row["raw_message"], row["plain_text"])
+    )
+    return [
+        {
+            "id": row["id"],
+            **_compact(
+                row["message"], row["raw_message"], row["plain_text"], text_ids
+            )._asdict(),
+        }
+        for row in rows
+    ]
+
+
+async def _hot_batch(last_id: int) -> List[dict]:
+    return await (
+        ChatMessage.filter(id__gt=last_id, raw_message__not="")
+        .order_by("id")
+        .limit(MIGRATE_BATCH_SIZE)
+        .values("id", "message", "raw_message", "plain_text")
+    )
+
+
+async def _update_hot(rows: List[dict]):
+    await ChatMessage.bulk_update(
+        [ChatMessage(**row) for row in rows], fields=list(CompactText._fields)
+    )
+
+
+async def migrate_messages() -> int:
+    """将当前分区和已归档分区中的旧聊天记录分批转换为去重存储，返回转换的数量
+
+    进度记录在后台任务表中，完成或被取消后不再扫描聊天记录
+    """
+    job = await ChatJob.filter(table=MIGRATE_JOB_TABLE).order_by("-id").first()
+    if job is not None and job.status in ("finished", "cancelled"):
+        return 0
+    partitions = await list_partitions()
+    if job is None:
+        total = await ChatMessage.filter(raw_message__not="").count()
+        for name in partitions:
+            total += await count_partition_messages(name)
+        job = await ChatJob.create(table=MIGRATE_JOB_TABLE, total=total, time=int(time.time()))
+    migrated = 0
+    tables = [(_hot_batch, _update_hot)] + [
+        (
+            partial(read_partition_messages, name, limit=MIGRATE_BATCH_SIZE),
+            partial(update_partition_messages, name),
+        )
+        for name in partitions
+    ]
+    for read_batch, update_batch in tables:
+        last_id = 0
+        while rows := await read_batch(last_id):
+            last_id = rows[-1]["id"]
+            await update_batch(await _compact_rows(rows))
+            migrated += len(rows)
+            job.progress += len(rows)
+            # 在网页中取消任务后停止转换
+            if not await ChatJob.filter(id=job.id, status="running").update(
+                progress=job.progress
+            ):
+                return migrated
+            await asyncio.sleep(MIGRATE_INTERVAL)
+    await ChatJob.filter(id=job.id, status="running").update(status="finished")
+    return migrated
+
+
+async def remove_orphan_texts() -> int:
+    """删除不再被任何聊天记录引用的文本，返回删除的数量"""
+    max_text_id = await ChatText.all().order_by("-id").limit(1).values_list("id", flat=True)
+    max_message_id = (
+        await ChatMessage.all().order_by("-id").limit(1).values_list("id", flat=True)
+    ) or [0]
+    if not max_text_id:
+        return 0
+    referenced = await distinct_message_values("text_id")
+    referenced |= await distinct_message_values("message_text_id")
+    removed = 0
+    last_id = 0
+    while ids := await (
+        ChatText.filter(id__gt=last_id, id__lte=max_text_id[0])
+        .order_by("id")
+        .limit(MIGRATE_BATCH_SIZE)
+        .values_list("id", flat=True)
+    ):
+        last_id = ids[-1]
+        if not (orphans := [text_id for text_id in ids if text_id not in referenced]):
+            continue
+        # 扫描期间新写入的聊天记录可能引用了这些文本
+        for text_id, message_text_id in await ChatMessage.filter(
+            id__gt=max_message_id[0]
+        ).values_list("text_id", "message_text_id"):
+            referenced.update((text_id, message_text_id))
+        if orphans := [text_id for text_id in orphans if text_id not in referenced]:
+            await ChatText.filter(id__in=orphans).delete()
+            removed += len(orphans)
+        await asyncio.sleep(MIGRATE_INTERVAL)
+    if removed:
+        # 缓存中可能有已删除文本的id
+        discard_text_ids()
+        log_info("群聊学习", f"已删除<m>{removed}</m>条不再被聊天记录引用的文本")
+    return removed
+
+
+async def _migrate_in_background():
+    start_time = time.time()
+    if migrated := await migrate_messages():
+        log_info(
+            "群聊学习",
+            f"已将<m>{migrated}</m>条旧聊天记录转换为去重存储，耗时<m>{time.time() - start_time:.1f}s</m>，"
+            "SQLite数据库可在停止bot后执行VACUUM回收空间",
+        )
+
+
+async def resume_text_migration():
+    """在后台转换旧聊天记录，多进程时只由主进程执行"""
+    global _migrate_task
+    if (_migrate_task is None or _migrate_task.done()) and await coordinator.is_leader():
+        _migrate_task = run_in_background(_migrate_in_background(), "聊天记录文本转换")
+
+
+@driver.on_startup
+async def migrate_text_storage():
+    """旧数据库缺少文本id列和消息id索引时添加，并在后台转换旧聊天记录"""
+    if altered := await add_message_column("text_id", "INT NULL"):
+        log_info("群聊学习", f"已为聊天记录表<m>{', '.join(altered)}</m>添加文本id列")
+    if altered := await add_message_column("message_text_id", "INT NULL"):
+        log_info("群聊学习", f"已为聊天记录表<m>{', '.join(altered)}</m>添加消息文本id列")
+    start_time = time.time()
+    if await add_message_index("message_id"):
+        log_info(
+            "群聊学习",
+            f"已为聊天记录表添加消息id索引，耗时<m>{time.time() - start_time:.1f}s</m>",
+        )
+    await resume_text_migration()
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import pickle
+import re
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Set, Tuple
+
+try:
+    import jieba_fast as jieba
+except ImportError:
+    import jieba
+
+from .config import config_manager, driver, log_debug, log_info
+
+DICTIONARY_CACHE_PATH = Path() / "data" / "learning_chat" / "dictionary.cache"
+"""包含自定义词典的分词前缀词典缓存"""
+
+USERDICT_PATTERN = re.compile(r"^(.+?)( [0-9]+)?( [a-z]+)?$", re.U)
+"""与jieba.load_userdict相同的词典行格式：词语 [词频] [词性]"""
+YIELD_EVERY = 1000
+"""每处理多少个词让出一次事件循环"""
+
+_loaded: Set[str] = set()
+"""当前已加载到分词器中的自定义词典行"""
+
+
+def _parse(line: str) -> Optional[Tuple[str, Optional[int], Optional[str]]]:
+    if not (line := line.strip()) or not (match := USERDICT_PATTERN.match(line)):
+        return None
+    word, freq, tag = match.groups()
+    return word.strip(), int(freq) if freq else None, tag.strip() if tag else None
+
+
+def _diff(dictionary: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+    lines = {line.strip() for line in dictionary if line.strip()}
+    return lines - _loaded, _loaded - lines
+
+
+def _apply(added: Iterable[str], removed: Iterable[str]):
+    for line in removed:
+        if parsed := _parse(line):
+            jieba.del_word(parsed[0])
+        _loaded.discard(line)
+    for line in added:
+        if parsed := _parse(line):
+            jieba.add_word(*parsed)
+        _loaded.add(line)
+
+
+def sync_dictionary(dictionary: Iterable[str]) -> Tuple[int, int]:
+    """同步加载自定义词典，只增删有变化的词，返回(新增数量, 删除数量)"""
+    added, removed = _diff(dictionary)
+    _apply(added, removed)
+    return len(added), len(removed)
+
+
+async def update_dictionary(dictionary: Iterable[str]) -> Tuple[int, int]:
+    """与sync_dictionary相同，但分批处理，避免大量词语变化时阻塞事件循环"""
+    added, removed = _diff(dictionary)
+    removed_list, added_list = list(removed), list(added)
+    for i in range(0, len(removed_list), YIELD_EVERY):
+        _apply((), removed_list[i : i + YIELD_EVERY])
+        await asyncio.sleep(0)
+    for i in range(0, len(added_list), YIELD_EVERY):
+        _apply(added_list[i : i + YIELD_EVERY], ())
+        await asyncio.sleep(0)
+    if added or removed:
+        log_debug(
+            "群聊学习", f"自定义词典已更新，新增<m>{len(added)}</m>个，删除<m>{len(removed)}</m>个"
+        )
+    return len(added), len(removed)
+
+
+def _cache_key(lines: List[str]) -> str:
+    # 未指定主词典时使用jieba内置词典，随版本变化
+    dictionary = jieba.dt.dictionary or ""
+    mtime = Path(dictionary).stat().st_mtime if dictionary else 0
+    key = hashlib.md5(f"{jieba.__version__}|{dictionary}|{mtime}".encode("utf-8"))
+    for line in lines:
+        key.update(line.encode("utf-8"))
+        key.update(b"\n")
+    return key.hexdigest()
+
+
+def _load_cache(key: str, lines: List[str]) -> bool:
+    if not DICTIONARY_CACHE_PATH.is_file():
+        return False
+    try:
+        with DICTIONARY_CACHE_PATH.open("rb") as f:
+            cache_key, freq, total, tags = pickle.load(f)
+    except Exception:
+        return False
+    if cache_key != key:
+        return False
+    with jieba.dt.lock:
+        jieba.dt.FREQ, jieba.dt.total = freq, total
+        jieba.dt.user_word_tag_tab.update(tags)
+        jieba.dt.initialized = True
+    _loaded.update(lines)
+    return True
+
+
+def _dump_cache(key: str):
+    temp_path = DICTIONARY_CACHE_PATH.with_suffix(".tmp")
+    with temp_path.open("wb") as f:
+        pickle.dump(
+            (key, jieba.dt.FREQ, jieba.dt.total, jieba.dt.user_word_tag_tab),
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    temp_path.replace(DICTIONARY_CACHE_PATH)
+
+
+def warm_up(dictionary: Iterable[str]) -> bool:
+    """初始化分词器并加载自定义词典，优先使用缓存，返回是否命中缓存"""
+    lines = sorted({line.strip() for line in dictionary if line.strip()})
+    key = _cache_key(lines)
+    if _load_cache(key, lines):
+        return True
+    jieba.initialize()
+    sync_dictionary(lines)
+    try:
+        _dump_cache(key)
+    except Exception as e:
+        log_info("群聊学习", f"分词词典缓存写入<r>失败</r>: {e}")
+    return False
+
+
+def initialize(dictionary: Iterable[str]):
+    """在当前进程中初始化分词器并同步自定义词典，不读写缓存，用于批量学习的分词进程"""
+    jieba.initialize()
+    sync_dictionary(dictionary)
+
+
+_warm_up_task: Optional["asyncio.Future[bool]"] = None
+
+
+def warm_up_done() -> bool:
+    """后台的分词器初始化是否已结束，未开始初始化时视为已结束"""
+    return _warm_up_task is None or _warm_up_task.done()
+
+
+async def wait_warm_up():
+    """等待后台的分词器初始化结束，初始化失败时不抛出异常"""
+    if _warm_up_task is not None:
+        await asyncio.wait([_warm_up_task])
+
+
+@driver.on_startup
+async def start_warm_up():
+    """在后台线程中初始化分词器，不阻塞启动"""
+    global _warm_up_task
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    _warm_up_task = loop.run_in_executor(
+        None, warm_up, list(config_manager.config.dictionary)
+    )
+
+    def done(task: "asyncio.Future[bool]"):
+        if task.exception():
+            log_info("群聊学习", f"分词器初始化<r>失败</r>: {task.exception()}")
+            return
+        log_info(
+            "群聊学习",
+            f"分词器初始化完成({'使用缓存' if task.result() else '已重建缓存'})，"
+            f"耗时<m>{time.perf_counter() - start_time:.2f}s</m>",
+        )
+
+    _warm_up_task.add_done_callback(done)
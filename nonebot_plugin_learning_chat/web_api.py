@@ -1,23 +1,39 @@
 import datetime
+import time
 from typing import Optional, Union
 
 from fastapi import FastAPI
-from fastapi import Header, HTTPException, Depends
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
+from fastapi import Header, HTTPException, Depends, Request
+from fastapi.responses import (
+    JSONResponse,
+    HTMLResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from jose import jwt
 from nonebot import get_app, get_adapter
 from nonebot.adapters.onebot.v11 import Adapter
 from pydantic import BaseModel
 
-try:
-    import jieba_fast as jieba
-except ImportError:
-    import jieba
-
 from .handler import LearningChat
-from .models import ChatMessage, ChatContext, ChatAnswer, ChatBlackList
-from .config import config_manager, driver
-from .web_page import login_page, admin_app
+from .models import ChatMessage, ChatContext, ChatAnswer, ChatBlackList, ChatJob
+from .cache import context_cache
+from .reply_target import reply_targets
+from .reload import apply_config_diff
+from .limiter import load_shedder
+from .stats import stat_counter, stats_chart
+from .explain import explain
+from .web_cache import page_cache, CompressionMiddleware
+from .corpus import (
+    export_corpus_bytes,
+    import_corpus,
+    read_corpus_file,
+    resolve_import_path,
+)
+from .partition import list_partitions, query_partition
+from .text_store import expand_message, expand_rows, message_search
+from .jobs import create_delete_job, cancel_job, job_to_dict
+from .config import config_manager, driver, log_info
 
 requestAdaptor = """
 requestAdaptor(api) {
@@ -55,6 +71,11 @@ def authentication():
     return Depends(inner)
 
 
+if config_manager.config.enable_web:
+    # 中间件必须在应用启动前添加
+    get_app().add_middleware(CompressionMiddleware)
+
+
 class UserModel(BaseModel):
     username: str
     password: str
@@ -64,6 +85,7 @@ class UserModel(BaseModel):
 async def init_web():
     if not config_manager.config.enable_web:
         return
+    start_time = time.perf_counter()
     app: FastAPI = get_app()
 
     @app.post("/learning_chat/api/login", response_class=JSONResponse)
@@ -143,15 +165,7 @@ async def init_web():
         dependencies=[authentication()],
     )
     async def post_chat_global_config(data: dict):
-        config_manager.config.update(**data)
-        config_manager.save()
-        await ChatContext.filter(
-            count__gt=config_manager.config.learn_max_count
-        ).update(count=config_manager.config.learn_max_count)
-        await ChatAnswer.filter(count__gt=config_manager.config.learn_max_count).update(
-            count=config_manager.config.learn_max_count
-        )
-        jieba.load_userdict(config_manager.config.dictionary)
+        await apply_config_diff(config_manager.update(**data))
         return {"status": 0, "msg": "保存成功"}
 
     @app.get(
@@ -175,6 +189,7 @@ async def init_web():
             ]
             config = config_manager.get_group_config(group_id).dict()
             config["break_probability"] = config["break_probability"] * 100
+            config["fuzzy_threshold"] = config["fuzzy_threshold"] * 100
             config["speak_continuously_probability"] = (
                 config["speak_continuously_probability"] * 100
             )
@@ -193,6 +208,7 @@ async def init_web():
         if not data["answer_threshold_weights"]:
             return {"status": 400, "msg": "回复阈值权重不能为空，必须至少有一个数值"}
         data["break_probability"] = data["break_probability"] / 100
+        data["fuzzy_threshold"] = data["fuzzy_threshold"] / 100
         data["speak_continuously_probability"] = (
             data["speak_continuously_probability"] / 100
         )
@@ -206,11 +222,9 @@ async def init_web():
             if group_id != "all"
             else await bot.get_group_list()
         )
-        for group in groups:
-            config = config_manager.get_group_config(int(group["group_id"]))
-            config.update(**data)
-            config_manager.config.group_config[int(group["group_id"])] = config
-        config_manager.save()
+        await apply_config_diff(
+            config_manager.update_groups([int(g["group_id"]) for g in groups], **data)
+        )
         return {"status": 0, "msg": "保存成功"}
 
     @app.get(
@@ -226,7 +240,31 @@ async def init_web():
         group_id: Optional[str] = None,
         user_id: Optional[str] = None,
         message: Optional[str] = None,
+        partition: Optional[str] = None,
     ):
+        if partition:
+            # 查询已归档的分区
+            if (
+                data := await query_partition(
+                    partition,
+                    page,
+                    perPage,
+                    orderBy or "time",
+                    (orderDir or "desc") != "asc",
+                    {
+                        k: v
+                        for k, v in {
+                            "group_id": int(group_id) if group_id else None,
+                            "user_id": int(user_id) if user_id else None,
+                            "message": message,
+                        }.items()
+                        if v
+                    },
+                )
+            ) is None:
+                return {"status": 500, "msg": f"分区{partition}不存在"}
+            await expand_rows(data["items"])
+            return {"status": 0, "msg": "ok", "data": data}
         orderBy = (
             (orderBy or "time")
             if (orderDir or "desc") == "asc"
@@ -237,20 +275,43 @@ async def init_web():
             for k, v in {
                 "group_id": group_id,
                 "user_id": user_id,
-                "raw_message": message,
             }.items()
             if v
         }
+        query = (
+            ChatMessage.filter(message_search(message), **filter_args)
+            if message
+            else ChatMessage.filter(**filter_args)
+        )
         return {
             "status": 0,
             "msg": "ok",
             "data": {
-                "items": await ChatMessage.filter(**filter_args)
-                .order_by(orderBy)
-                .offset((page - 1) * perPage)
-                .limit(perPage)
-                .values(),
-                "total": await ChatMessage.filter(**filter_args).count(),
+                "items": await expand_rows(
+                    await query.order_by(orderBy)
+                    .offset((page - 1) * perPage)
+                    .limit(perPage)
+                    .values()
+                ),
+                "total": await query.count(),
+            },
+        }
+
+    @app.get(
+        "/learning_chat/api/get_message_partitions",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_message_partitions():
+        return {
+            "status": 0,
+            "msg": "ok",
+            "data": {
+                "options": [{"label": "当前", "value": ""}]
+                + [
+                    {"label": name.rsplit("_", 1)[-1], "value": name}
+                    for name in await list_partitions()
+                ]
             },
         }
 
@@ -368,15 +429,24 @@ async def init_web():
     async def delete_chat(id: int, type: str):
         try:
             if type == "message":
-                await ChatMessage.filter(id=id).delete()
+                m = await ChatMessage.get(id=id)
+                await m.delete()
+                reply_targets.discard(m.message_id)
             elif type == "context":
                 c = await ChatContext.get(id=id)
                 await ChatAnswer.filter(context=c).delete()
                 await c.delete()
+                context_cache.invalidate_context(c.keywords)
             elif type == "answer":
-                await ChatAnswer.filter(id=id).delete()
+                a = await ChatAnswer.get(id=id)
+                await a.delete()
+                context_cache.invalidate_answer(a.keywords)
             elif type == "blacklist":
-                await ChatBlackList.filter(id=id).delete()
+                b = await ChatBlackList.get(id=id)
+                await b.delete()
+                context_cache.invalidate_answer(b.keywords)
+                context_cache.invalidate_context(b.keywords)
+                reply_targets.invalidate_keywords(b.keywords)
             return {"status": 0, "msg": "删除成功"}
         except Exception as e:
             return {"status": 500, "msg": f"删除失败，{e}"}
@@ -389,7 +459,7 @@ async def init_web():
     async def ban_chat(id: int, type: str):
         try:
             if type == "message":
-                data = await ChatMessage.get(id=id)
+                data = await expand_message(await ChatMessage.get(id=id))
             elif type == "context":
                 data = await ChatContext.get(id=id)
             else:
@@ -406,34 +476,159 @@ async def init_web():
     )
     async def delete_all(type: str, id: Optional[int] = None):
         try:
-            if type == "answer":
-                if id:
-                    await ChatAnswer.filter(context_id=id).delete()
-                else:
-                    await ChatAnswer.all().delete()
-            elif type == "blacklist":
-                await ChatBlackList.all().delete()
-            elif type == "context":
-                await ChatContext.all().delete()
-            elif type == "message":
-                await ChatMessage.all().delete()
-            return {"status": 0, "msg": "操作成功"}
+            job = await create_delete_job(type, id if type == "answer" else None)
+            return {
+                "status": 0,
+                "msg": f"已创建后台删除任务，共{job.total}条数据，可在后台任务中查看进度",
+                "data": {"job_id": job.id},
+            }
         except Exception as e:
             return {"status": 500, "msg": f"操作失败，{e}"}
 
+    @app.get(
+        "/learning_chat/api/get_jobs",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_jobs(page: int = 1, perPage: int = 10):
+        return {
+            "status": 0,
+            "msg": "ok",
+            "data": {
+                "items": [
+                    job_to_dict(job)
+                    for job in await ChatJob.all()
+                    .offset((page - 1) * perPage)
+                    .limit(perPage)
+                    .values()
+                ],
+                "total": await ChatJob.all().count(),
+            },
+        }
+
+    @app.put(
+        "/learning_chat/api/cancel_job",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def cancel_job_api(id: int):
+        if await cancel_job(id):
+            return {"status": 0, "msg": "已取消任务"}
+        return {"status": 500, "msg": "任务不存在或已结束"}
+
+    @app.get(
+        "/learning_chat/api/cache_stats",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_cache_stats():
+        return {"status": 0, "msg": "ok", "data": context_cache.stats}
+
+    @app.get(
+        "/learning_chat/api/load_stats",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_load_stats():
+        return {"status": 0, "msg": "ok", "data": load_shedder.stats}
+
+    @app.get(
+        "/learning_chat/api/explain",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def explain_api(
+        group_id: int, message: str, user_id: int = 0, to_me: bool = False
+    ):
+        return {
+            "status": 0,
+            "msg": "ok",
+            "data": await explain(group_id, message, user_id, to_me),
+        }
+
+    @app.get(
+        "/learning_chat/api/stats",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_stats(group_id: Optional[str] = None, days: int = 30):
+        daily, groups = await stat_counter.query(
+            int(group_id) if group_id else None, days
+        )
+        return {
+            "status": 0,
+            "msg": "ok",
+            "data": {"items": groups, "total": len(groups), "daily": daily},
+        }
+
+    @app.get(
+        "/learning_chat/api/stats_chart",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def get_stats_chart(group_id: Optional[str] = None, days: int = 30):
+        daily, _ = await stat_counter.query(int(group_id) if group_id else None, days)
+        return {"status": 0, "msg": "ok", "data": stats_chart(daily)}
+
+    @app.get(
+        "/learning_chat/api/export",
+        dependencies=[authentication()],
+    )
+    async def export_api(compress: bool = True):
+        filename = time.strftime(
+            f"learning_chat_%Y%m%d_%H%M%S.jsonl{'.gz' if compress else ''}"
+        )
+        return StreamingResponse(
+            export_corpus_bytes(compress),
+            media_type="application/gzip" if compress else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+
+    @app.post(
+        "/learning_chat/api/import",
+        response_class=JSONResponse,
+        dependencies=[authentication()],
+    )
+    async def import_api(data: dict):
+        if not (path := resolve_import_path(data.get("path") or "")):
+            return {"status": 500, "msg": f"文件{data.get('path')}不存在或不在数据目录下"}
+        try:
+            result = await import_corpus(read_corpus_file(path))
+        except Exception as e:
+            return {"status": 500, "msg": f"导入失败，{e}"}
+        return {
+            "status": 0,
+            "msg": f"导入成功，新增内容{result['context']}条，回复{result['answer']}条，禁用词{result['blacklist']}条",
+        }
+
     @app.get("/learning_chat", response_class=RedirectResponse)
     async def redirect_page():
         return RedirectResponse("/learning_chat/login")
 
     @app.get("/learning_chat/login", response_class=HTMLResponse)
-    async def login_page_app():
-        return login_page.render(site_title="登录 | Learning-Chat 后台管理", theme="ang")
+    async def login_page_app(request: Request):
+        def render() -> str:
+            # 页面结构在首次访问时才构建
+            from .web_page import login_page
+
+            return login_page.render(
+                site_title="登录 | Learning-Chat 后台管理", theme="ang"
+            )
+
+        return page_cache.response(request, "login", render)
 
     @app.get("/learning_chat/admin", response_class=HTMLResponse)
-    async def admin_page_app():
-        return admin_app.render(
-            site_title="Learning-Chat 后台管理",
-            theme="ang",
-            requestAdaptor=requestAdaptor,
-            responseAdaptor=responseAdaptor,
-        )
+    async def admin_page_app(request: Request):
+        def render() -> str:
+            from .web_page import admin_app
+
+            return admin_app.render(
+                site_title="Learning-Chat 后台管理",
+                theme="ang",
+                requestAdaptor=requestAdaptor,
+                responseAdaptor=responseAdaptor,
+            )
+
+        return page_cache.response(request, "admin", render)
+
+    log_info("群聊学习", f"后台管理接口注册完成，耗时<m>{time.perf_counter() - start_time:.2f}s</m>")
@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+from typing import Callable, Dict, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+COMPRESS_EXCLUDE_PATHS = {"/learning_chat/api/export"}
+"""自行处理压缩的接口"""
+
+
+def _accepted_encodings(request: Request) -> Dict[str, float]:
+    encodings = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if name:
+            encodings[name.strip().lower()] = quality
+    return encodings
+
+
+class RenderedPage:
+    """渲染后的页面及其压缩版本"""
+
+    __slots__ = ("body", "etag", "variants")
+
+    def __init__(self, html: str):
+        self.body = html.encode("utf-8")
+        self.etag = f'"{hashlib.md5(self.body).hexdigest()}"'
+        self.variants: Dict[str, bytes] = {"gzip": gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(self.body)
+
+    def negotiate(self, request: Request) -> Optional[str]:
+        """根据Accept-Encoding选择压缩方式，优先br"""
+        accepted = _accepted_encodings(request)
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+
+class PageCache:
+    """后台管理页面的渲染缓存，配置修改后清空"""
+
+    def __init__(self):
+        self._pages: Dict[str, RenderedPage] = {}
+
+    def get(self, name: str, render: Callable[[], str]) -> RenderedPage:
+        if (page := self._pages.get(name)) is None:
+            page = self._pages[name] = RenderedPage(render())
+        return page
+
+    def response(
+        self, request: Request, name: str, render: Callable[[], str]
+    ) -> Response:
+        page = self.get(name, render)
+        headers = {
+            "ETag": page.etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+        }
+        if request.headers.get("if-none-match") == page.etag:
+            return Response(status_code=304, headers=headers)
+        if encoding := page.negotiate(request):
+            headers["Content-Encoding"] = encoding
+            return Response(
+                page.variants[encoding], media_type="text/html", headers=headers
+            )
+        return Response(page.body, media_type="text/html", headers=headers)
+
+    def clear(self):
+        self._pages.clear()
+
+
+page_cache = PageCache()
+
+
+class CompressionMiddleware:
+    """只对群聊学习的接口进行gzip压缩，不影响其他插件"""
+
+    def __init__(
+        self, app: ASGIApp, prefix: str = "/learning_chat", minimum_size: int = 500
+    ):
+        self.app = app
+        self.prefix = prefix
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=6)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] == "http"
+            and scope["path"].startswith(self.prefix)
+            and scope["path"] not in COMPRESS_EXCLUDE_PATHS
+        ):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
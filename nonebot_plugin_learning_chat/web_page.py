@@ -12,7 +12,7 @@ from amis import (
     AmisAPI,
     Wrapper,
 )
-from amis import LevelEnum, Select, InputArray, Alert, Tpl, Flex
+from amis import LevelEnum, Select, InputArray, Alert, Tpl, Flex, Chart
 
 from .config import NICKNAME
 
@@ -181,6 +181,196 @@ global_config_form = Form(
                 content="添加自定义词语，让分词能够识别未收录的词汇，提高学习的准确性。你可以添加特殊名词，这样学习时就会将该词看作一个整体，目前词典中已默认添加部分原神相关词汇。(回车进行添加)",
             ),
         ),
+        InputNumber(
+            label="每次主动发言最多群数",
+            name="speak_max_groups",
+            value="${speak_max_groups}",
+            visibleOn="${total_enable}",
+            min=0,
+            labelRemark=Remark(
+                shape="circle",
+                content="每次主动发言检查时最多在多少个群发言，按群热度优先，其余群等待下次检查。0为不限制。",
+            ),
+        ),
+        Switch(
+            label="语料IDF开关",
+            name="idf_enable",
+            value="${idf_enable}",
+            visibleOn="${total_enable}",
+            onText="开启",
+            offText="关闭",
+            labelRemark=Remark(
+                shape="circle",
+                content="开启后，每天根据本bot的聊天记录统计词语的常见程度(IDF)，代替通用的IDF提取关键词，群里的口头禅不再容易被当作关键词。所有群使用同一份IDF，聊天记录达到5000条后生效，之后语料增加一半以上时才更新版本。每次生效或关闭时会将已学习内容的关键词迁移为新的提取结果，迁移期间仍使用旧的IDF。安装numpy后统计更快。",
+            ),
+        ),
+        Switch(
+            label="多进程协同",
+            name="multi_worker",
+            value="${multi_worker}",
+            visibleOn="${total_enable}",
+            onText="开启",
+            offText="关闭",
+            labelRemark=Remark(
+                shape="circle",
+                content="多个Bot进程共用同一个数据库时开启，通过数据库中的租约保证定时任务只在一个进程执行、同一条消息只学习一次、同一个群不会重复主动发言，并同步配置修改。",
+            ),
+        ),
+        Switch(
+            label="学习遗忘开关",
+            name="forget_enable",
+            value="${forget_enable}",
+            visibleOn="${total_enable}",
+            onText="开启",
+            offText="关闭",
+            labelRemark=Remark(
+                shape="circle",
+                content="开启后，每天会将长时间没有再学习到的内容和回复的学习次数逐渐减少，低于遗忘下限时删除，避免学习数据无限增长。",
+            ),
+        ),
+        InputNumber(
+            label="内容遗忘周期",
+            name="forget_days",
+            value="${forget_days}",
+            visibleOn="${AND(total_enable, forget_enable)}",
+            min=0,
+            suffix="天",
+            labelRemark=Remark(
+                shape="circle",
+                content="内容每超过该天数没有被学习，学习次数减1，0为不遗忘。各群回复的遗忘周期请在分群配置中设置。",
+            ),
+        ),
+        InputNumber(
+            label="内容遗忘下限",
+            name="forget_min_count",
+            value="${forget_min_count}",
+            visibleOn="${AND(total_enable, forget_enable)}",
+            min=1,
+            labelRemark=Remark(
+                shape="circle", content="超过一个遗忘周期未学习、衰减后次数会低于该值的内容及其所有回复会被删除，最小为1。"
+            ),
+        ),
+        InputNumber(
+            label="过载数据库延迟阈值",
+            name="shed_latency",
+            value="${shed_latency}",
+            visibleOn="${total_enable}",
+            min=0,
+            suffix="毫秒",
+            labelRemark=Remark(
+                shape="circle",
+                content="写入聊天记录的平均耗时超过该值时视为过载，过载时只学习部分消息，回复不受影响，0为不检测。",
+            ),
+        ),
+        InputNumber(
+            label="过载并发消息阈值",
+            name="shed_queue_depth",
+            value="${shed_queue_depth}",
+            visibleOn="${total_enable}",
+            min=0,
+            labelRemark=Remark(
+                shape="circle",
+                content="同时正在处理的消息数量达到该值时视为过载，0为不检测。",
+            ),
+        ),
+        InputNumber(
+            label="过载时学习比例",
+            name="shed_sample_rate",
+            value="${shed_sample_rate}",
+            visibleOn="${total_enable}",
+            min=0,
+            max=1,
+            step=0.05,
+            precision=2,
+            labelRemark=Remark(
+                shape="circle", content="过载时仍然进行学习的消息比例，0为过载时完全不学习。"
+            ),
+        ),
+        InputNumber(
+            label="回复缓存大小",
+            name="cache_size",
+            value="${cache_size}",
+            visibleOn="${total_enable}",
+            min=0,
+            labelRemark=Remark(
+                shape="circle",
+                content="缓存最近用于回复的学习内容数量，减少数据库查询，0为不缓存。",
+            ),
+        ),
+        InputNumber(
+            label="回复缓存有效期",
+            name="cache_ttl",
+            value="${cache_ttl}",
+            visibleOn="${total_enable}",
+            min=0,
+            suffix="秒",
+            labelRemark=Remark(
+                shape="circle", content="缓存的学习内容超过该时间后会重新从数据库读取。"
+            ),
+        ),
+        Switch(
+            label="聊天记录按月分区",
+            name="message_partition_enable",
+            value="${message_partition_enable}",
+            onText="开启",
+            offText="关闭",
+            labelRemark=Remark(
+                shape="circle",
+                content="开启后，每天会将本月之前的聊天记录归档到按月的分区表中，学习和回复只会查询当前的聊天记录表。",
+            ),
+        ),
+        InputNumber(
+            label="聊天记录保留月数",
+            name="message_retention_months",
+            value="${message_retention_months}",
+            min=0,
+            suffix="月",
+            labelRemark=Remark(
+                shape="circle",
+                content="超过该月数的聊天记录会被删除，开启分区时整个分区表会被直接删除，0为永久保留。不影响已学习的内容。",
+            ),
+        ),
+        InputText(
+            label="数据库地址",
+            name="database_url",
+            value="${database_url}",
+            labelRemark=Remark(
+                shape="circle",
+                content="Tortoise ORM格式的数据库地址，默认使用SQLite，也可以使用PostgreSQL(postgres://)或MySQL(mysql://)，修改后需要重启才能生效，且不会迁移原有数据。",
+            ),
+        ),
+        InputNumber(
+            label="数据库连接池大小",
+            name="database_pool_size",
+            value="${database_pool_size}",
+            min=1,
+            visibleOn="${!STARTSWITH(database_url, 'sqlite')}",
+            labelRemark=Remark(
+                shape="circle", content="PostgreSQL或MySQL的最大连接数，修改后需要重启才能生效。"
+            ),
+        ),
+        InputNumber(
+            label="SQLite缓存大小",
+            name="sqlite_cache_size",
+            value="${sqlite_cache_size}",
+            min=2048,
+            suffix="KB",
+            visibleOn="${STARTSWITH(database_url, 'sqlite')}",
+            labelRemark=Remark(
+                shape="circle", content="SQLite的页缓存大小，越大查询越快，但占用内存越多，修改后需要重启才能生效。"
+            ),
+        ),
+        InputNumber(
+            label="SQLite内存映射大小",
+            name="sqlite_mmap_size",
+            value="${sqlite_mmap_size}",
+            min=0,
+            suffix="MB",
+            visibleOn="${STARTSWITH(database_url, 'sqlite')}",
+            labelRemark=Remark(
+                shape="circle", content="SQLite使用内存映射读取数据库文件的大小，0为不使用，修改后需要重启才能生效。"
+            ),
+        ),
     ],
     actions=[
         Action(label="保存", level=LevelEnum.success, type="submit"),
@@ -245,6 +435,28 @@ group_config_form = Form(
             visibleOn="${AND(enable, speak_enable)}",
             labelRemark=Remark(shape="circle", content="达到复读阈值时，打断复读而不是跟随复读的概率。"),
         ),
+        Switch(
+            label="模糊匹配开关",
+            name="fuzzy_match",
+            value="${fuzzy_match}",
+            visibleOn="${enable}",
+            labelRemark=Remark(
+                shape="circle",
+                content="开启后，没有完全相同的已学习内容时，会按关键词相似度寻找最相似的内容进行回复。",
+            ),
+        ),
+        InputNumber(
+            label="模糊匹配相似度",
+            name="fuzzy_threshold",
+            value="${fuzzy_threshold}",
+            min=0,
+            max=100,
+            suffix="%",
+            visibleOn="${AND(enable, fuzzy_match)}",
+            labelRemark=Remark(
+                shape="circle", content="消息与已学习内容的关键词重合比例(Jaccard相似度)达到该值时才会匹配。"
+            ),
+        ),
         InputTag(
             label="屏蔽词",
             name="ban_words",
@@ -325,6 +537,47 @@ group_config_form = Form(
                 shape="circle", content="主动发言时附带戳一戳的概率，会在最近5个发言者中随机选一个戳。"
             ),
         ),
+        InputNumber(
+            label="每分钟最多回复次数",
+            name="reply_rate_limit",
+            value="${reply_rate_limit}",
+            visibleOn="${enable}",
+            min=0,
+            labelRemark=Remark(
+                shape="circle", content="该群每分钟最多进行回复和复读的次数，防止刷屏时频繁回复，0为不限制。"
+            ),
+        ),
+        InputNumber(
+            label="每分钟最多学习次数",
+            name="learn_rate_limit",
+            value="${learn_rate_limit}",
+            visibleOn="${enable}",
+            min=0,
+            labelRemark=Remark(
+                shape="circle",
+                content="该群每分钟最多学习和记录的消息数量，超出的消息不会被学习，但仍然可以触发回复，0为不限制。",
+            ),
+        ),
+        InputNumber(
+            label="回复遗忘周期",
+            name="forget_days",
+            value="${forget_days}",
+            visibleOn="${enable}",
+            min=0,
+            suffix="天",
+            labelRemark=Remark(
+                shape="circle",
+                content="需要在全局配置中开启学习遗忘。该群的回复每超过该天数没有被学习，学习次数减1，0为不遗忘。",
+            ),
+        ),
+        InputNumber(
+            label="回复遗忘下限",
+            name="forget_min_count",
+            value="${forget_min_count}",
+            visibleOn="${enable}",
+            min=1,
+            labelRemark=Remark(shape="circle", content="该群超过一个遗忘周期未学习、衰减后次数会低于该值的回复会被删除，最小为1。"),
+        ),
     ],
     actions=[
         Action(label="保存", level=LevelEnum.success, type="submit"),
@@ -384,6 +637,20 @@ message_table = TableCRUD(
     syncLocation=False,
     api="/learning_chat/api/get_chat_messages",
     interval=12000,
+    filter=Form(
+        title="",
+        mode=DisplayModeEnum.inline,
+        body=[
+            Select(
+                label="分区",
+                name="partition",
+                value="",
+                source="/learning_chat/api/get_message_partitions",
+                labelRemark=Remark(shape="circle", content="查看已按月归档的聊天记录。"),
+            )
+        ],
+        actions=[Action(label="查看", level=LevelEnum.primary, type="submit")],
+    ),
     headerToolbar=[
         ActionType.Ajax(
             label="删除所有聊天记录",
@@ -614,6 +881,38 @@ context_table = TableCRUD(
         TableColumn(label="已学次数", name="count", sortable=True),
     ],
 )
+job_table = TableCRUD(
+    mode="table",
+    title="",
+    syncLocation=False,
+    api="/learning_chat/api/get_jobs",
+    interval=3000,
+    itemActions=[
+        ActionType.Ajax(
+            tooltip="取消",
+            icon="fa fa-stop-circle text-danger",
+            confirmText="取消该后台任务，已删除的数据不会恢复",
+            visibleOn="${status == 'running'}",
+            api="put:/learning_chat/api/cancel_job?id=${id}",
+        )
+    ],
+    footable=True,
+    columns=[
+        TableColumn(label="ID", name="id"),
+        TableColumn(label="数据表", name="table"),
+        TableColumn(label="状态", name="status"),
+        TableColumn(type="progress", label="进度", name="percent"),
+        TableColumn(
+            type="tpl", tpl="${progress}/${total}", label="已处理/总数", name="progress"
+        ),
+        TableColumn(
+            type="tpl",
+            tpl="${time|date:YYYY-MM-DD HH\\:mm\\:ss}",
+            label="创建时间",
+            name="time",
+        ),
+    ],
+)
 
 message_page = PageSchema(
     url="/messages",
@@ -695,10 +994,125 @@ blacklist_page = PageSchema(
         ],
     ),
 )
+job_page = PageSchema(
+    url="/jobs",
+    icon="fa fa-tasks",
+    label="后台任务",
+    schema=Page(
+        title="后台任务",
+        body=[
+            Alert(
+                level=LevelEnum.info,
+                className="white-space-pre-wrap",
+                body="批量删除等耗时操作会在后台分批执行，避免长时间占用数据库。\n"
+                "· 任务在重启后会自动继续。\n"
+                "· 取消任务后，已删除的数据不会恢复。",
+            ),
+            job_table,
+        ],
+    ),
+)
+backup_page = PageSchema(
+    url="/backup",
+    icon="fa fa-download",
+    label="导入导出",
+    schema=Page(
+        title="导入导出",
+        body=[
+            Alert(
+                level=LevelEnum.info,
+                className="white-space-pre-wrap",
+                body=f"可以将{NICKNAME}学习的内容、回复和禁用列表导出为JSONL文件，用于备份或迁移到新的Bot。\n"
+                "· 导出不包含聊天记录。\n"
+                "· 导入时已有的内容和回复会累加次数并合并消息，不会覆盖。\n"
+                "· 也可以由超级用户发送[导出学习数据]和[导入学习数据 文件路径]进行操作。",
+            ),
+            ActionType.Ajax(
+                label="导出学习数据",
+                level=LevelEnum.primary,
+                actionType="download",
+                api="/learning_chat/api/export?compress=true",
+            ),
+            Form(
+                title="导入学习数据",
+                api="post:/learning_chat/api/import",
+                body=[
+                    InputText(
+                        label="文件路径",
+                        name="path",
+                        required=True,
+                        labelRemark=Remark(
+                            shape="circle",
+                            content="导出文件需放在Bot数据目录data/learning_chat下，填写相对该目录的路径，例如export/learning_chat_20240101_000000.jsonl.gz。支持.jsonl和.jsonl.gz文件。",
+                        ),
+                    )
+                ],
+                actions=[Action(label="导入", level=LevelEnum.success, type="submit")],
+            ),
+        ],
+    ),
+)
+stats_group_select = Select(
+    label="群",
+    name="group_id",
+    source="${group_list}",
+    placeholder="全部群",
+    clearable=True,
+)
+stats_chart = Chart(
+    api="/learning_chat/api/stats_chart?group_id=${group_id}&days=30",
+    height=400,
+    interval=60000,
+)
+stats_table = TableCRUD(
+    mode="table",
+    title="",
+    syncLocation=False,
+    api="/learning_chat/api/stats?group_id=${group_id}&days=30",
+    footable=True,
+    columns=[
+        TableColumn(label="群ID", name="group_id", sortable=True),
+        TableColumn(label="消息", name="messages", sortable=True),
+        TableColumn(label="新内容", name="contexts", sortable=True),
+        TableColumn(label="学习", name="answers", sortable=True),
+        TableColumn(label="回复", name="replies", sortable=True),
+        TableColumn(label="复读", name="repeats", sortable=True),
+        TableColumn(label="禁用", name="bans", sortable=True),
+        TableColumn(label="主动发言", name="speeches", sortable=True),
+    ],
+)
+stats_page = PageSchema(
+    url="/stats",
+    icon="fa fa-line-chart",
+    label="统计",
+    schema=Page(
+        title="统计",
+        initApi="/learning_chat/api/get_group_list",
+        body=[
+            Alert(
+                level=LevelEnum.info,
+                className="white-space-pre-wrap",
+                body=f"最近30天各群的消息数量，以及{NICKNAME}的学习、回复、复读、禁用和主动发言次数。\n"
+                "· 统计在收到消息和学习时累计，约每分钟写入一次数据库。\n"
+                "· 统计从更新到此版本后开始记录，不包含之前的数据。",
+            ),
+            stats_group_select,
+            stats_chart,
+            stats_table,
+        ],
+    ),
+)
 database_page = PageSchema(
     label="数据库",
     icon="fa fa-database",
-    children=[message_page, context_page, answer_page, blacklist_page],
+    children=[
+        message_page,
+        context_page,
+        answer_page,
+        blacklist_page,
+        job_page,
+        backup_page,
+    ],
 )
 config_page = PageSchema(
     url="/configs",
@@ -713,7 +1127,9 @@ config_page = PageSchema(
     ),
 )
 chat_page = PageSchema(
-    label="群聊学习", icon="fa fa-wechat (alias)", children=[config_page, database_page]
+    label="群聊学习",
+    icon="fa fa-wechat (alias)",
+    children=[config_page, stats_page, database_page],
 )
 
 github_logo = Tpl(
@@ -728,6 +1144,6 @@ admin_app = App(
     brandName="Learning-Chat",
     logo="http://static.cherishmoon.fun/LittlePaimon/readme/logo.png",
     header=header,
-    pages=[{"children": [config_page, database_page]}],
+    pages=[{"children": [config_page, stats_page, database_page]}],
     footer='<div class="p-2 text-center bg-blue-100">Copyright © 2021 - 2022 <a href="https://github.com/CMHopeSunshine/nonebot-plugin-learning-chat" target="_blank" class="link-secondary">Learning-Chat</a> X<a target="_blank" href="https://github.com/baidu/amis" class="link-secondary" rel="noopener"> amis v2.2.0</a></div>',
 )
@@ -0,0 +1,52 @@
+"""测试共用的启动代码：在临时目录中加载插件，并为每个测试提供独立的事件循环和内存数据库"""
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+T = TypeVar("T")
+
+# 插件的配置文件和默认数据库路径都相对于工作目录
+os.chdir(tempfile.mkdtemp(prefix="learning_chat_test_"))
+sys.path.insert(0, str(ROOT))
+
+import nonebot  # noqa: E402
+from nonebot.adapters.onebot.v11 import Adapter  # noqa: E402
+
+nonebot.init(driver="~fastapi", superusers={"1"}, nickname={"bot"}, log_level="WARNING")
+nonebot.get_driver().register_adapter(Adapter)
+nonebot.load_plugin("nonebot_plugin_learning_chat")
+
+from tortoise import Tortoise  # noqa: E402
+
+TORTOISE_CONFIG = {
+    "connections": {"learning_chat": "sqlite://:memory:"},
+    "apps": {
+        "learning_chat": {
+            "models": ["nonebot_plugin_learning_chat.models"],
+            "default_connection": "learning_chat",
+        }
+    },
+}
+
+
+@pytest.fixture
+def run() -> Iterator[Callable[[Awaitable[T]], T]]:
+    """在测试独占的事件循环中运行协程，数据库连接绑定在该循环上"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db(run: Callable[[Awaitable[T]], T]) -> Iterator[None]:
+    """初始化内存中的SQLite数据库，每个测试都是空的"""
+    run(Tortoise.init(config=TORTOISE_CONFIG))
+    run(Tortoise.generate_schemas())
+    yield
+    run(Tortoise.close_connections())
@@ -0,0 +1,36 @@
+import json
+
+from nonebot_plugin_learning_chat.bulk_learn import _tokenize
+
+
+def _event(message_id: int, group_id: int, text: str, **extra) -> str:
+    event = {
+        "post_type": "message",
+        "message_type": "group",
+        "group_id": group_id,
+        "user_id": 123,
+        "message_id": message_id,
+        "raw_message": text,
+        "time": 1700000000 + message_id,
+        **extra,
+    }
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def test_malformed_lines_are_skipped_and_counted():
+    lines = [
+        _event(1, 2, "今天天气不错"),
+        '{"post_type": "message", 损坏的行\n',
+        json.dumps({"post_type": "message", "message_type": "group"}) + "\n",
+        "\n",
+        _event(2, 1, "[CQ:reply,id=1]出去玩吧"),
+        _event(3, 1, "私聊", message_type="private"),
+    ]
+    invalid, history, keyword_lists = _tokenize(lines)
+
+    assert invalid == 2
+    # 按群和时间排序
+    assert [(m.group_id, m.message_id) for m in history] == [(1, 2), (2, 1)]
+    assert history[0].reply_id == 1
+    assert history[0].message == "出去玩吧"
+    assert len(keyword_lists) == 2
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from nonebot_plugin_learning_chat.cache import ContextCache
+from nonebot_plugin_learning_chat.config import config_manager
+from nonebot_plugin_learning_chat.models import ChatAnswer, ChatContext
+
+
+async def _learn(keywords: str, answer_keywords: str, group_id: int = 1) -> ChatContext:
+    context = await ChatContext.create(keywords=keywords, time=int(time.time()), count=2)
+    await _answer(context, answer_keywords, group_id)
+    return context
+
+
+async def _answer(
+    context: ChatContext, keywords: str, group_id: int = 1, count: int = 3
+) -> ChatAnswer:
+    return await ChatAnswer.create(
+        keywords=keywords,
+        group_id=group_id,
+        count=count,
+        time=int(time.time()),
+        messages=[keywords],
+        context=context,
+    )
+
+
+@pytest.fixture
+def cache() -> ContextCache:
+    return ContextCache()
+
+
+def test_unknown_keywords_are_cached_until_invalidated(run, db, cache):
+    assert run(cache.get("天气 不错")).context is None
+    run(_learn("天气 不错", "出去 玩"))
+    # 未失效前仍返回缓存的结果
+    assert run(cache.get("天气 不错")).context is None
+    assert cache.stats["hits"] == 1
+
+    cache.invalidate_context("天气 不错")
+    entry = run(cache.get("天气 不错"))
+    assert entry.context is not None
+    assert [a.keywords for a in entry.answers] == ["出去 玩"]
+    assert cache.stats["invalidations"] == 1
+
+
+def test_invalidate_answer_drops_every_context_using_it(run, db, cache):
+    run(_learn("天气 不错", "出去 玩"))
+    run(_learn("周末 干嘛", "出去 玩"))
+    run(_learn("吃 什么", "火锅"))
+    for keywords in ("天气 不错", "周末 干嘛", "吃 什么"):
+        run(cache.get(keywords))
+
+    cache.invalidate_answer("不存在的 回复")
+    assert cache.stats["size"] == 3
+    cache.invalidate_answer("出去 玩")
+    assert cache.stats["size"] == 1
+    assert cache.stats["invalidations"] == 2
+
+
+def test_candidates_include_answers_shared_across_groups(run, db, cache):
+    context = run(_learn("天气 不错", "出去 玩"))
+    run(_answer(context, "睡觉", group_id=2))
+    run(_answer(context, "吃饭", group_id=2, count=1))
+    run(_answer(run(_learn("周末 干嘛", "看 电影")), "睡觉", group_id=3))
+
+    entry = run(cache.get("天气 不错"))
+    assert sorted(a.keywords for a in entry.candidates(1, 2, 2)) == ["出去 玩", "睡觉"]
+    # 跨群次数不足时只保留本群的回复
+    assert [a.keywords for a in entry.candidates(1, 2, 3)] == ["出去 玩"]
+
+
+def test_invalidate_group_only_drops_that_groups_samplers(run, db, cache):
+    run(_learn("天气 不错", "出去 玩"))
+    entry = run(cache.get("天气 不错"))
+    entry.samplers[(1, 3, 3)] = None
+    entry.samplers[(2, 3, 3)] = None
+
+    cache.invalidate_group(1)
+    assert list(entry.samplers) == [(2, 3, 3)]
+    assert run(cache.get("天气 不错")) is entry
+
+
+def test_entry_loaded_during_invalidation_is_not_cached(run, db, cache):
+    run(_learn("天气 不错", "出去 玩"))
+    load = cache._load
+
+    async def load_and_invalidate(keywords: str):
+        entry = await load(keywords)
+        # 模拟加载期间其他协程修改了回复
+        cache.invalidate_answer("出去 玩")
+        return entry
+
+    cache._load = load_and_invalidate
+    assert run(cache.get("天气 不错")).context is not None
+    assert cache.stats["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(run, db, cache, monkeypatch):
+    monkeypatch.setattr(config_manager.config, "cache_size", 2)
+    for keywords in ("a b", "c d"):
+        run(cache.get(keywords))
+    run(cache.get("a b"))
+    run(cache.get("e f"))
+
+    assert cache.stats["evictions"] == 1
+    misses = cache.stats["misses"]
+    run(cache.get("a b"))
+    assert cache.stats["misses"] == misses
+    run(cache.get("c d"))
+    assert cache.stats["misses"] == misses + 1
+
+
+def test_clear_forces_reload(run, db, cache):
+    run(_learn("天气 不错", "出去 玩"))
+    run(cache.get("天气 不错"))
+    cache.clear()
+    assert cache.stats["size"] == 0
+    run(cache.get("天气 不错"))
+    assert cache.stats["misses"] == 2
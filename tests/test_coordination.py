@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import time
+
+import pytest
+
+from nonebot_plugin_learning_chat import coordination
+from nonebot_plugin_learning_chat.config import config_manager
+from nonebot_plugin_learning_chat.coordination import Coordinator
+from nonebot_plugin_learning_chat.models import ChatLease
+
+OTHER_WORKER = "other-worker"
+
+
+@pytest.fixture
+def coordinator(monkeypatch) -> Coordinator:
+    monkeypatch.setattr(config_manager.config, "multi_worker", True)
+    return Coordinator()
+
+
+def test_acquire_is_exclusive_until_expiry(run, db, coordinator, monkeypatch):
+    assert run(coordinator.acquire("lease", 30))
+    # 持有者可以续约
+    assert run(coordinator.acquire("lease", 30))
+
+    monkeypatch.setattr(coordination, "WORKER_ID", OTHER_WORKER)
+    assert not run(coordinator.acquire("lease", 30))
+
+    run(ChatLease.filter(name="lease").update(expire_time=int(time.time()) - 1))
+    assert run(coordinator.acquire("lease", 30))
+    assert run(ChatLease.get(name="lease")).owner == OTHER_WORKER
+
+
+def test_release_lets_others_acquire(run, db, coordinator, monkeypatch):
+    assert run(coordinator.acquire("lease", 30))
+    monkeypatch.setattr(coordination, "WORKER_ID", OTHER_WORKER)
+    # 非持有者释放不影响租约
+    run(coordinator.release("lease"))
+    assert not run(coordinator.acquire("lease", 30))
+
+    monkeypatch.undo()
+    run(coordinator.release("lease"))
+    monkeypatch.setattr(coordination, "WORKER_ID", OTHER_WORKER)
+    assert run(coordinator.acquire("lease", 30))
+
+
+def test_concurrent_acquire_has_single_winner(run, db, coordinator):
+    async def contend():
+        # 两个进程同时发现租约不存在并尝试创建，只有一个能成功
+        await ChatLease.create(name="lease", owner=OTHER_WORKER, expire_time=int(time.time()) + 30)
+        return await coordinator.acquire("lease", 30)
+
+    assert not run(contend())
+    assert run(ChatLease.filter(name="lease").count()) == 1
+
+
+def test_claim_is_always_granted_without_multi_worker(run, db, monkeypatch):
+    monkeypatch.setattr(config_manager.config, "multi_worker", False)
+    coordinator = Coordinator()
+    run(ChatLease.create(name="speak", owner=OTHER_WORKER, expire_time=int(time.time()) + 30))
+    assert run(coordinator.claim("speak", 30))
+    assert run(coordinator.is_leader())
+
+
+def test_claim_message_only_once(run, db, coordinator):
+    assert run(coordinator.claim_message(1, 100))
+    assert not run(coordinator.claim_message(1, 100))
+    assert run(coordinator.claim_message(2, 100))
+
+
+def test_claim_message_across_workers(run, db, coordinator, monkeypatch):
+    assert run(coordinator.claim_message(1, 100))
+    # 其他进程的内存中没有记录，由数据库中的租约识别
+    monkeypatch.setattr(coordination, "WORKER_ID", OTHER_WORKER)
+    assert not run(Coordinator().claim_message(1, 100))
+    assert run(Coordinator().claim_message(1, 101))
+
+
+def test_learn_lock_serializes_same_keywords(run, db, coordinator):
+    events = []
+
+    async def learn(name: str, keywords: str):
+        async with coordinator.learn_lock(keywords) as locked:
+            assert locked
+            events.append(f"{name}+")
+            await asyncio.sleep(0.05)
+            events.append(f"{name}-")
+
+    async def contend():
+        await asyncio.gather(
+            learn("a", "天气 不错"), learn("b", "天气 不错"), learn("c", "吃 什么")
+        )
+
+    run(contend())
+    assert events.index("a-") < events.index("b+")
+    assert events.index("c+") < events.index("a-")
+    assert not coordinator._locks and not coordinator._lock_users
+    assert run(ChatLease.filter(expire_time__gt=0).count()) == 0
+
+
+def test_learn_lock_gives_up_when_held_elsewhere(run, db, coordinator, monkeypatch):
+    monkeypatch.setattr(coordination, "LEARN_LOCK_TTL", 1)
+    name = f"learn:{hashlib.md5('天气 不错'.encode()).hexdigest()}"
+    run(ChatLease.create(name=name, owner=OTHER_WORKER, expire_time=int(time.time()) + 30))
+
+    async def learn() -> bool:
+        async with coordinator.learn_lock("天气 不错") as locked:
+            return locked
+
+    assert not run(learn())
+    # 其他进程释放后可以获得
+    run(ChatLease.filter(name=name).update(expire_time=0))
+    assert run(learn())
+
+
+def test_pause_learning_waits_for_writes_and_blocks_new_ones(run, db, coordinator):
+    events = []
+
+    async def learn(name: str, delay: float):
+        await asyncio.sleep(delay)
+        async with coordinator.learn_lock(name):
+            events.append(f"{name}+")
+            await asyncio.sleep(0.05)
+            events.append(f"{name}-")
+
+    async def pause():
+        await asyncio.sleep(0.01)
+        async with coordinator.pause_learning():
+            events.append("pause+")
+            await asyncio.sleep(0.1)
+            events.append("pause-")
+
+    async def contend():
+        await asyncio.gather(learn("a", 0), pause(), learn("b", 0.02))
+
+    run(contend())
+    assert events == ["a+", "a-", "pause+", "pause-", "b+", "b-"]
+    assert run(ChatLease.get(name=coordination.LEARN_PAUSE)).expire_time == 0
+
+
+def test_learn_lock_gives_up_while_paused_elsewhere(run, db, coordinator, monkeypatch):
+    monkeypatch.setattr(coordination, "LEARN_LOCK_TTL", 1)
+    run(
+        ChatLease.create(
+            name=coordination.LEARN_PAUSE, owner=OTHER_WORKER, expire_time=int(time.time()) + 30
+        )
+    )
+
+    async def learn() -> bool:
+        async with coordinator.learn_lock("天气 不错") as locked:
+            return locked
+
+    assert not run(learn())
+    # 放弃时释放了已获得的学习锁
+    assert run(ChatLease.filter(name__startswith="learn:", expire_time__gt=0).count()) == 0
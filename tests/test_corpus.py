@@ -0,0 +1,46 @@
+import gzip
+import json
+
+from nonebot_plugin_learning_chat import corpus
+from nonebot_plugin_learning_chat.corpus import import_corpus, read_corpus_file
+from nonebot_plugin_learning_chat.models import ChatAnswer, ChatBlackList, ChatContext
+
+
+def _lines(contexts: int) -> list:
+    lines = [{"type": "meta", "version": 1, "time": 0}]
+    lines += [
+        {
+            "type": "context",
+            "keywords": f"内容{i}",
+            "time": 1,
+            "count": 1,
+            "answers": [
+                {"keywords": "回复", "group_id": 1, "count": 1, "time": 1, "messages": ["回复"]}
+            ],
+        }
+        for i in range(contexts)
+    ]
+    lines.append({"type": "blacklist", "keywords": "坏话", "global_ban": False, "ban_group_id": [1]})
+    return [json.dumps(line, ensure_ascii=False) + "\n" for line in lines]
+
+
+def test_gzip_file_is_read_in_batches(run, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(corpus, "BATCH_SIZE", 2)
+    path = tmp_path / "corpus.jsonl.gz"
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.writelines(_lines(5))
+
+    result = run(import_corpus(read_corpus_file(path)))
+    assert result == {"context": 5, "answer": 5, "blacklist": 1}
+    assert run(ChatContext.all().count()) == 5
+    assert run(ChatAnswer.all().count()) == 5
+    assert run(ChatBlackList.get(keywords="坏话")).ban_group_id == [1]
+
+
+def test_plain_file_import_merges_counts(run, db, tmp_path):
+    path = tmp_path / "corpus.jsonl"
+    path.write_text("".join(_lines(1)), encoding="utf-8")
+
+    run(import_corpus(read_corpus_file(path)))
+    assert run(import_corpus(read_corpus_file(path))) == {"context": 0, "answer": 0, "blacklist": 0}
+    assert run(ChatContext.get(keywords="内容0")).count == 2
@@ -0,0 +1,78 @@
+import time
+
+from nonebot_plugin_learning_chat.config import ChatGroupConfig
+from nonebot_plugin_learning_chat.decay import _forget
+from nonebot_plugin_learning_chat.models import ChatContext
+
+DAY = 86400
+
+
+def _config(forget_days: int = 30, forget_min_count: int = 1) -> ChatGroupConfig:
+    config = ChatGroupConfig()
+    config.update(forget_days=forget_days, forget_min_count=forget_min_count)
+    return config
+
+
+async def _create(keywords: str, count: int, days_ago: int) -> ChatContext:
+    return await ChatContext.create(
+        keywords=keywords, count=count, time=int(time.time()) - days_ago * DAY
+    )
+
+
+async def _counts() -> dict:
+    return dict(await ChatContext.all().values_list("keywords", "count"))
+
+
+def test_stale_rows_decay_and_move_forward_one_period(run, db):
+    stale = run(_create("stale", 3, 40))
+    run(_create("fresh", 3, 1))
+
+    assert run(_forget(ChatContext, {}, _config())) == {"decayed": 1, "evicted": 0}
+    assert run(_counts()) == {"stale": 2, "fresh": 3}
+    decayed = run(ChatContext.get(id=stale.id))
+    assert decayed.time == stale.time + 30 * DAY
+
+
+def test_rows_falling_below_floor_are_deleted(run, db):
+    run(_create("stale once", 1, 40))
+    run(_create("stale twice", 2, 40))
+    run(_create("stale often", 3, 40))
+
+    result = run(_forget(ChatContext, {}, _config(forget_min_count=2)))
+    assert result == {"decayed": 1, "evicted": 2}
+    assert run(_counts()) == {"stale often": 2}
+
+
+def test_recently_learned_rows_below_floor_are_kept(run, db):
+    run(_create("learned an hour ago", 1, 0))
+    run(_create("learned yesterday", 2, 1))
+
+    result = run(_forget(ChatContext, {}, _config(forget_min_count=3)))
+    assert result == {"decayed": 0, "evicted": 0}
+    assert run(_counts()) == {"learned an hour ago": 1, "learned yesterday": 2}
+
+
+def test_zero_floor_never_leaves_zero_counts(run, db):
+    run(_create("once", 1, 40))
+    run(_create("twice", 2, 100))
+
+    for _ in range(5):
+        run(_forget(ChatContext, {}, _config(forget_min_count=0)))
+        assert all(count >= 1 for count in run(_counts()).values())
+    assert "once" not in run(_counts())
+
+
+def test_disabled_forgetting_changes_nothing(run, db):
+    run(_create("stale", 1, 400))
+    assert run(_forget(ChatContext, {}, _config(forget_days=0))) == {
+        "decayed": 0,
+        "evicted": 0,
+    }
+    assert run(_counts()) == {"stale": 1}
+
+
+def test_filters_limit_forgetting(run, db):
+    run(_create("kept", 1, 40))
+    run(_create("forgotten", 1, 40))
+    run(_forget(ChatContext, {"keywords": "forgotten"}, _config()))
+    assert run(_counts()) == {"kept": 1}
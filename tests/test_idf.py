@@ -0,0 +1,98 @@
+import time
+
+from nonebot_plugin_learning_chat.idf import Migration
+from nonebot_plugin_learning_chat.models import ChatAnswer, ChatContext, ChatJob, ChatReply
+
+
+async def _learn(keywords: str, answers: dict, count: int = 1) -> ChatContext:
+    """answers: 回复关键词 -> 群id"""
+    now = int(time.time())
+    context = await ChatContext.create(keywords=keywords, time=now, count=count)
+    for answer_keywords, group_id in answers.items():
+        await ChatAnswer.create(
+            keywords=answer_keywords,
+            group_id=group_id,
+            count=2,
+            time=now,
+            messages=[answer_keywords],
+            context=context,
+        )
+    return context
+
+
+async def _migrate(mapping: dict) -> Migration:
+    migration = Migration(mapping)
+    await migration.rename()
+    await migration.merge()
+    return migration
+
+
+async def _contexts() -> dict:
+    return {
+        c.id: (c.keywords, c.count, sorted((a.keywords, a.group_id) for a in c.answers))
+        for c in await ChatContext.all().prefetch_related("answers")
+    }
+
+
+def test_keywords_are_replaced_in_place(run, db):
+    context = run(_learn("天气 不错", {"出去 玩": 1}))
+    answer = run(ChatAnswer.get(context_id=context.id))
+    run(ChatReply.create(group_id=1, message_id=1, message="出去玩", answer_id=answer.id, time=0))
+
+    migration = run(_migrate({"天气 不错": "不错 天气", "出去 玩": "玩 出去"}))
+    assert migration.migrated == 1
+    assert run(_contexts()) == {context.id: ("不错 天气", 1, [("玩 出去", 1)])}
+    # 发送记录仍指向原来的回复
+    assert run(ChatAnswer.get(id=answer.id)).keywords == "玩 出去"
+
+
+def test_swapped_keywords_do_not_merge(run, db):
+    a = run(_learn("天气 不错", {"出去 玩": 1}))
+    b = run(_learn("不错 天气", {"睡觉": 1}))
+    migration = run(_migrate({"天气 不错": "不错 天气", "不错 天气": "天气 不错"}))
+    assert migration.merged == 0
+    assert run(_contexts()) == {
+        a.id: ("不错 天气", 1, [("出去 玩", 1)]),
+        b.id: ("天气 不错", 1, [("睡觉", 1)]),
+    }
+
+
+def test_colliding_contexts_merge_into_the_oldest_row(run, db):
+    kept = run(_learn("天气 不错", {"出去 玩": 1, "睡觉": 2}, count=2))
+    merged = run(_learn("今天 天气 不错", {"出去 玩": 1, "吃饭": 1}, count=3))
+    duplicate = run(ChatAnswer.get(context_id=merged.id, keywords="出去 玩"))
+    target = run(ChatAnswer.get(context_id=kept.id, keywords="出去 玩"))
+    run(ChatReply.create(group_id=1, message_id=1, message="出去玩", answer_id=duplicate.id, time=0))
+    run(ChatJob.create(table="answer", context_id=merged.id, time=0))
+
+    migration = run(_migrate({"今天 天气 不错": "天气 不错"}))
+    assert (migration.migrated, migration.merged) == (1, 1)
+    assert run(_contexts()) == {
+        kept.id: ("天气 不错", 5, [("出去 玩", 1), ("吃饭", 1), ("睡觉", 2)])
+    }
+    assert run(ChatAnswer.get(id=target.id)).count == 4
+    assert run(ChatReply.get(message_id=1)).answer_id == target.id
+    assert run(ChatJob.first()).context_id == kept.id
+
+
+def test_answers_becoming_equal_are_merged(run, db):
+    context = run(_learn("天气 不错", {"出去 玩": 1, "玩 出去": 1}))
+    run(_migrate({"玩 出去": "出去 玩"}))
+    assert run(_contexts()) == {context.id: ("天气 不错", 1, [("出去 玩", 1)])}
+    answer = run(ChatAnswer.get(context_id=context.id))
+    assert (answer.count, answer.messages) == (4, ["出去 玩", "玩 出去"])
+
+
+def test_contexts_learned_during_migration_are_rescanned(run, db):
+    async def migrate():
+        await _learn("天气 不错", {})
+        migration = Migration({"天气 不错": "不错 天气", "出去 玩": "玩 出去"})
+        last_id = await migration.rename()
+        # 迁移期间按旧关键词学习到的内容
+        learned = await _learn("出去 玩", {"天气 不错": 1})
+        await migration.rename(since=last_id, lock=False)
+        await migration.merge(lock=False)
+        return learned
+
+    learned = run(migrate())
+    assert run(_contexts())[learned.id] == ("玩 出去", 1, [("不错 天气", 1)])
@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import pytest
+
+from nonebot_plugin_learning_chat import coordination, jobs
+from nonebot_plugin_learning_chat.config import config_manager
+from nonebot_plugin_learning_chat.jobs import (
+    batched_delete,
+    cancel_job,
+    create_delete_job,
+    resume_jobs,
+)
+from nonebot_plugin_learning_chat.models import ChatContext, ChatJob, ChatLease
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(jobs, "BATCH_SIZE", 2)
+    monkeypatch.setattr(jobs, "BATCH_INTERVAL", 0)
+
+
+async def _create(*keywords: str):
+    await ChatContext.bulk_create(
+        [ChatContext(keywords=k, time=int(time.time())) for k in keywords]
+    )
+
+
+async def _keywords() -> list:
+    return await ChatContext.all().order_by("id").values_list("keywords", flat=True)
+
+
+async def _wait(job_id: int) -> ChatJob:
+    while (job := await ChatJob.get(id=job_id)).status == "running" or job.id in jobs._running:
+        await asyncio.sleep(0.01)
+    return job
+
+
+def test_batched_delete_only_deletes_matching_rows(run, db):
+    run(_create("a", "b", "c", "d", "e", "kept"))
+    query = ChatContext.filter(keywords__in=["a", "b", "c", "d", "e"])
+    assert run(batched_delete(query)) == 5
+    assert run(_keywords()) == ["kept"]
+
+
+def test_job_leaves_rows_created_after_it(run, db):
+    async def delete_while_learning():
+        await _create("a", "b", "c")
+        job = await create_delete_job("context")
+        # 任务创建后新学习的内容不受影响
+        await _create("new")
+        return await _wait(job.id)
+
+    job = run(delete_while_learning())
+    assert (job.status, job.total, job.progress) == ("finished", 3, 3)
+    assert run(_keywords()) == ["new"]
+
+
+def test_running_job_is_reused(run, db):
+    async def create_twice():
+        await _create("a", "b", "c")
+        first = await create_delete_job("context")
+        second = await create_delete_job("context")
+        await _wait(first.id)
+        return first, second
+
+    first, second = run(create_twice())
+    assert first.id == second.id
+    assert run(ChatJob.all().count()) == 1
+
+
+def test_unknown_table_is_rejected(run, db):
+    with pytest.raises(ValueError):
+        run(create_delete_job("config"))
+
+
+def test_cancel_stops_between_batches(run, db, monkeypatch):
+    monkeypatch.setattr(jobs, "BATCH_INTERVAL", 0.05)
+
+    async def create_and_cancel():
+        await _create("a", "b", "c", "d", "e", "f")
+        job = await create_delete_job("context")
+        while not job.progress:
+            await asyncio.sleep(0.001)
+        assert await cancel_job(job.id)
+        return await _wait(job.id)
+
+    job = run(create_and_cancel())
+    assert job.status == "cancelled"
+    assert job.progress < 6
+    assert len(run(_keywords())) == 6 - job.progress
+    assert not run(cancel_job(job.id))
+
+
+def test_resume_continues_unfinished_jobs(run, db):
+    async def resume():
+        await _create("a", "b", "c", "d", "e")
+        # 重启前已经删除了一批
+        await ChatContext.filter(keywords__in=["a", "b"]).delete()
+        job = await ChatJob.create(
+            table="context", max_id=5, total=5, progress=2, time=int(time.time())
+        )
+        await _create("new")
+        await resume_jobs()
+        return await _wait(job.id)
+
+    job = run(resume())
+    assert (job.status, job.progress) == ("finished", 5)
+    assert run(_keywords()) == ["new"]
+
+
+def test_only_leader_resumes_jobs(run, db, monkeypatch):
+    monkeypatch.setattr(config_manager.config, "multi_worker", True)
+    monkeypatch.setattr(coordination.coordinator, "leader", False)
+
+    async def resume():
+        await _create("a", "b")
+        await ChatLease.create(
+            name=coordination.LEADER_LEASE,
+            owner="other-worker",
+            expire_time=int(time.time()) + 30,
+        )
+        job = await ChatJob.create(table="context", max_id=2, total=2, time=int(time.time()))
+        await resume_jobs()
+        await asyncio.sleep(0.05)
+        return job
+
+    job = run(resume())
+    assert not jobs._running
+    assert run(ChatJob.get(id=job.id)).status == "running"
+    assert run(_keywords()) == ["a", "b"]
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from nonebot_plugin_learning_chat.journal import RESTORE_SECONDS, ReplyJournal
+from nonebot_plugin_learning_chat.models import ChatMessage, ChatReply
+
+SELF_ID = 10000
+
+
+def test_flush_writes_messages_and_replies(run, db):
+    journal = ReplyJournal()
+    journal.record(1, SELF_ID, 101, "你好", answer_id=7)
+    journal.record(2, SELF_ID, 102, "[CQ:face,id=1]")
+    run(journal.flush())
+
+    assert journal.pending == 0
+    assert run(ChatMessage.all().count()) == 2
+    assert sorted(run(ChatReply.all().values_list("message_id", "answer_id"))) == [
+        (101, 7),
+        (102, None),
+    ]
+
+
+def test_failed_flush_is_rolled_back_and_retried(run, db, monkeypatch):
+    journal = ReplyJournal()
+    journal.record(1, SELF_ID, 101, "第一条")
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("数据库不可用")
+
+    monkeypatch.setattr(ChatReply, "bulk_create", fail)
+    with pytest.raises(RuntimeError):
+        run(journal.flush())
+    assert journal.pending == 1
+    # 聊天记录与发送记录在同一个事务中，不会只写入一半
+    assert run(ChatMessage.all().count()) == 0
+
+    monkeypatch.undo()
+    journal.record(1, SELF_ID, 102, "第二条")
+    run(journal.flush())
+    assert journal.pending == 0
+    assert run(
+        ChatMessage.all().order_by("id").values_list("message_id", flat=True)
+    ) == [101, 102]
+
+
+def test_restore_reads_own_messages_and_answer_ids(run, db):
+    now = int(time.time())
+
+    async def prepare():
+        await ChatMessage.bulk_create(
+            [
+                # 升级前发送的消息没有发送记录
+                ChatMessage(group_id=1, user_id=SELF_ID, message_id=1, message="旧消息", time=now - 60),
+                ChatMessage(group_id=1, user_id=SELF_ID, message_id=2, message="回复", time=now - 30),
+                ChatMessage(group_id=1, user_id=123, message_id=3, message="群友", time=now - 20),
+                ChatMessage(
+                    group_id=2,
+                    user_id=SELF_ID,
+                    message_id=4,
+                    message="太久以前",
+                    time=now - RESTORE_SECONDS - 60,
+                ),
+            ]
+        )
+        await ChatReply.create(group_id=1, message_id=2, message="回复", answer_id=9, time=now - 30)
+
+    run(prepare())
+    journal = ReplyJournal()
+    run(journal.restore(SELF_ID))
+
+    assert [(s.message_id, s.message, s.answer_id) for s in journal._recent[1]] == [
+        (1, "旧消息", None),
+        (2, "回复", 9),
+    ]
+    assert journal.last(1).message_id == 2
+    assert journal.last(2) is None
+
+
+def test_restore_keeps_groups_already_in_memory(run, db):
+    run(ChatMessage.create(group_id=1, user_id=SELF_ID, message_id=1, message="旧", time=int(time.time())))
+    journal = ReplyJournal()
+    journal.record(1, SELF_ID, 2, "新")
+    run(journal.restore(SELF_ID))
+    assert [s.message_id for s in journal._recent[1]] == [2]
+
+
+def test_has_pending_is_per_group(run, db):
+    journal = ReplyJournal()
+    journal.record(1, SELF_ID, 101, "你好")
+    assert journal.has_pending(1)
+    assert not journal.has_pending(2)
+    run(journal.flush())
+    assert not journal.has_pending(1)
@@ -0,0 +1,44 @@
+from nonebot_plugin_learning_chat.models import ChatMessage
+from nonebot_plugin_learning_chat.reply_target import ReplyTargetResolver
+
+
+def _message(message_id: int, message: str, group_id: int = 1) -> ChatMessage:
+    return ChatMessage(
+        group_id=group_id,
+        user_id=123,
+        message_id=message_id,
+        message=message,
+        raw_message=message,
+        plain_text=message,
+        time=0,
+    )
+
+
+def test_keywords_are_extracted_only_when_resolved(run):
+    resolver = ReplyTargetResolver()
+    learned = _message(1, "今天天气真不错")
+    keywords = learned.keywords
+    resolver.add(learned, True)
+    resolver.add(_message(2, "周末一起出去玩吧"), None)
+
+    assert resolver._targets[1]._keywords == keywords
+    # 没有学习的消息保存时不分词
+    assert resolver._targets[2]._keywords is None
+    target = run(resolver.resolve(2))
+    assert target.keywords == _message(2, "周末一起出去玩吧").keywords
+
+
+def test_invalidation_resets_checked_targets(run):
+    resolver = ReplyTargetResolver()
+    banned = _message(1, "今天天气真不错")
+    resolver.add(banned, bool(banned.keywords))
+    resolver.add(_message(2, "[CQ:face,id=1]"), False)
+    other = _message(3, "周末一起出去玩吧", group_id=2)
+    resolver.add(other, bool(other.keywords))
+
+    resolver.invalidate_keywords(banned.keywords)
+    assert [t.allowed for t in resolver._targets.values()] == [None, False, True]
+    assert resolver._targets[2]._keywords is None
+
+    resolver.invalidate_group(2)
+    assert resolver._targets[3].allowed is None
@@ -0,0 +1,39 @@
+import random
+from collections import Counter
+
+import pytest
+
+from nonebot_plugin_learning_chat.sampler import AliasSampler
+
+
+def test_rejects_mismatched_or_empty_input():
+    with pytest.raises(ValueError):
+        AliasSampler(["a", "b"], [1.0])
+    with pytest.raises(ValueError):
+        AliasSampler([], [])
+
+
+def test_single_item_is_always_chosen():
+    sampler = AliasSampler(["a"], [0.3])
+    assert {sampler.sample() for _ in range(100)} == {"a"}
+
+
+def test_zero_and_negative_weights_are_never_chosen():
+    sampler = AliasSampler(["a", "b", "c"], [0.0, 1.0, -2.0])
+    assert sampler.weights == [0.0, 1.0, 0.0]
+    assert {sampler.sample() for _ in range(1000)} == {"b"}
+
+
+def test_all_zero_weights_fall_back_to_uniform():
+    sampler = AliasSampler(["a", "b"], [0.0, 0.0])
+    assert {sampler.sample() for _ in range(1000)} == {"a", "b"}
+
+
+def test_frequencies_follow_weights():
+    random.seed(0)
+    weights = [0.1, 0.2, 0.3, 0.4]
+    sampler = AliasSampler(["a", "b", "c", None], weights)
+    times = 50000
+    counter = Counter(sampler.sample() for _ in range(times))
+    for item, weight in zip(sampler.items, weights):
+        assert counter[item] / times == pytest.approx(weight, abs=0.01)
@@ -0,0 +1,105 @@
+import pytest
+
+from nonebot_plugin_learning_chat import text_store
+from nonebot_plugin_learning_chat.models import ChatJob, ChatMessage, ChatText
+from nonebot_plugin_learning_chat.partition import (
+    _connection,
+    archive_messages,
+    list_partitions,
+)
+from nonebot_plugin_learning_chat.text_store import (
+    MIGRATE_JOB_TABLE,
+    migrate_messages,
+    remove_orphan_texts,
+    save_messages,
+)
+
+OLD_TIME = 1577836800
+"""2020-01-01，早于分区归档的时间"""
+NOW = 1900000000
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    # 每个测试使用新的数据库，缓存中的文本id不再有效
+    text_store.discard_text_ids()
+    text_store._seen_messages.clear()
+    monkeypatch.setattr(text_store, "MIGRATE_INTERVAL", 0)
+
+
+def _message(message_id: int, message: str, raw_message: str, timestamp: int) -> ChatMessage:
+    return ChatMessage(
+        group_id=1,
+        user_id=123,
+        message_id=message_id,
+        message=message,
+        raw_message=raw_message,
+        time=timestamp,
+    )
+
+
+async def _partition_rows() -> list:
+    (name,) = await list_partitions()
+    return await _connection().execute_query_dict(
+        f'SELECT message_id, raw_message, text_id FROM "{name}" ORDER BY id'
+    )
+
+
+def test_migration_covers_partitions_and_runs_once(run, db):
+    async def prepare():
+        # 升级前的聊天记录保存了完整的原始消息
+        await ChatMessage.bulk_create(
+            [
+                _message(1, "你好", "你好", OLD_TIME),
+                _message(2, "[CQ:image,file=a]", "[CQ:image,file=a,url=x]", OLD_TIME),
+                _message(3, "[CQ:image,file=b]", "[CQ:image,file=b,url=y]", NOW),
+            ]
+        )
+        await archive_messages()
+
+    run(prepare())
+    assert run(migrate_messages()) == 3
+
+    assert [(r["message_id"], r["raw_message"]) for r in run(_partition_rows())] == [
+        (1, ""),
+        (2, ""),
+    ]
+    assert run(_partition_rows())[1]["text_id"] is not None
+    message = run(ChatMessage.get(message_id=3))
+    assert (message.raw_message, message.text_id is not None) == ("", True)
+    job = run(ChatJob.get(table=MIGRATE_JOB_TABLE))
+    assert (job.status, job.progress, job.total) == ("finished", 3, 3)
+
+    # 完成后不再扫描聊天记录
+    run(ChatMessage.create(message_id=4, group_id=1, user_id=123, message="a", raw_message="b", time=NOW))
+    assert run(migrate_messages()) == 0
+
+
+def test_cancelled_migration_is_not_resumed(run, db):
+    run(ChatMessage.create(message_id=1, group_id=1, user_id=123, message="a", raw_message="b", time=NOW))
+    run(ChatJob.create(table=MIGRATE_JOB_TABLE, status="cancelled", time=NOW))
+    assert run(migrate_messages()) == 0
+    assert run(ChatMessage.get(message_id=1)).raw_message == "b"
+
+
+def test_orphan_texts_are_removed(run, db):
+    async def prepare():
+        await save_messages(
+            [
+                _message(1, "[CQ:image,file=a]", "[CQ:image,file=a,url=x]", OLD_TIME),
+                _message(2, "[CQ:image,file=b]", "[CQ:image,file=b,url=y]", NOW),
+                _message(3, "[CQ:image,file=c]", "[CQ:image,file=c,url=z]", NOW),
+            ]
+        )
+        await archive_messages()
+        # 删除消息后其原始消息不再被引用
+        await ChatMessage.filter(message_id=3).delete()
+
+    run(prepare())
+    assert run(remove_orphan_texts()) == 1
+    # 已归档分区中的消息引用的文本仍然保留
+    assert sorted(run(ChatText.all().values_list("text", flat=True))) == [
+        "[CQ:image,file=a,url=x]",
+        "[CQ:image,file=b,url=y]",
+    ]
+    assert run(remove_orphan_texts()) == 0